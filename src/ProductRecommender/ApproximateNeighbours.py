@@ -0,0 +1,321 @@
+"""
+This file computes approximate top-k cosine neighbours for catalogs where the exact search gets too slow.
+The sparse vectors are reduced to dense float32 embeddings by a TruncatedSVD or a random projection.
+An inverted file index (IVF) clusters the embeddings into lists and every product only searches
+the n_probe lists closest to it. The found neighbours get their exact cosine similarity as score.
+"""
+import logging
+import time
+from typing import Dict, Tuple
+
+import numpy as np
+from scipy import sparse
+from sklearn.decomposition import TruncatedSVD
+from sklearn.random_projection import SparseRandomProjection
+from sklearn.preprocessing import normalize
+
+from TopKSimilarity import get_block_size, prepare_matrix, select_top_k, top_k_rows
+
+logger = logging.getLogger("ApproximateNeighbours")
+
+REDUCERS = ("svd", "random_projection")
+
+
+def embed_vectors(vectors: sparse.spmatrix, n_components: int = 128, reducer: str = "svd",
+                  seed: int = 42) -> np.ndarray:
+    """
+    This function reduces the sparse vectors to l2 normalized dense float32 embeddings.
+    :param vectors:
+    :type vectors: sparse.spmatrix
+    :param n_components: Dimensions of the embeddings.
+    :type n_components: int
+    :param reducer: svd or random_projection
+    :type reducer: str
+    :param seed:
+    :type seed: int
+    :return: An array of shape (N, n_components).
+    :rtype: np.ndarray
+    """
+    matrix = normalize(sparse.csr_matrix(vectors, dtype=np.float32), norm="l2")
+    if reducer == "svd":
+        n_components = max(1, min(n_components, matrix.shape[1] - 1))
+        embeddings = TruncatedSVD(n_components=n_components, random_state=seed).fit_transform(matrix)
+    elif reducer == "random_projection":
+        embeddings = SparseRandomProjection(n_components=n_components, dense_output=True,
+                                            random_state=seed).fit_transform(matrix)
+    else:
+        raise ValueError(f"Unknown reducer <{reducer}>, use one of {REDUCERS}.")
+
+    return normalize(embeddings.astype(np.float32, copy=False), norm="l2")
+
+
+def assign_lists(embeddings: np.ndarray, centroids: np.ndarray, block_size: int = 4096) -> np.ndarray:
+    """
+    This function returns the index of the most similar centroid per row.
+    :param embeddings:
+    :type embeddings: np.ndarray
+    :param centroids:
+    :type centroids: np.ndarray
+    :param block_size: Number of rows that are assigned at once.
+    :type block_size: int
+    :return:
+    :rtype: np.ndarray
+    """
+    list_ids = np.empty(len(embeddings), dtype=np.int64)
+    for start in range(0, len(embeddings), block_size):
+        list_ids[start:start + block_size] = np.argmax(embeddings[start:start + block_size] @ centroids.T, axis=1)
+
+    return list_ids
+
+
+def build_ivf_lists(embeddings: np.ndarray, n_lists: int, seed: int = 42, n_iter: int = 10,
+                    max_train_rows_per_list: int = 64) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    This function clusters the embeddings into n_lists lists by a spherical k-means
+    on a sample of at most max_train_rows_per_list rows per list.
+    :param embeddings:
+    :type embeddings: np.ndarray
+    :param n_lists:
+    :type n_lists: int
+    :param seed:
+    :type seed: int
+    :param n_iter: Number of k-means iterations.
+    :type n_iter: int
+    :param max_train_rows_per_list:
+    :type max_train_rows_per_list: int
+    :return: The l2 normalized centroids of shape (n_lists, dimensions) and the list per row.
+    :rtype: Tuple[np.ndarray, np.ndarray]
+    """
+    rng = np.random.default_rng(seed)
+    n_lists = max(1, min(n_lists, len(embeddings)))
+    n_train_rows = min(len(embeddings), n_lists * max_train_rows_per_list)
+    train_rows = embeddings[np.sort(rng.choice(len(embeddings), size=n_train_rows, replace=False))]
+
+    centroids = train_rows[rng.choice(n_train_rows, size=n_lists, replace=False)]
+    for _ in range(n_iter):
+        train_list_ids = assign_lists(train_rows, centroids)
+        membership = sparse.csr_matrix((np.ones(n_train_rows, dtype=np.float32),
+                                        (train_list_ids, np.arange(n_train_rows))),
+                                       shape=(n_lists, n_train_rows))
+        sums = membership @ train_rows
+        # Empty lists keep their centroid
+        filled = np.asarray(membership.sum(axis=1)).ravel() > 0
+        centroids[filled] = normalize(sums[filled], norm="l2")
+
+    return centroids, assign_lists(embeddings, centroids)
+
+
+def exact_pair_scores(matrix: sparse.csr_matrix, row_ids: np.ndarray, neighbour_indices: np.ndarray,
+                      block_size: int = 4096) -> np.ndarray:
+    """
+    This function returns the exact cosine similarity of every row to each of its neighbours.
+    :param matrix: The l2 normalized matrix.
+    :type matrix: sparse.csr_matrix
+    :param row_ids:
+    :type row_ids: np.ndarray
+    :param neighbour_indices: Neighbours of shape (len(row_ids), k), -1 marks no neighbour.
+    :type neighbour_indices: np.ndarray
+    :param block_size: Number of rows whose pairs are multiplied at once.
+    :type block_size: int
+    :return: The scores of shape (len(row_ids), k), -inf for missing neighbours.
+    :rtype: np.ndarray
+    """
+    k = neighbour_indices.shape[1]
+    scores = np.full(neighbour_indices.shape, -np.inf, dtype=np.float32)
+    for start in range(0, len(row_ids), block_size):
+        block_neighbours = neighbour_indices[start:start + block_size]
+        found = block_neighbours >= 0
+        pair_rows = np.repeat(row_ids[start:start + block_size], k)[found.ravel()]
+        pair_scores = np.asarray(matrix[pair_rows].multiply(matrix[block_neighbours[found]]).sum(axis=1)).ravel()
+        block_scores = scores[start:start + block_size]
+        block_scores[found] = pair_scores
+
+    return scores
+
+
+def partition_top_k(score_block: np.ndarray, k: int) -> np.ndarray:
+    """
+    This function returns the columns of the k highest scores per row in no particular order.
+    :param score_block:
+    :type score_block: np.ndarray
+    :param k:
+    :type k: int
+    :return: The columns of shape (rows, k).
+    :rtype: np.ndarray
+    """
+    n_cols = score_block.shape[1]
+    if k >= n_cols:
+        return np.tile(np.arange(n_cols), (len(score_block), 1))
+
+    return np.argpartition(score_block, n_cols - k, axis=1)[:, n_cols - k:]
+
+
+def ivf_top_k(embeddings: np.ndarray, k: int, n_lists: int, n_probe: int, seed: int = 42,
+              block_size: int = 256, max_block_mb: float = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    This function searches the k nearest embeddings of every row in the n_probe closest lists.
+    Every list multiplies all rows that probe it with its members at once,
+    so the work is n_probe / n_lists of the exact search.
+    :param embeddings: l2 normalized embeddings.
+    :type embeddings: np.ndarray
+    :param k:
+    :type k: int
+    :param n_lists:
+    :type n_lists: int
+    :param n_probe: Number of lists that every row searches.
+    :type n_probe: int
+    :param seed:
+    :type seed: int
+    :param block_size: Number of probing rows that are multiplied with a list at once.
+    :type block_size: int
+    :param max_block_mb:
+    :type max_block_mb: float
+    :return: The neighbour indices (int32, -1 if a row found less than k neighbours) and the embedding scores
+        (float32) of shape (N, k) in no particular order.
+    :rtype: Tuple[np.ndarray, np.ndarray]
+    """
+    n_rows = len(embeddings)
+    centroids, list_ids = build_ivf_lists(embeddings, n_lists, seed)
+    n_probe = max(1, min(n_probe, len(centroids)))
+
+    probes = np.empty((n_rows, n_probe), dtype=np.int64)
+    for start in range(0, n_rows, 4096):
+        probes[start:start + 4096] = select_top_k(embeddings[start:start + 4096] @ centroids.T, n_probe)[0]
+
+    # The members of every list are sorted by row
+    members = np.argsort(list_ids, kind="stable")
+    member_offsets = np.searchsorted(list_ids[members], np.arange(len(centroids) + 1))
+    probing_rows = np.argsort(probes.ravel(), kind="stable") // n_probe
+    probing_offsets = np.searchsorted(np.sort(probes.ravel()), np.arange(len(centroids) + 1))
+
+    neighbour_indices = np.full((n_rows, k), -1, dtype=np.int32)
+    neighbour_scores = np.full((n_rows, k), -np.inf, dtype=np.float32)
+    for list_id in range(len(centroids)):
+        list_members = members[member_offsets[list_id]:member_offsets[list_id + 1]]
+        list_rows = probing_rows[probing_offsets[list_id]:probing_offsets[list_id + 1]]
+        if len(list_members) == 0 or len(list_rows) == 0:
+            continue
+
+        list_embeddings_t = embeddings[list_members].T
+        list_block_size = get_block_size(len(list_members) + k, block_size, max_block_mb)
+        for start in range(0, len(list_rows), list_block_size):
+            rows = list_rows[start:start + list_block_size]
+            # The kept neighbours come first, so one partition merges them with the members of the list
+            candidate_scores = np.hstack([neighbour_scores[rows], embeddings[rows] @ list_embeddings_t])
+            own_rows = np.flatnonzero(list_ids[rows] == list_id)
+            candidate_scores[own_rows, k + np.searchsorted(list_members, rows[own_rows])] = -np.inf
+
+            columns = partition_top_k(candidate_scores, k)
+            from_list = columns >= k
+            neighbour_indices[rows] = np.where(from_list, list_members[np.maximum(columns - k, 0)],
+                                               np.take_along_axis(neighbour_indices[rows], np.minimum(columns, k - 1),
+                                                                  axis=1))
+            neighbour_scores[rows] = np.take_along_axis(candidate_scores, columns, axis=1)
+
+    neighbour_indices[np.isneginf(neighbour_scores)] = -1
+    return neighbour_indices, neighbour_scores
+
+
+def approximate_top_k_cosine_similarity(vecs: sparse.spmatrix, k: int, n_components: int = 128,
+                                        reducer: str = "svd", n_lists: int = None, n_probe: int = 8,
+                                        n_candidates: int = None, seed: int = 42, block_size: int = 256,
+                                        max_block_mb: float = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    This function computes approximately the k most similar rows of every row by cosine similarity.
+    The n_candidates nearest embeddings are searched, then the k candidates with the highest exact cosine
+    similarity are kept. Rows that found less than k candidates in their lists are searched exactly.
+    :param vecs: Sparse document vectors, e.g. the output of the TfidfVectorizer.
+    :type vecs: sparse.spmatrix
+    :param k: Number of neighbours per row.
+    :type k: int
+    :param n_components: Dimensions of the embeddings.
+    :type n_components: int
+    :param reducer: svd or random_projection
+    :type reducer: str
+    :param n_lists: Number of IVF lists, by default sqrt(N).
+    :type n_lists: int
+    :param n_probe: Number of lists that every row searches.
+    :type n_probe: int
+    :param n_candidates: Number of candidates per row that are scored exactly, by default 4 * k.
+    :type n_candidates: int
+    :param seed:
+    :type seed: int
+    :param block_size:
+    :type block_size: int
+    :param max_block_mb:
+    :type max_block_mb: float
+    :return: The neighbour indices (int32) and exact scores (float32) of shape (N, k) in descending score order.
+    :rtype: Tuple[np.ndarray, np.ndarray]
+    """
+    n_rows = vecs.shape[0]
+    k = max(0, min(k, n_rows - 1))
+    if k == 0:
+        return np.empty((n_rows, 0), dtype=np.int32), np.empty((n_rows, 0), dtype=np.float32)
+    n_lists = n_lists or int(np.sqrt(n_rows))
+    n_candidates = max(k, min(n_candidates or 4 * k, n_rows - 1))
+
+    start_time = time.perf_counter()
+    embeddings = embed_vectors(vecs, n_components, reducer, seed)
+    logger.info(f"Reduced {n_rows} rows to {embeddings.shape[1]} dimensions with {reducer} "
+                f"in {time.perf_counter() - start_time:.2f}s")
+
+    start_time = time.perf_counter()
+    indices, _ = ivf_top_k(embeddings, n_candidates, n_lists, n_probe, seed, block_size, max_block_mb)
+    del embeddings
+    logger.info(f"Searched {n_probe} of {n_lists} lists per row in {time.perf_counter() - start_time:.2f}s")
+
+    matrix, _ = prepare_matrix(vecs)
+    scores = exact_pair_scores(matrix, np.arange(n_rows), indices)
+    order = np.lexsort((indices, -scores), axis=1)[:, :k]
+    indices = np.take_along_axis(indices, order, axis=1)
+    scores = np.take_along_axis(scores, order, axis=1)
+
+    incomplete_rows = np.flatnonzero((indices < 0).any(axis=1))
+    if len(incomplete_rows):
+        logger.info(f"Searching {len(incomplete_rows)} rows with less than {k} candidates exactly")
+        indices[incomplete_rows], scores[incomplete_rows] = top_k_rows(vecs, incomplete_rows, k, block_size,
+                                                                       max_block_mb)
+
+    return indices, scores
+
+
+def recall_at_k(vecs: sparse.spmatrix, indices: np.ndarray, scores: np.ndarray, n_samples: int = 1000,
+                seed: int = 42, block_size: int = 256, max_block_mb: float = None) -> Dict:
+    """
+    This function compares approximate neighbours with the exact search on a sample of rows.
+    A neighbour counts as found if its exact score reaches the k-th exact score of its row,
+    so neighbours with the same score as the exact ones are not counted as misses.
+    :param vecs:
+    :type vecs: sparse.spmatrix
+    :param indices: The approximate neighbours of all rows.
+    :type indices: np.ndarray
+    :param scores: The exact scores of the approximate neighbours.
+    :type scores: np.ndarray
+    :param n_samples: Number of rows that are searched exactly.
+    :type n_samples: int
+    :param seed:
+    :type seed: int
+    :param block_size:
+    :type block_size: int
+    :param max_block_mb:
+    :type max_block_mb: float
+    :return: The recall@k, the mean score ratio to the exact neighbours and the number of sampled rows.
+    :rtype: Dict
+    """
+    k = indices.shape[1]
+    n_rows = vecs.shape[0]
+    sample_rows = np.sort(np.random.default_rng(seed).choice(n_rows, size=min(n_samples, n_rows), replace=False))
+    if k == 0 or len(sample_rows) == 0:
+        return {"k": k, "recall": 1.0, "score_ratio": 1.0, "n_samples": len(sample_rows)}
+
+    _, exact_scores = top_k_rows(vecs, sample_rows, k, block_size, max_block_mb)
+    sample_scores = scores[sample_rows]
+    hits = (sample_scores >= exact_scores[:, -1:] - 1e-6).sum(axis=1)
+    exact_sums = exact_scores.sum(axis=1)
+    score_ratio = np.divide(sample_scores.sum(axis=1), exact_sums, out=np.ones_like(exact_sums),
+                            where=exact_sums > 0)
+
+    return {"k": k,
+            "recall": float(np.mean(np.minimum(hits, k) / k)),
+            "score_ratio": float(np.mean(score_ratio)),
+            "n_samples": len(sample_rows)}
@@ -0,0 +1,127 @@
+"""
+This file contains the asyncio client of the Magento REST endpoints.
+All requests share one keep-alive connection pool and one OAuth1 authorization,
+and every host gets at most max_connections_per_host requests at the same time.
+"""
+import asyncio
+import logging
+import time
+from typing import Dict
+from urllib.parse import urlparse
+
+import httpx
+from requests_oauthlib import OAuth1
+
+from RunMetrics import run_metrics
+
+logger = logging.getLogger("AsyncMagentoClient")
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class OAuth1Auth(httpx.Auth):
+    """
+    This class signs the httpx requests with the oauthlib client of a requests OAuth1 object,
+    so the sync session and the async client use the same authorization.
+    """
+
+    def __init__(self, oauth1: OAuth1):
+        self.oauth_client = oauth1.client
+
+    def auth_flow(self, request: httpx.Request):
+        # The client of requests_oauthlib returns the Authorization header as bytes
+        _, signed_headers, _ = self.oauth_client.sign(str(request.url), http_method=request.method)
+        request.headers.update(signed_headers)
+        yield request
+
+
+class AsyncMagentoClient:
+    """
+    This class sends GET requests to Magento with retries and a concurrency limit per host.
+    It has to be used as async context manager, which opens and closes the connection pool.
+    """
+
+    def __init__(self, base_url: str, auth: OAuth1, max_connections_per_host: int = 8, timeout: float = 60,
+                 max_retries: int = 5, backoff_factor: float = 0.5):
+        self.base_url = base_url
+        self.auth = OAuth1Auth(auth)
+        self.max_connections_per_host = max_connections_per_host
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.host_semaphores = {}
+        self.client = None
+
+    async def __aenter__(self) -> "AsyncMagentoClient":
+        self.client = httpx.AsyncClient(auth=self.auth,
+                                        timeout=self.timeout,
+                                        limits=httpx.Limits(max_keepalive_connections=self.max_connections_per_host))
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.client.aclose()
+        self.client = None
+
+    def get_host_semaphore(self, url: str) -> asyncio.Semaphore:
+        """
+        This function returns the semaphore that limits the concurrent requests to the host of the url.
+        :param url:
+        :type url: str
+        :return:
+        :rtype: asyncio.Semaphore
+        """
+        host = urlparse(url).netloc
+        if host not in self.host_semaphores:
+            self.host_semaphores[host] = asyncio.Semaphore(self.max_connections_per_host)
+
+        return self.host_semaphores[host]
+
+    async def get(self, endpoint: str, params: Dict = None, headers: Dict = None) -> httpx.Response:
+        """
+        This function requests an endpoint and retries connection errors and the status codes 429 and 5xx
+        with an exponential backoff. Every response is counted in the run metrics.
+        :param endpoint: The path of the endpoint, e.g. /rest/all/V1/products.
+        :type endpoint: str
+        :param params:
+        :type params: Dict
+        :param headers:
+        :type headers: Dict
+        :return: The last response, its status is not checked.
+        :rtype: httpx.Response
+        """
+        url = self.base_url + endpoint
+        for attempt in range(self.max_retries + 1):
+            async with self.get_host_semaphore(url):
+                start_time = time.perf_counter()
+                try:
+                    response = await self.client.get(url, params=params, headers=headers)
+                except httpx.TransportError:
+                    if attempt == self.max_retries:
+                        raise
+                    response = None
+                else:
+                    run_metrics.record_http(endpoint, len(response.content), response.status_code,
+                                            time.perf_counter() - start_time)
+
+            if response is not None and (response.status_code not in RETRY_STATUS_CODES
+                                         or attempt == self.max_retries):
+                return response
+
+            reason = "a connection error" if response is None else f"status {response.status_code}"
+            logger.info(f"Retrying <{endpoint}> after {reason}")
+            await asyncio.sleep(self.backoff_factor * 2 ** attempt)
+
+    async def get_json(self, endpoint: str, params: Dict = None):
+        """
+        This function returns the json response of an endpoint and raises for error status codes.
+        :param endpoint:
+        :type endpoint: str
+        :param params:
+        :type params: Dict
+        :return:
+        :rtype:
+        """
+        response = await self.get(endpoint, params)
+        response.raise_for_status()
+
+        return response.json()
@@ -0,0 +1,141 @@
+"""
+This file collects the recommendations of many products at once from the top-k neighbour arrays.
+"""
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+
+from CandidateFilter import get_candidate_mask
+
+
+def get_sku_codes(skus: Sequence[str]) -> np.ndarray:
+    """
+    This function returns an integer code per row, rows with the same sku get the same code.
+    Callers that select the recommendations several times per run compute the codes once and pass them on.
+    :param skus:
+    :type skus: Sequence[str]
+    :return:
+    :rtype: np.ndarray
+    """
+    _, sku_codes = np.unique(np.asarray(skus, dtype=object).astype(str), return_inverse=True)
+    return sku_codes
+
+
+def select_recommendations(row_ids: Sequence[int], neighbour_indices: np.ndarray, neighbour_scores: np.ndarray,
+                           skus: Sequence[str], n_products: int = 15, allowed: np.ndarray = None,
+                           category_bitsets: np.ndarray = None, block_size: int = 8192,
+                           sku_codes: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    This function returns the rows and scores of the first n recommendations for every given row id
+    in descending score order.
+    The product itself, products with the same sku and padded neighbours (index -1) are skipped,
+    as well as neighbours that are not allowed or share no category with the product if the masks are given.
+    The rows are processed in blocks, so the candidate masks of many rows and wide candidate lists stay small.
+    :param row_ids: Positional ids of the products, i.e. the row in neighbour_indices.
+    :type row_ids: Sequence[int]
+    :param neighbour_indices: Neighbour row ids of shape (N, k).
+    :type neighbour_indices: np.ndarray
+    :param neighbour_scores: Neighbour scores of shape (N, k).
+    :type neighbour_scores: np.ndarray
+    :param skus: The sku per row id.
+    :type skus: Sequence[str]
+    :param n_products:
+    :type n_products: int
+    :param allowed: Boolean mask per product of the products that may be recommended, e.g. in stock and enabled.
+    :type allowed: np.ndarray
+    :param category_bitsets: Category bitsets per product of CandidateFilter.get_category_bitsets.
+    :type category_bitsets: np.ndarray
+    :param block_size: Number of rows whose candidates are filtered at once.
+    :type block_size: int
+    :param sku_codes: The output of get_sku_codes for the skus, computed from the skus if not given.
+    :type sku_codes: np.ndarray
+    :return: The recommended rows and their scores of shape (len(row_ids), n_products). The valid recommendations
+        come first, the rows are filled up with -1 and the scores with 0 if too few neighbours exist.
+    :rtype: Tuple[np.ndarray, np.ndarray]
+    """
+    rows = np.asarray(row_ids, dtype=np.int64)
+    if sku_codes is None:
+        sku_codes = get_sku_codes(skus)
+
+    recommended_rows = np.full((rows.shape[0], n_products), -1, dtype=np.int64)
+    recommended_scores = np.zeros((rows.shape[0], n_products), dtype=neighbour_scores.dtype)
+    for start in range(0, rows.shape[0], block_size):
+        block_rows = rows[start:start + block_size]
+        block_indices = neighbour_indices[block_rows]
+        block_scores = neighbour_scores[block_rows]
+        valid = (get_candidate_mask(block_rows, block_indices, allowed, category_bitsets)
+                 & (block_indices != block_rows[:, None])
+                 & (sku_codes[block_indices] != sku_codes[block_rows][:, None]))
+
+        order = np.lexsort((-block_scores, ~valid), axis=1)[:, :n_products]
+        selected_valid = np.take_along_axis(valid, order, axis=1)
+        recommended_rows[start:start + block_size, :order.shape[1]] = np.where(
+            selected_valid, np.take_along_axis(block_indices, order, axis=1), -1)
+        recommended_scores[start:start + block_size, :order.shape[1]] = np.where(
+            selected_valid, np.take_along_axis(block_scores, order, axis=1), 0)
+
+    return recommended_rows, recommended_scores
+
+
+def recommend_batch(row_ids: Sequence[int], neighbour_indices: np.ndarray, neighbour_scores: np.ndarray,
+                    skus: Sequence[str], n_products: int = 15, allowed: np.ndarray = None,
+                    category_bitsets: np.ndarray = None, block_size: int = 8192,
+                    sku_codes: np.ndarray = None) -> np.ndarray:
+    """
+    This function returns the first n recommended skus for every given row id in descending score order,
+    the candidates are filtered like in select_recommendations.
+    :param row_ids:
+    :type row_ids: Sequence[int]
+    :param neighbour_indices:
+    :type neighbour_indices: np.ndarray
+    :param neighbour_scores:
+    :type neighbour_scores: np.ndarray
+    :param skus:
+    :type skus: Sequence[str]
+    :param n_products:
+    :type n_products: int
+    :param allowed:
+    :type allowed: np.ndarray
+    :param category_bitsets:
+    :type category_bitsets: np.ndarray
+    :param block_size:
+    :type block_size: int
+    :param sku_codes:
+    :type sku_codes: np.ndarray
+    :return: An object array of shape (len(row_ids), n_products), filled up with None if too few neighbours exist.
+    :rtype: np.ndarray
+    """
+    recommended_rows, _ = select_recommendations(row_ids, neighbour_indices, neighbour_scores, skus, n_products,
+                                                 allowed, category_bitsets, block_size, sku_codes)
+
+    return to_skus(recommended_rows, skus)
+
+
+def to_skus(recommended_rows: np.ndarray, skus: Sequence[str]) -> np.ndarray:
+    """
+    This function returns the skus of the rows of select_recommendations, None for the missing rows.
+    :param recommended_rows:
+    :type recommended_rows: np.ndarray
+    :param skus:
+    :type skus: Sequence[str]
+    :return:
+    :rtype: np.ndarray
+    """
+    return np.where(recommended_rows >= 0, np.asarray(skus, dtype=object)[recommended_rows], None)
+
+
+def to_recommender_dict(query_skus: Sequence[str], recommendations: np.ndarray) -> Dict[str, List[str]]:
+    """
+    This function converts the output of recommend_batch to a dict with the sku as key and its recommended skus.
+    :param query_skus:
+    :type query_skus: Sequence[str]
+    :param recommendations:
+    :type recommendations: np.ndarray
+    :return:
+    :rtype: Dict[str, List[str]]
+    """
+    product_recommender_dict = {}
+    for sku, recommended_skus in zip(query_skus, recommendations.tolist()):
+        product_recommender_dict[sku] = [esg_sku for esg_sku in recommended_skus if esg_sku is not None]
+
+    return product_recommender_dict
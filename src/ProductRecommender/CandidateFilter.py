@@ -0,0 +1,113 @@
+"""
+This file derives the recommendations from the candidate neighbours of the neighbour stage.
+The stock and status of the products are boolean masks and their categories bitsets, one bit per category,
+so a changed stock or a category filter only needs the saved candidates and no new similarity search.
+"""
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
+
+# The column with the comma separated category ids of a product
+CATEGORY_COLUMN = "category_ids"
+
+
+def get_category_bitsets(product_df: pd.DataFrame, column: str = CATEGORY_COLUMN) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    This function returns the sorted category ids and a bitset of the categories per product.
+    Bit i of a bitset is category_ids[i] in the order of np.packbits, ids that are no integers are ignored.
+    :param product_df:
+    :type product_df: pd.DataFrame
+    :param column:
+    :type column: str
+    :return: The category ids (int64) and the bitsets (uint8) of shape (N, ceil(n_categories / 8)).
+    :rtype: Tuple[np.ndarray, np.ndarray]
+    """
+    n_rows = len(product_df)
+    if column not in product_df.columns:
+        return np.empty(0, dtype=np.int64), np.zeros((n_rows, 0), dtype=np.uint8)
+
+    values = pd.Series(product_df[column].astype(object).fillna("").astype(str).to_numpy())
+    row_categories = pd.to_numeric(values.str.split(",").explode().str.strip(), errors="coerce").dropna()
+    category_ids, codes = np.unique(row_categories.to_numpy(dtype=np.int64), return_inverse=True)
+
+    # Distinct categories of a row set distinct bits, so the sum of the bits per byte is their bitwise or
+    n_bytes = -(-len(category_ids) // 8)
+    row_codes = np.unique(row_categories.index.to_numpy(dtype=np.int64) * max(len(category_ids), 1) + codes)
+    rows, codes = np.divmod(row_codes, max(len(category_ids), 1))
+    bits = np.right_shift(128, codes % 8)
+    bitsets = np.bincount(rows * n_bytes + codes // 8, weights=bits, minlength=n_rows * n_bytes)
+
+    return category_ids, bitsets.astype(np.uint8).reshape(n_rows, n_bytes)
+
+
+def get_category_bit(category_ids: np.ndarray, category_id: int) -> Tuple[int, int]:
+    """
+    This function returns the byte and the bit mask of a category in the bitsets.
+    :param category_ids: The sorted category ids of the bitsets.
+    :type category_ids: np.ndarray
+    :param category_id:
+    :type category_id: int
+    :return: (-1, 0) if the category is unknown.
+    :rtype: Tuple[int, int]
+    """
+    position = int(np.searchsorted(category_ids, category_id))
+    if position >= len(category_ids) or category_ids[position] != category_id:
+        return -1, 0
+
+    return position // 8, 128 >> (position % 8)
+
+
+def shares_category(category_bitsets: np.ndarray, row_ids: np.ndarray, candidate_indices: np.ndarray) -> np.ndarray:
+    """
+    This function checks per candidate if it has at least one category of its row.
+    :param category_bitsets: The output of get_category_bitsets.
+    :type category_bitsets: np.ndarray
+    :param row_ids:
+    :type row_ids: np.ndarray
+    :param candidate_indices: Candidate rows of shape (len(row_ids), k), -1 for missing candidates.
+    :type candidate_indices: np.ndarray
+    :return: A boolean array of the shape of candidate_indices.
+    :rtype: np.ndarray
+    """
+    row_bitsets = category_bitsets[row_ids][:, None, :]
+    common = np.bitwise_and(category_bitsets[candidate_indices], row_bitsets).any(axis=2)
+
+    return common & (candidate_indices >= 0)
+
+
+def get_candidate_mask(row_ids: np.ndarray, candidate_indices: np.ndarray, allowed: np.ndarray = None,
+                       category_bitsets: np.ndarray = None) -> np.ndarray:
+    """
+    This function checks per candidate if it exists, is allowed and shares a category with its row.
+    :param row_ids:
+    :type row_ids: np.ndarray
+    :param candidate_indices: Candidate rows of the given rows of shape (len(row_ids), k), -1 for missing candidates.
+    :type candidate_indices: np.ndarray
+    :param allowed: Boolean mask per product, e.g. in stock and enabled. All products are allowed if not given.
+    :type allowed: np.ndarray
+    :param category_bitsets: Only keep candidates with a category of their row if given.
+    :type category_bitsets: np.ndarray
+    :return: A boolean array of the shape of candidate_indices.
+    :rtype: np.ndarray
+    """
+    valid = candidate_indices >= 0
+    if allowed is not None:
+        valid &= allowed[candidate_indices]
+    if category_bitsets is not None:
+        valid &= shares_category(category_bitsets, np.asarray(row_ids), candidate_indices)
+
+    return valid
+
+
+def get_affected_rows(candidate_indices: np.ndarray, changed: np.ndarray) -> np.ndarray:
+    """
+    This function returns the rows with at least one candidate whose mask value changed.
+    :param candidate_indices: Candidate rows of all products of shape (N, k).
+    :type candidate_indices: np.ndarray
+    :param changed: Boolean mask of the products whose stock or status changed.
+    :type changed: np.ndarray
+    :return:
+    :rtype: np.ndarray
+    """
+    return np.flatnonzero((changed[candidate_indices] & (candidate_indices >= 0)).any(axis=1))
@@ -0,0 +1,215 @@
+"""
+This file contains the ColumnarFrameBuilder that collects rows as columns and builds the DataFrame once.
+"""
+import logging
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+logger = logging.getLogger("ColumnarFrameBuilder")
+
+
+def to_arrow_table(frame: pd.DataFrame) -> pa.Table:
+    """
+    This function converts a chunk frame to an arrow table. Columns without any value become null columns,
+    object columns with mixed types are stored as strings.
+    :param frame:
+    :type frame: pd.DataFrame
+    :return:
+    :rtype: pa.Table
+    """
+    frame = frame.copy()
+    for column_name in frame.columns:
+        if frame[column_name].isna().all():
+            frame[column_name] = pd.Series([None] * len(frame), index=frame.index, dtype=object)
+
+    try:
+        return pa.Table.from_pandas(frame, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        for column_name in frame.columns[frame.dtypes == object]:
+            frame[column_name] = frame[column_name].map(lambda value: value if pd.isna(value) else str(value))
+        return pa.Table.from_pandas(frame, preserve_index=False)
+
+
+def dictionary_encode_columns(table: pa.Table, max_distinct_ratio: float,
+                              text_columns: Iterable[str] = ()) -> pa.Table:
+    """
+    This function dictionary encodes the string columns with few distinct values, they become categorical columns
+    in pandas and keep every distinct value once instead of one python string per row.
+    :param table:
+    :type table: pa.Table
+    :param max_distinct_ratio: Highest ratio of distinct values to rows that gets encoded.
+    :type max_distinct_ratio: float
+    :param text_columns: Columns that stay strings, e.g. texts that get concatenated.
+    :type text_columns: Iterable[str]
+    :return:
+    :rtype: pa.Table
+    """
+    text_columns = set(text_columns)
+    for index, field in enumerate(table.schema):
+        if not pa.types.is_string(field.type) or field.name in text_columns:
+            continue
+        column = table.column(index)
+        if len(column.unique()) <= max_distinct_ratio * max(table.num_rows, 1):
+            table = table.set_column(index, field.name, column.dictionary_encode())
+
+    return table
+
+
+def concat_arrow_tables(tables: List[pa.Table]) -> pa.Table:
+    """
+    This function concatenates tables with different columns. Missing columns are filled with nulls
+    and null columns take the type of the other tables.
+    :param tables:
+    :type tables: List[pa.Table]
+    :return:
+    :rtype: pa.Table
+    """
+    schema = pa.unify_schemas([table.schema for table in tables])
+    aligned_tables = []
+    for table in tables:
+        columns = [table.column(field.name).cast(field.type) if field.name in table.column_names
+                   else pa.nulls(table.num_rows, field.type) for field in schema]
+        aligned_tables.append(pa.Table.from_arrays(columns, schema=schema))
+
+    return pa.concat_tables(aligned_tables)
+
+
+class ColumnarFrameBuilder:
+    """
+    This class collects the values of dict rows in per-column lists.
+    Columns keep the order of their first appearance and missing values are filled with NaN,
+    so the result equals a concat of one-row frames.
+    With chunk_rows set, every chunk of rows is converted to a frame, transformed and spilled to a Parquet file,
+    so the memory of the collected rows depends on the chunk size and not on the number of rows.
+    The text_columns of the spilled chunks stay object columns, the other string columns can become categorical.
+    """
+
+    def __init__(self, chunk_rows: int = None, spill_dir=None, keep_columns: Iterable[str] = None,
+                 chunk_transform: Callable[[pd.DataFrame], pd.DataFrame] = None, max_distinct_ratio: float = 0.5,
+                 text_columns: Iterable[str] = ()):
+        self.columns = {}
+        self.n_rows = 0
+        self.chunk_rows = chunk_rows
+        self.max_distinct_ratio = max_distinct_ratio
+        self.text_columns = set(text_columns)
+        self.keep_columns = set(keep_columns) if keep_columns else None
+        self.chunk_transform = chunk_transform
+        self.spill_dir = None
+        self.spill_paths = []
+        self.n_spilled_rows = 0
+        if chunk_rows:
+            if spill_dir:
+                Path(spill_dir).mkdir(parents=True, exist_ok=True)
+            self.spill_dir = Path(tempfile.mkdtemp(prefix="product_frame_", dir=spill_dir or None))
+
+    def append_row(self, row: Dict):
+        """
+        This function appends one row.
+        :param row:
+        :type row: Dict
+        :return:
+        :rtype:
+        """
+        for column_name, value in row.items():
+            if self.keep_columns is not None and column_name not in self.keep_columns:
+                continue
+            column = self.columns.get(column_name)
+            if column is None:
+                column = []
+                self.columns[column_name] = column
+            if len(column) < self.n_rows:
+                column.extend([np.nan] * (self.n_rows - len(column)))
+            column.append(value)
+        self.n_rows += 1
+
+        if self.chunk_rows and self.n_rows >= self.chunk_rows:
+            self.spill()
+
+    def append_rows(self, rows: Iterable[Dict]):
+        """
+        This function appends all rows.
+        :param rows:
+        :type rows: Iterable[Dict]
+        :return:
+        :rtype:
+        """
+        for row in rows:
+            self.append_row(row)
+
+    def build_chunk(self) -> pd.DataFrame:
+        """
+        This function builds the frame of the buffered rows and empties the buffer.
+        :return:
+        :rtype: pd.DataFrame
+        """
+        for column in self.columns.values():
+            if len(column) < self.n_rows:
+                column.extend([np.nan] * (self.n_rows - len(column)))
+
+        frame = pd.DataFrame(self.columns, index=pd.RangeIndex(self.n_spilled_rows,
+                                                               self.n_spilled_rows + self.n_rows))
+        if self.chunk_transform is not None:
+            frame = self.chunk_transform(frame)
+        self.columns = {}
+        self.n_rows = 0
+
+        return frame
+
+    def spill(self):
+        """
+        This function writes the buffered rows to the next Parquet file of the spill directory.
+        :return:
+        :rtype:
+        """
+        if self.n_rows == 0:
+            return
+
+        chunk = self.build_chunk()
+        spill_path = self.spill_dir / f"part-{len(self.spill_paths):05d}.parquet"
+        pq.write_table(to_arrow_table(chunk), spill_path)
+        self.spill_paths.append(spill_path)
+        self.n_spilled_rows += len(chunk)
+
+    def build(self, categorical_columns: Iterable[str] = ()) -> pd.DataFrame:
+        """
+        This function builds the DataFrame of all appended rows.
+        Spilled chunks are read back and the spill directory gets removed. Their string columns
+        with at most max_distinct_ratio distinct values per row get the categorical dtype, except the text columns.
+        :param categorical_columns: Columns that get the categorical dtype if they exist.
+        :type categorical_columns: Iterable[str]
+        :return:
+        :rtype: pd.DataFrame
+        """
+        if not self.spill_paths:
+            frame = self.build_chunk()
+        else:
+            self.spill()
+            logger.info(f"Reading {self.n_spilled_rows} rows from {len(self.spill_paths)} spilled chunks")
+            table = concat_arrow_tables([pq.read_table(spill_path) for spill_path in self.spill_paths])
+            table = dictionary_encode_columns(table, self.max_distinct_ratio, self.text_columns)
+            frame = table.to_pandas(split_blocks=True, self_destruct=True)
+            del table
+        self.cleanup()
+
+        for column_name in categorical_columns:
+            if column_name in frame.columns and not isinstance(frame[column_name].dtype, pd.CategoricalDtype):
+                frame[column_name] = frame[column_name].astype("category")
+
+        return frame
+
+    def cleanup(self):
+        """
+        This function removes the spill directory with the spilled chunks.
+        :return:
+        :rtype:
+        """
+        if self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+        self.spill_paths = []
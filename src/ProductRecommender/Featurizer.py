@@ -0,0 +1,341 @@
+"""
+This file creates the vectorizer of the featurize stage.
+tfidf: the exact TfidfVectorizer with a vocabulary dict of all tokens.
+hashing: a HashingVectorizer with a fixed number of features followed by a TfidfTransformer,
+its memory is bounded by n_features and the documents can be vectorized in independent batches.
+fields: one vectorizer per product field, the weighted field vectors are stacked side by side.
+"""
+import logging
+import sys
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from sklearn.feature_extraction.text import CountVectorizer, HashingVectorizer, TfidfTransformer, TfidfVectorizer
+from sklearn.pipeline import Pipeline
+
+logger = logging.getLogger("Featurizer")
+
+FEATURIZER_MODES = ("tfidf", "hashing", "fields")
+FIELD_TYPES = ("text", "categorical")
+
+
+def get_text_values(values: pd.Series) -> np.ndarray:
+    """
+    This function returns the values of a field as strings, missing values become empty strings.
+    :param values:
+    :type values: pd.Series
+    :return:
+    :rtype: np.ndarray
+    """
+    return values.astype(object).fillna("").astype(str).to_numpy()
+
+
+def get_field_values(product_df: pd.DataFrame, column: str) -> pd.Series:
+    """
+    This function returns the values of a field, a missing column has no value for any product.
+    :param product_df:
+    :type product_df: pd.DataFrame
+    :param column:
+    :type column: str
+    :return:
+    :rtype: pd.Series
+    """
+    if column not in product_df.columns:
+        return pd.Series(np.nan, index=product_df.index, dtype=object)
+
+    return product_df[column]
+
+
+def get_field_fingerprints(product_df: pd.DataFrame, fields: List[Dict]) -> np.ndarray:
+    """
+    This function returns a hash of the field values per product. The fields mode compares
+    the fingerprints instead of the concatenated text to find the changed products.
+    :param product_df:
+    :type product_df: pd.DataFrame
+    :param fields:
+    :type fields: List[Dict]
+    :return:
+    :rtype: np.ndarray
+    """
+    field_values = pd.DataFrame({field["column"]: get_text_values(get_field_values(product_df, field["column"]))
+                                 for field in fields})
+    hashes = pd.util.hash_pandas_object(field_values, index=False).to_numpy()
+
+    return np.char.mod("%016x", hashes)
+
+
+def check_field_weight(column: str, weight: float):
+    """
+    This function raises a ValueError for weights that are not positive. The vectors of a field are scaled
+    by the square root of its weight and reweight divides by it, a field without weight has to be removed.
+    :param column:
+    :type column: str
+    :param weight:
+    :type weight: float
+    :return:
+    :rtype:
+    """
+    if not weight > 0:
+        raise ValueError(f"The weight of the field <{column}> is {weight}, "
+                         f"use a positive weight or remove the field.")
+
+
+class FieldVectorizer:
+    """
+    This class vectorizes every field of the products on its own: text fields with their own tfidf vocabulary,
+    categorical fields one-hot from their category codes. Text fields tokenize every distinct value once and
+    gather the token counts per product by the codes of the values, the document frequencies stay exact.
+    Every field vector has unit length and gets scaled by the square root of its weight,
+    so a field adds its weight times its cosine similarity to the dot product.
+    """
+
+    def __init__(self, fields: List[Dict], dtype="float32"):
+        self.fields = [{"column": field["column"],
+                        "type": field.get("type", "text"),
+                        "weight": float(field.get("weight", 1.0))} for field in fields]
+        self.dtype = np.dtype(dtype).type
+        self.field_counters = {}
+        self.field_transformers = {}
+        self.field_categories = {}
+        self.field_sizes = []
+        for field in self.fields:
+            if field["type"] not in FIELD_TYPES:
+                raise ValueError(f"Unknown type <{field['type']}> of the field <{field['column']}>, "
+                                 f"use one of {FIELD_TYPES}.")
+            check_field_weight(field["column"], field["weight"])
+
+    def get_weights(self) -> List[float]:
+        """
+        This function returns the weight per field.
+        :return:
+        :rtype: List[float]
+        """
+        return [field["weight"] for field in self.fields]
+
+    def count_tokens(self, column: str, values: pd.Series, fit: bool) -> sparse.csr_matrix:
+        """
+        This function returns the token counts per product of a text field, every distinct value is tokenized once.
+        :param column:
+        :type column: str
+        :param values:
+        :type values: pd.Series
+        :param fit: Learn the vocabulary of the values.
+        :type fit: bool
+        :return:
+        :rtype: sparse.csr_matrix
+        """
+        codes, unique_values = pd.factorize(get_text_values(values))
+        if fit:
+            self.field_counters[column] = CountVectorizer(dtype=self.dtype)
+            unique_counts = self.field_counters[column].fit_transform(unique_values)
+        else:
+            unique_counts = self.field_counters[column].transform(unique_values)
+
+        return unique_counts[codes]
+
+    def vectorize_field(self, field: Dict, values: pd.Series, fit: bool) -> sparse.csr_matrix:
+        """
+        This function returns the unweighted vectors of a field and learns its vocabulary or categories with fit.
+        :param field:
+        :type field: Dict
+        :param values:
+        :type values: pd.Series
+        :param fit:
+        :type fit: bool
+        :return:
+        :rtype: sparse.csr_matrix
+        """
+        column = field["column"]
+        if field["type"] == "categorical":
+            if fit:
+                self.field_categories[column] = pd.Categorical(values).categories
+            categories = self.field_categories[column]
+            codes = pd.Categorical(values, categories=categories).codes
+            rows = np.flatnonzero(codes >= 0)
+            return sparse.csr_matrix((np.ones(len(rows), dtype=self.dtype), (rows, codes[rows])),
+                                     shape=(len(values), len(categories)))
+
+        if fit:
+            try:
+                counts = self.count_tokens(column, values, fit=True)
+            except ValueError:
+                logger.warning(f"The field <{column}> has no tokens, it gets no features")
+                self.field_counters[column] = None
+                self.field_transformers[column] = None
+                return sparse.csr_matrix((len(values), 0), dtype=self.dtype)
+            self.field_transformers[column] = TfidfTransformer()
+            return self.field_transformers[column].fit_transform(counts)
+
+        if self.field_counters[column] is None:
+            return sparse.csr_matrix((len(values), 0), dtype=self.dtype)
+
+        return self.field_transformers[column].transform(self.count_tokens(column, values, fit=False))
+
+    def vectorize(self, product_df: pd.DataFrame, fit: bool) -> sparse.csr_matrix:
+        """
+        This function stacks the weighted field vectors of the products.
+        :param product_df:
+        :type product_df: pd.DataFrame
+        :param fit:
+        :type fit: bool
+        :return:
+        :rtype: sparse.csr_matrix
+        """
+        blocks = []
+        for field in self.fields:
+            block = self.vectorize_field(field, get_field_values(product_df, field["column"]), fit)
+            blocks.append(block * np.sqrt(field["weight"]).astype(self.dtype))
+        self.field_sizes = [block.shape[1] for block in blocks]
+
+        return sparse.hstack(blocks, format="csr", dtype=self.dtype)
+
+    def fit(self, product_df: pd.DataFrame) -> "FieldVectorizer":
+        """
+        This function learns the vocabularies and categories of all fields.
+        :param product_df:
+        :type product_df: pd.DataFrame
+        :return:
+        :rtype: FieldVectorizer
+        """
+        self.vectorize(product_df, fit=True)
+
+        return self
+
+    def transform(self, product_df: pd.DataFrame) -> sparse.csr_matrix:
+        """
+        This function returns the vectors of the products.
+        :param product_df:
+        :type product_df: pd.DataFrame
+        :return:
+        :rtype: sparse.csr_matrix
+        """
+        return self.vectorize(product_df, fit=False)
+
+    def fit_transform(self, product_df: pd.DataFrame) -> sparse.csr_matrix:
+        """
+        This function fits the fields and returns the vectors of the products.
+        :param product_df:
+        :type product_df: pd.DataFrame
+        :return:
+        :rtype: sparse.csr_matrix
+        """
+        return self.vectorize(product_df, fit=True)
+
+    def reweight(self, vectors: sparse.spmatrix, weights: List[float]) -> sparse.csr_matrix:
+        """
+        This function rescales the field vectors from the current to new weights without tokenizing again
+        and keeps the new weights.
+        :param vectors: Vectors of this vectorizer.
+        :type vectors: sparse.spmatrix
+        :param weights: The new weight per field.
+        :type weights: List[float]
+        :return:
+        :rtype: sparse.csr_matrix
+        """
+        for field, weight in zip(self.fields, weights):
+            check_field_weight(field["column"], weight)
+        factors = np.repeat(np.sqrt(np.asarray(weights, dtype=float) / np.asarray(self.get_weights(), dtype=float)),
+                            self.field_sizes).astype(self.dtype)
+        for field, weight in zip(self.fields, weights):
+            field["weight"] = float(weight)
+
+        return sparse.csr_matrix(vectors @ sparse.diags(factors, format="csr"))
+
+
+def create_vectorizer(mode: str = "tfidf", n_features: int = 2 ** 20, dtype: str = "float64",
+                      fields: List[Dict] = None):
+    """
+    This function creates an unfitted vectorizer of the given mode.
+    :param mode: tfidf, hashing or fields
+    :type mode: str
+    :param n_features: Number of hash buckets of the hashing mode.
+    :type n_features: int
+    :param dtype: float32 or float64
+    :type dtype: str
+    :param fields: The column, type (text or categorical) and weight per field of the fields mode.
+    :type fields: List[Dict]
+    :return: An estimator with fit_transform and transform.
+    :rtype:
+    """
+    dtype = np.dtype(dtype).type
+    if mode == "tfidf":
+        return TfidfVectorizer(dtype=dtype)
+    if mode == "hashing":
+        return Pipeline([("hashing", HashingVectorizer(n_features=n_features, alternate_sign=False, norm=None,
+                                                       dtype=dtype)),
+                         ("tfidf", TfidfTransformer())])
+    if mode == "fields":
+        if not fields:
+            raise ValueError("The fields mode needs the featurizer fields.")
+        return FieldVectorizer(fields, dtype=dtype)
+
+    raise ValueError(f"Unknown featurizer mode <{mode}>, use one of {FEATURIZER_MODES}.")
+
+
+def get_vectorizer_signature(vectorizer) -> Tuple:
+    """
+    This function returns the mode, the number of hash buckets or the fields and the dtype of a vectorizer.
+    Vectors of vectorizers with different signatures can not be mixed.
+    :param vectorizer:
+    :type vectorizer:
+    :return:
+    :rtype: Tuple
+    """
+    if isinstance(vectorizer, Pipeline):
+        hashing_vectorizer = vectorizer.named_steps["hashing"]
+        return "hashing", hashing_vectorizer.n_features, np.dtype(hashing_vectorizer.dtype).name
+    if isinstance(vectorizer, FieldVectorizer):
+        fields = tuple((field["column"], field["type"], field["weight"]) for field in vectorizer.fields)
+        return "fields", fields, np.dtype(vectorizer.dtype).name
+
+    return "tfidf", None, np.dtype(vectorizer.dtype).name
+
+
+def get_config_signature(featurizer_config: Dict) -> Tuple:
+    """
+    This function returns the signature of the vectorizer that the featurizer config creates.
+    :param featurizer_config:
+    :type featurizer_config: Dict
+    :return:
+    :rtype: Tuple
+    """
+    return get_vectorizer_signature(create_vectorizer(**featurizer_config))
+
+
+def get_vectorizer_report(vectorizer, vectors: sparse.spmatrix) -> Dict:
+    """
+    This function returns the vocabulary size and the memory of a fitted vectorizer and its vectors.
+    The vocabulary of the hashing mode are the hash buckets that got at least one token.
+    :param vectorizer:
+    :type vectorizer:
+    :param vectors:
+    :type vectors: sparse.spmatrix
+    :return:
+    :rtype: Dict
+    """
+    mode, n_features, dtype = get_vectorizer_signature(vectorizer)
+    vectors = sparse.csr_matrix(vectors)
+    if mode == "hashing":
+        vocabulary_size = int(np.count_nonzero(np.bincount(vectors.indices, minlength=vectors.shape[1])))
+        vocabulary_bytes = vectorizer.named_steps["tfidf"].idf_.nbytes
+    elif mode == "fields":
+        vocabulary_size = vectors.shape[1]
+        vocabulary_bytes = sum(sys.getsizeof(vocabulary) + sum(sys.getsizeof(token) for token in vocabulary)
+                               for vocabulary in [counter.vocabulary_ for counter
+                                                  in vectorizer.field_counters.values() if counter]
+                               + [categories.tolist() for categories in vectorizer.field_categories.values()])
+    else:
+        vocabulary = vectorizer.vocabulary_
+        vocabulary_size = len(vocabulary)
+        vocabulary_bytes = (sys.getsizeof(vocabulary) + sum(sys.getsizeof(token) for token in vocabulary)
+                            + vectorizer.idf_.nbytes)
+
+    return {"mode": mode,
+            "n_features": vectors.shape[1],
+            "vocabulary_size": vocabulary_size,
+            "vocabulary_mb": vocabulary_bytes / 1024 / 1024,
+            "vectors_mb": (vectors.data.nbytes + vectors.indices.nbytes + vectors.indptr.nbytes) / 1024 / 1024,
+            "nnz": int(vectors.nnz),
+            "dtype": dtype}
@@ -0,0 +1,274 @@
+"""
+This file persists the fitted vectorizer, the document vectors and the neighbours of a run,
+so that the next run only recomputes the products that changed since then.
+"""
+import json
+import logging
+import os
+import shutil
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+import joblib
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from TopKSimilarity import max_similarity_to_rows, top_k_rows
+
+logger = logging.getLogger("IncrementalRecommender")
+
+
+class IncrementalState:
+    """
+    This class saves and loads the state of the last run in a directory.
+    """
+
+    def __init__(self, state_dir):
+        self.state_dir = Path(state_dir)
+
+    def exists(self) -> bool:
+        """
+        This function checks if a complete state was saved.
+        :return:
+        :rtype: bool
+        """
+        return (self.state_dir / "state.json").exists()
+
+    def load(self) -> Optional[Dict]:
+        """
+        This function loads the state of the last run.
+        :return: None if no state exists, otherwise a dict with the keys watermark, raw_products, skus, documents,
+            in_stock, vectorizer, vectors, neighbour_indices and neighbour_scores.
+        :rtype: Optional[Dict]
+        """
+        if not self.exists():
+            logger.info(f"No incremental state found in <{self.state_dir}>")
+            return None
+
+        with open(self.state_dir / "state.json", encoding="utf8") as state_file:
+            state = json.load(state_file)
+        documents = pd.read_pickle(self.state_dir / "documents.pkl")
+        neighbours = np.load(self.state_dir / "neighbours.npz")
+
+        state["raw_products"] = pd.read_pickle(self.state_dir / "raw_products.pkl")
+        state["skus"] = documents["sku"].to_numpy()
+        state["documents"] = documents["document"].to_numpy(dtype=str)
+        # States of older versions only contain in stock products
+        state["in_stock"] = (documents["in_stock"].to_numpy(dtype=bool) if "in_stock" in documents.columns
+                             else np.ones(len(documents), dtype=bool))
+        state["vectorizer"] = joblib.load(self.state_dir / "vectorizer.joblib")
+        state["vectors"] = sparse.load_npz(self.state_dir / "vectors.npz").tocsr()
+        state["neighbour_indices"] = neighbours["indices"]
+        state["neighbour_scores"] = neighbours["scores"]
+
+        return state
+
+    def save(self, watermark: str, raw_products: pd.DataFrame, skus: np.ndarray, documents: np.ndarray,
+             in_stock: np.ndarray, vectorizer, vectors: sparse.spmatrix, neighbour_indices: np.ndarray,
+             neighbour_scores: np.ndarray):
+        """
+        This function saves the state into a temporary directory and replaces the old state afterwards,
+        so a failed run never leaves a mixed state behind.
+        :param watermark: The highest updated_at of all fetched products.
+        :type watermark: str
+        :param raw_products: The raw product frame without qtys.
+        :type raw_products: pd.DataFrame
+        :param skus: The sku per row of the vectors.
+        :type skus: np.ndarray
+        :param documents: The vectorized text per row.
+        :type documents: np.ndarray
+        :param in_stock: The stock mask per row that filtered the published recommendations.
+        :type in_stock: np.ndarray
+        :param vectorizer: The fitted vectorizer.
+        :type vectorizer:
+        :param vectors:
+        :type vectors: sparse.spmatrix
+        :param neighbour_indices:
+        :type neighbour_indices: np.ndarray
+        :param neighbour_scores:
+        :type neighbour_scores: np.ndarray
+        :return:
+        :rtype:
+        """
+        tmp_dir = self.state_dir.with_name(self.state_dir.name + "_tmp")
+        old_dir = self.state_dir.with_name(self.state_dir.name + "_old")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        tmp_dir.mkdir(parents=True)
+
+        raw_products.to_pickle(tmp_dir / "raw_products.pkl")
+        pd.DataFrame({"sku": skus, "document": documents, "in_stock": in_stock}).to_pickle(tmp_dir / "documents.pkl")
+        joblib.dump(vectorizer, tmp_dir / "vectorizer.joblib")
+        sparse.save_npz(tmp_dir / "vectors.npz", sparse.csr_matrix(vectors))
+        np.savez(tmp_dir / "neighbours.npz", indices=neighbour_indices, scores=neighbour_scores)
+        with open(tmp_dir / "state.json", "w", encoding="utf8") as state_file:
+            json.dump({"watermark": watermark}, state_file)
+
+        shutil.rmtree(old_dir, ignore_errors=True)
+        if self.state_dir.exists():
+            self.state_dir.rename(old_dir)
+        tmp_dir.rename(self.state_dir)
+        shutil.rmtree(old_dir, ignore_errors=True)
+        logger.info(f"Saved incremental state with watermark <{watermark}> to <{self.state_dir}>")
+
+    def save_in_stock(self, in_stock: np.ndarray):
+        """
+        This function replaces the stock mask of the saved state after a stock refresh.
+        :param in_stock:
+        :type in_stock: np.ndarray
+        :return:
+        :rtype:
+        """
+        documents = pd.read_pickle(self.state_dir / "documents.pkl")
+        documents["in_stock"] = in_stock
+        tmp_path = self.state_dir / f"documents.pkl.{os.getpid()}.tmp"
+        documents.to_pickle(tmp_path)
+        os.replace(tmp_path, self.state_dir / "documents.pkl")
+        logger.info(f"Saved the stock of {int(np.count_nonzero(in_stock))} in stock products to <{self.state_dir}>")
+
+
+def get_watermark(raw_products: pd.DataFrame, previous_watermark: str = None) -> Optional[str]:
+    """
+    This function returns the highest updated_at of the products or the previous watermark if it is higher.
+    :param raw_products:
+    :type raw_products: pd.DataFrame
+    :param previous_watermark:
+    :type previous_watermark: str
+    :return:
+    :rtype: Optional[str]
+    """
+    updated_ats = [] if "updated_at" not in raw_products else raw_products["updated_at"].dropna().tolist()
+    if previous_watermark:
+        updated_ats.append(previous_watermark)
+
+    return max(updated_ats) if updated_ats else None
+
+
+def merge_changed_products(previous_raw: pd.DataFrame, changed_raw: pd.DataFrame) -> pd.DataFrame:
+    """
+    This function replaces the previous rows of changed products in place and appends new products.
+    Products that got deleted in Magento are not detected, a full run removes them.
+    :param previous_raw: The raw product frame of the last run without qtys.
+    :type previous_raw: pd.DataFrame
+    :param changed_raw: The raw product frame of the changed products without qtys.
+    :type changed_raw: pd.DataFrame
+    :return:
+    :rtype: pd.DataFrame
+    """
+    if changed_raw.empty:
+        return previous_raw
+
+    id_order = pd.concat([previous_raw["id"], changed_raw["id"]]).drop_duplicates(keep="first")
+    unchanged_raw = previous_raw[~previous_raw["id"].isin(changed_raw["id"])]
+    merged_raw = (pd.concat([unchanged_raw, changed_raw], ignore_index=True, sort=False)
+                  .drop_duplicates(subset="id", keep="last")
+                  .set_index("id")
+                  .loc[id_order]
+                  .reset_index())
+
+    for column_name, dtype in previous_raw.dtypes.items():
+        if isinstance(dtype, pd.CategoricalDtype):
+            merged_raw[column_name] = merged_raw[column_name].astype("category")
+
+    return merged_raw
+
+
+def update_vectors(state: Dict, skus: np.ndarray, documents: np.ndarray,
+                   vectorizer_inputs=None) -> Tuple[sparse.csr_matrix, np.ndarray, np.ndarray]:
+    """
+    This function reuses the vectors of the last run and vectorizes only new products and products
+    with a changed text with the persisted vectorizer.
+    :param state: The output of IncrementalState.load.
+    :type state: Dict
+    :param skus: The sku per current product.
+    :type skus: np.ndarray
+    :param documents: The text or field fingerprint per current product, that detects the changed products.
+    :type documents: np.ndarray
+    :param vectorizer_inputs: The input of the vectorizer per current product if it is not the documents,
+        e.g. the product frame of the fields featurizer.
+    :type vectorizer_inputs: pd.DataFrame
+    :return: The vectors, the previous row per current row (-1 for new products) and the changed row ids.
+    :rtype: Tuple[sparse.csr_matrix, np.ndarray, np.ndarray]
+    """
+    old_positions = pd.Series(np.arange(len(state["skus"])), index=state["skus"])
+    old_positions = old_positions[~old_positions.index.duplicated()]
+    new_to_old = old_positions.reindex(skus).fillna(-1).to_numpy(dtype=np.int64)
+
+    known = new_to_old >= 0
+    unchanged = known.copy()
+    unchanged[known] = state["documents"][new_to_old[known]] == documents[known]
+    changed_rows = np.flatnonzero(~unchanged)
+    unchanged_rows = np.flatnonzero(unchanged)
+
+    if len(changed_rows) == 0:
+        return state["vectors"][new_to_old], new_to_old, changed_rows
+
+    if vectorizer_inputs is None:
+        changed_inputs = documents[changed_rows]
+    else:
+        changed_inputs = vectorizer_inputs.iloc[changed_rows]
+    stacked_vectors = sparse.vstack([state["vectors"][new_to_old[unchanged_rows]],
+                                     state["vectorizer"].transform(changed_inputs)]).tocsr()
+    vectors = stacked_vectors[np.argsort(np.concatenate([unchanged_rows, changed_rows]))]
+
+    return vectors, new_to_old, changed_rows
+
+
+def update_neighbours(state: Dict, vectors: sparse.csr_matrix, new_to_old: np.ndarray, changed_rows: np.ndarray,
+                      k: int, block_size: int = 256,
+                      max_block_mb: float = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    This function updates the neighbours of the last run to the current products.
+    The neighbours are recomputed for the changed products and for all products whose neighbours changed
+    or got removed or which are more similar to a changed product than to their current k-th neighbour.
+    :param state: The output of IncrementalState.load.
+    :type state: Dict
+    :param vectors: The vectors of the current products.
+    :type vectors: sparse.csr_matrix
+    :param new_to_old: The previous row per current row, -1 for new products.
+    :type new_to_old: np.ndarray
+    :param changed_rows: The rows with a new or changed text.
+    :type changed_rows: np.ndarray
+    :param k:
+    :type k: int
+    :param block_size:
+    :type block_size: int
+    :param max_block_mb:
+    :type max_block_mb: float
+    :return: The neighbour indices and scores of all products and the recomputed row ids.
+    :rtype: Tuple[np.ndarray, np.ndarray, np.ndarray]
+    """
+    n_rows = vectors.shape[0]
+    k = max(0, min(k, n_rows - 1))
+    old_indices = state["neighbour_indices"]
+    if old_indices.shape[1] != k:
+        logger.info("The number of neighbours changed, recomputing all rows")
+        neighbour_indices, neighbour_scores = top_k_rows(vectors, np.arange(n_rows), k, block_size, max_block_mb)
+        return neighbour_indices, neighbour_scores, np.arange(n_rows)
+
+    known = new_to_old >= 0
+    is_changed = np.zeros(n_rows, dtype=bool)
+    is_changed[changed_rows] = True
+    unchanged_rows = np.flatnonzero(~is_changed)
+
+    old_to_new = np.full(len(state["skus"]) + 1, -1, dtype=np.int64)
+    old_to_new[new_to_old[known]] = np.flatnonzero(known)
+    neighbour_indices = np.full((n_rows, k), -1, dtype=np.int32)
+    neighbour_scores = np.zeros((n_rows, k), dtype=np.float32)
+    neighbour_indices[unchanged_rows] = old_to_new[old_indices[new_to_old[unchanged_rows]]]
+    neighbour_scores[unchanged_rows] = state["neighbour_scores"][new_to_old[unchanged_rows]]
+
+    lost_neighbour = (neighbour_indices[unchanged_rows] < 0).any(axis=1)
+    changed_neighbour = is_changed[neighbour_indices[unchanged_rows]].any(axis=1)
+    affected = lost_neighbour | changed_neighbour
+    if k > 0 and len(changed_rows) > 0:
+        max_changed_scores = max_similarity_to_rows(vectors, changed_rows, block_size, max_block_mb)
+        affected |= max_changed_scores[unchanged_rows] > neighbour_scores[unchanged_rows, -1]
+
+    recompute_rows = np.union1d(changed_rows, unchanged_rows[affected])
+    logger.info(f"{len(changed_rows)} changed products, recomputing {len(recompute_rows)} of {n_rows} rows")
+    if len(recompute_rows) > 0:
+        neighbour_indices[recompute_rows], neighbour_scores[recompute_rows] = top_k_rows(
+            vectors, recompute_rows, k, block_size, max_block_mb)
+
+    return neighbour_indices, neighbour_scores, recompute_rows
@@ -1,35 +1,54 @@
 """
 This file contains the MagentoAttributeHandler
 """
-import requests
+from typing import Dict
+
+from AsyncMagentoClient import AsyncMagentoClient
 from MagentoConnectionHandler import MagentoConnectionHandler
 
+ATTRIBUTES_ENDPOINT = r"/rest/all/V1/products/attributes"
+CATEGORIES_ENDPOINT = r"/rest/all/V1/categories"
+
 
 class MagentoAttributeHandler(MagentoConnectionHandler):
     """
     This class handles the Magento Attributes.
     """
 
-    def __init__(self):
-        super(MagentoAttributeHandler, self).__init__("MagentoConnectionConf.yaml")
+    def __init__(self, connection_settings: Dict = None, connection: MagentoConnectionHandler = None,
+                 store_code: str = None):
+        super(MagentoAttributeHandler, self).__init__("MagentoConnectionConf.yaml", connection_settings, connection,
+                                                      store_code)
+        self.attributes = None
+        self.category_id_names = None
 
     def get_attributes(self):
         """
         This function returns the attributes of Magento.
+        The attributes are fetched once per handler and reused by all later calls.
         :return:
         :rtype:
         """
-        endpoint = r"/rest/all/V1/products/attributes"
-        params = {"searchCriteria[currentPage]": "0"}
-        get_response = requests.get(url=self.base_url + endpoint,
-                                    auth=self.magento_auth,
-                                    params=params
-                                    )
+        if self.attributes is None:
+            params = {"searchCriteria[currentPage]": "0"}
+            self.attributes = self.get_cached_json(self.get_store_endpoint(ATTRIBUTES_ENDPOINT), params)
 
-        get_response.raise_for_status()
-        attributes = get_response.json()
+        return self.attributes
 
-        return attributes
+    async def get_attributes_async(self, client: AsyncMagentoClient):
+        """
+        This function is the asyncio version of get_attributes.
+        :param client:
+        :type client: AsyncMagentoClient
+        :return:
+        :rtype:
+        """
+        if self.attributes is None:
+            params = {"searchCriteria[currentPage]": "0"}
+            self.attributes = await self.get_cached_json_async(client, self.get_store_endpoint(ATTRIBUTES_ENDPOINT),
+                                                               params)
+
+        return self.attributes
 
     def get_attribute_ids_and_values(self):
         """
@@ -81,16 +100,36 @@ class MagentoAttributeHandler(MagentoConnectionHandler):
         :return:
         :rtype:
         """
-        endpoint = r"/rest/all/V1/categories"
-        params = {"searchCriteria[currentPage]": "0"}
-        get_response = requests.get(url=self.base_url + endpoint,
-                                    auth=self.magento_auth,
-                                    params=params
-                                    )
+        if self.category_id_names is None:
+            params = {"searchCriteria[currentPage]": "0"}
+            self.category_id_names = self.parse_category_id_and_names(
+                self.get_cached_json(self.get_store_endpoint(CATEGORIES_ENDPOINT), params))
 
-        get_response.raise_for_status()
-        category_names = get_response.json()
+        return self.category_id_names
 
+    async def get_category_id_and_names_async(self, client: AsyncMagentoClient):
+        """
+        This function is the asyncio version of get_category_id_and_names.
+        :param client:
+        :type client: AsyncMagentoClient
+        :return:
+        :rtype:
+        """
+        if self.category_id_names is None:
+            params = {"searchCriteria[currentPage]": "0"}
+            self.category_id_names = self.parse_category_id_and_names(
+                await self.get_cached_json_async(client, self.get_store_endpoint(CATEGORIES_ENDPOINT), params))
+
+        return self.category_id_names
+
+    def parse_category_id_and_names(self, category_names):
+        """
+        This function returns a dict with category ids as keys and the names as values of the category tree.
+        :param category_names: The response of the categories endpoint.
+        :type category_names:
+        :return:
+        :rtype:
+        """
         id_name_pair = {}
         for elem in category_names["children_data"]:
             if len(elem) > 0:
@@ -2,8 +2,24 @@
 This file contains the MagentoConnectionHandler
 """
 
+import logging
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from AsyncMagentoClient import AsyncMagentoClient
 from MagentoAauthorization import Authorizator
-from util import get_config_file
+from MagentoResponseCache import MagentoResponseCache
+from RunMetrics import run_metrics
+from util import get_config_file, get_root
+
+logger = logging.getLogger("MagentoConnectionHandler")
+
+# The endpoints are written for all store views, a handler of a store view replaces the store code
+ALL_STORES_PREFIX = "/rest/all/"
 
 
 class MagentoConnectionHandler:
@@ -11,10 +27,36 @@ class MagentoConnectionHandler:
     This function handles the Magento2 connection.
     """
 
-    def __init__(self, path_to_conf):
-        self.magento_conn_settings = get_config_file(path_to_conf)
+    def __init__(self, path_to_conf, connection_settings: Dict = None,
+                 connection: "MagentoConnectionHandler" = None, store_code: str = None):
+        # A handler whose settings, authorization, session and cache are reused instead of loading the config again
+        if connection is not None:
+            self.magento_conn_settings = connection.magento_conn_settings
+            self.magento_auth = connection.magento_auth
+        else:
+            self.magento_conn_settings = get_config_file(path_to_conf)
+            # Overrides of the config file, e.g. the base_url of a local stub server
+            self.magento_conn_settings.update(connection_settings or {})
+            self.magento_auth = self.get_connection_to_magento()
         self.base_url = self.magento_conn_settings["base_url"]
-        self.magento_auth = self.get_connection_to_magento()
+        self.store_code = store_code or self.magento_conn_settings.get("store_code", "all")
+        self.max_workers = self.magento_conn_settings.get("max_workers", 4)
+        self.timeout = self.magento_conn_settings.get("timeout", 60)
+        self.session = connection.session if connection is not None else self.get_session()
+        self.response_cache = connection.response_cache if connection is not None else self.get_response_cache()
+
+    def get_store_endpoint(self, endpoint: str) -> str:
+        """
+        This function returns the endpoint in the store view of this handler, e.g. /rest/de/V1/products.
+        :param endpoint: An endpoint of all store views, e.g. /rest/all/V1/products.
+        :type endpoint: str
+        :return:
+        :rtype: str
+        """
+        if not endpoint.startswith(ALL_STORES_PREFIX):
+            return endpoint
+
+        return f"/rest/{self.store_code}/" + endpoint[len(ALL_STORES_PREFIX):]
 
     def get_connection_to_magento(self):
         """
@@ -35,3 +77,178 @@ class MagentoConnectionHandler:
         magento_authorizator = magento_authorizator_object.get_authorization_object()
 
         return magento_authorizator
+
+    def get_session(self) -> requests.Session:
+        """
+        This function returns a pooled session that carries the Magento authorization
+        and retries failed GET requests with an exponential backoff.
+        :return:
+        :rtype: requests.Session
+        """
+        retries = Retry(total=self.magento_conn_settings.get("max_retries", 5),
+                        backoff_factor=self.magento_conn_settings.get("backoff_factor", 0.5),
+                        status_forcelist=(429, 500, 502, 503, 504),
+                        allowed_methods=frozenset(["GET"]))
+        adapter = HTTPAdapter(pool_maxsize=self.max_workers, max_retries=retries)
+
+        session = requests.Session()
+        session.auth = self.magento_auth
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.hooks["response"].append(self.record_response)
+
+        return session
+
+    @staticmethod
+    def record_response(response: requests.Response, *args, **kwargs):
+        """
+        This function counts the request and the response bytes per endpoint in the run metrics.
+        :param response:
+        :type response: requests.Response
+        :return:
+        :rtype:
+        """
+        run_metrics.record_http(urlparse(response.url).path,
+                                len(response.content),
+                                response.status_code,
+                                response.elapsed.total_seconds())
+
+    def get_response_cache(self) -> Optional[MagentoResponseCache]:
+        """
+        This function returns the on-disk response cache if a cache_dir is configured.
+        Relative directories are resolved against the package root.
+        :return:
+        :rtype: Optional[MagentoResponseCache]
+        """
+        cache_dir = self.magento_conn_settings.get("cache_dir")
+        if not cache_dir:
+            return None
+
+        return MagentoResponseCache(cache_dir=get_root() / cache_dir,
+                                    base_url=self.base_url,
+                                    ttl=self.magento_conn_settings.get("cache_ttl", 86400))
+
+    def get_async_client(self) -> AsyncMagentoClient:
+        """
+        This function returns a new async client with the settings and the authorization of this handler.
+        :return:
+        :rtype: AsyncMagentoClient
+        """
+        return AsyncMagentoClient(self.base_url,
+                                  self.magento_auth,
+                                  max_connections_per_host=self.magento_conn_settings.get("max_connections_per_host",
+                                                                                          8),
+                                  timeout=self.timeout,
+                                  max_retries=self.magento_conn_settings.get("max_retries", 5),
+                                  backoff_factor=self.magento_conn_settings.get("backoff_factor", 0.5))
+
+    def load_cache_entry(self, endpoint: str, params: Dict) -> Tuple[Optional[Dict], Dict]:
+        """
+        This function returns the cached response of an endpoint and the headers that revalidate it.
+        :param endpoint:
+        :type endpoint: str
+        :param params:
+        :type params: Dict
+        :return: The cache entry or None and the ETag/If-Modified-Since headers.
+        :rtype: Tuple[Optional[Dict], Dict]
+        """
+        entry = None
+        headers = {}
+        if self.response_cache is not None:
+            entry = self.response_cache.load(endpoint, params)
+            if entry is not None and entry["etag"]:
+                headers["If-None-Match"] = entry["etag"]
+            if entry is not None and entry["last_modified"]:
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        return entry, headers
+
+    def is_cache_hit(self, endpoint: str, entry: Optional[Dict]) -> bool:
+        """
+        This function returns if a cache entry is fresh and can be used without a request.
+        :param endpoint:
+        :type endpoint: str
+        :param entry:
+        :type entry: Optional[Dict]
+        :return:
+        :rtype: bool
+        """
+        if entry is None or not self.response_cache.is_fresh(entry):
+            return False
+
+        logger.info(f"Using cached response of <{endpoint}>")
+        run_metrics.record_http_cache_hit(endpoint)
+        return True
+
+    def get_response_body(self, endpoint: str, params: Dict, entry: Optional[Dict], response):
+        """
+        This function returns the json body of a response, a 304 response returns the cached body.
+        The body is stored in the cache if configured.
+        :param endpoint:
+        :type endpoint: str
+        :param params:
+        :type params: Dict
+        :param entry: The cache entry that got revalidated.
+        :type entry: Optional[Dict]
+        :param response: A requests or httpx response.
+        :type response:
+        :return:
+        :rtype:
+        """
+        if response.status_code == 304 and entry is not None:
+            logger.info(f"Cached response of <{endpoint}> is still valid")
+            body = entry["body"]
+        else:
+            response.raise_for_status()
+            body = response.json()
+
+        if self.response_cache is not None:
+            self.response_cache.store(endpoint, params, body,
+                                      etag=response.headers.get("ETag", entry and entry["etag"]),
+                                      last_modified=response.headers.get("Last-Modified",
+                                                                         entry and entry["last_modified"]))
+
+        return body
+
+    def get_cached_json(self, endpoint: str, params: Dict):
+        """
+        This function returns the json response of an endpoint and uses the on-disk cache if configured.
+        Fresh entries are returned without a request, stale ones are revalidated with ETag/If-Modified-Since.
+        :param endpoint:
+        :type endpoint: str
+        :param params:
+        :type params: Dict
+        :return:
+        :rtype:
+        """
+        entry, headers = self.load_cache_entry(endpoint, params)
+        if self.is_cache_hit(endpoint, entry):
+            return entry["body"]
+
+        get_response = self.session.get(url=self.base_url + endpoint,
+                                        params=params,
+                                        headers=headers,
+                                        timeout=self.timeout
+                                        )
+
+        return self.get_response_body(endpoint, params, entry, get_response)
+
+    async def get_cached_json_async(self, client: AsyncMagentoClient, endpoint: str, params: Dict):
+        """
+        This function is the asyncio version of get_cached_json.
+        :param client:
+        :type client: AsyncMagentoClient
+        :param endpoint:
+        :type endpoint: str
+        :param params:
+        :type params: Dict
+        :return:
+        :rtype:
+        """
+        entry, headers = self.load_cache_entry(endpoint, params)
+        if self.is_cache_hit(endpoint, entry):
+            return entry["body"]
+
+        get_response = await client.get(endpoint, params=params, headers=headers)
+
+        return self.get_response_body(endpoint, params, entry, get_response)
@@ -1,14 +1,122 @@
 """
 This file is for handling the Magento2 Items and get the releveant informations
 """
+import asyncio
+import logging
+import math
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Tuple
 
-from typing import List, Dict
-
+import numpy as np
 import pandas as pd
-import requests
+from AsyncMagentoClient import AsyncMagentoClient
+from CandidateFilter import CATEGORY_COLUMN
+from ColumnarFrameBuilder import ColumnarFrameBuilder
 from MagentoAttributeHandler import MagentoAttributeHandler
 from MagentoConnectionHandler import MagentoConnectionHandler
-from util import get_config_file
+from ProductPreprocessing import TEXT_COLUMNS, add_text_columns
+from util import get_config_file, get_root
+
+logger = logging.getLogger("MagentoItemHandler")
+
+# The fields of every product that are kept even if keep_columns is set
+PRODUCT_FIELDS = ("id", "sku", "name", "price", "status", "type_id", "weight", "updated_at")
+
+PRODUCTS_ENDPOINT = "/rest/all/V1/products"
+LOW_STOCK_ENDPOINT = "/rest/all/V1/stockItems/lowStock"
+
+# The product fields that a handler of scope columns requests, the text attributes are custom attributes
+SCOPE_PRODUCT_FIELDS = "items[id,name,custom_attributes],total_count"
+
+# The columns of the streamed product frame that stay strings, the documents are concatenated from them
+FRAME_TEXT_COLUMNS = ("name", "imp_text") + TEXT_COLUMNS
+
+# The attribute types whose values are comma separated option ids
+OPTION_ATTRIBUTE_TYPES = ("select", "multiselect")
+
+
+def join_ids(values: pd.Series) -> pd.Series:
+    """
+    This function converts lists of ids to comma separated ids, the other values are converted to str.
+    :param values: Values without missing values.
+    :type values: pd.Series
+    :return:
+    :rtype: pd.Series
+    """
+    if pd.api.types.infer_dtype(values, skipna=False) == "string":
+        return values
+
+    is_list = values.map(lambda value: isinstance(value, (list, tuple))).to_numpy(dtype=bool)
+    joined = values.astype(str)
+    if is_list.any():
+        joined[is_list] = values[is_list].map(lambda ids: ",".join(map(str, ids)))
+
+    return joined
+
+
+def split_ids(values: pd.Series) -> pd.Series:
+    """
+    This function returns one row per id of comma separated ids, indexed by the row of the value.
+    :param values:
+    :type values: pd.Series
+    :return:
+    :rtype: pd.Series
+    """
+    return values.str.split(",").explode()
+
+
+def join_by_row(values: pd.Series, index: pd.Index) -> pd.Series:
+    """
+    This function joins the values per row of the index with commas, rows without values get an empty string.
+    :param values: The values indexed by their row.
+    :type values: pd.Series
+    :param index:
+    :type index: pd.Index
+    :return:
+    :rtype: pd.Series
+    """
+    joined = pd.Series("", index=index, dtype=object)
+    if len(values):
+        # explode keeps the values of a row together, so every run of equal row labels is one row
+        rows = values.index.to_numpy()
+        starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+        items = values.tolist()
+        joined.loc[rows[starts]] = [",".join(items[start:end])
+                                    for start, end in zip(starts.tolist(), starts[1:].tolist() + [len(items)])]
+
+    return joined
+
+
+def resolve_labels(values: pd.Series, labels: Dict[str, str] = None, column: str = None) -> pd.Series:
+    """
+    This function replaces the comma separated ids of every value with the comma separated labels of the ids.
+    Missing values stay missing and unknown ids are skipped. Every distinct value is only resolved once.
+    :param values: Comma separated ids or lists of ids.
+    :type values: pd.Series
+    :param labels: The label per id, without labels the ids are joined.
+    :type labels: Dict[str, str]
+    :param column: The name of the values in the warning about unknown ids.
+    :type column: str
+    :return:
+    :rtype: pd.Series
+    """
+    present = values.notna().to_numpy(dtype=bool)
+    codes, distinct_values = pd.factorize(join_ids(values[present]))
+    ids = split_ids(pd.Series(distinct_values, dtype=object))
+    if labels is None:
+        resolved = ids
+    else:
+        resolved = ids.map(labels)
+    unknown = resolved.isna() & (ids != "")
+    if unknown.any():
+        logger.warning(f"{ids[unknown].nunique()} ids of <{column}> have no label, e.g. {ids[unknown].iloc[0]}")
+
+    result = pd.Series(np.nan, index=values.index, dtype=object)
+    result[present] = join_by_row(resolved.dropna(), pd.RangeIndex(len(distinct_values))).to_numpy()[codes]
+
+    return result
 
 
 class MagentoItemHandler(MagentoConnectionHandler):
@@ -17,11 +125,22 @@ class MagentoItemHandler(MagentoConnectionHandler):
 
     """
 
-    def __init__(self):
-        super(MagentoItemHandler, self).__init__("MagentoConnectionConf.yaml")
-        self.magento_attribute_handler = MagentoAttributeHandler()
-        self.attribute_id_value = self.magento_attribute_handler.get_attribute_ids_and_values()
+    def __init__(self, connection_settings: Dict = None, connection: MagentoConnectionHandler = None,
+                 store_code: str = None, scope_columns: Iterable[str] = None):
+        super(MagentoItemHandler, self).__init__("MagentoConnectionConf.yaml", connection_settings, connection,
+                                                 store_code)
+        self.magento_attribute_handler = MagentoAttributeHandler(connection=self, store_code=self.store_code)
+        # Only the id and these columns are requested and kept, e.g. the text attributes of a store view
+        self.scope_columns = set(scope_columns) if scope_columns else None
+        self.attribute_id_value = None
+        self.async_client = self.magento_conn_settings.get("async_client", True)
         self.attribute_conf_file = get_config_file("MagentoAttributeConf.yaml")
+        self.page_size = self.magento_conn_settings.get("page_size", 500)
+        product_frame_conf = get_config_file("RecommenderConf.yaml").get("product_frame", {})
+        self.categorical_columns = product_frame_conf.get("categorical_columns", [])
+        self.chunk_rows = product_frame_conf.get("chunk_rows")
+        self.spill_dir = product_frame_conf.get("spill_dir")
+        self.keep_columns = product_frame_conf.get("keep_columns")
 
     def get_products(self) -> List[Dict]:
         """
@@ -30,18 +149,126 @@ class MagentoItemHandler(MagentoConnectionHandler):
 
         """
 
-        full_endpoint = self.base_url + "/rest/all/V1/products"
+        return list(self.iter_products())
+
+    def get_attribute_id_value(self) -> Dict:
+        """
+        This function returns the labels per value id of the select attributes, they are fetched on first use.
+        :return:
+        :rtype: Dict
+        """
+        if self.attribute_id_value is None:
+            self.attribute_id_value = self.magento_attribute_handler.get_attribute_ids_and_values()
+
+        return self.attribute_id_value
+
+    @staticmethod
+    def get_product_page_params(current_page: int, page_size: int, updated_since: str = None,
+                                fields: str = None) -> Dict:
+        """
+        This function returns the params of one page of the products endpoint.
+        :param current_page: The page number, starting with 1.
+        :type current_page: int
+        :param page_size:
+        :type page_size: int
+        :param updated_since: Only return products with a newer updated_at, format "YYYY-MM-DD HH:MM:SS".
+        :type updated_since: str
+        :param fields: Only return these fields, e.g. items[id,name],total_count.
+        :type fields: str
+        :return:
+        :rtype: Dict
+        """
+        params = {"searchCriteria[currentPage]": current_page,
+                  "searchCriteria[pageSize]": page_size}
+        if updated_since:
+            params["searchCriteria[filter_groups][0][filters][0][field]"] = "updated_at"
+            params["searchCriteria[filter_groups][0][filters][0][value]"] = updated_since
+            params["searchCriteria[filter_groups][0][filters][0][condition_type]"] = "gt"
+        if fields:
+            params["fields"] = fields
+
+        return params
 
-        params = {"searchCriteria[currentPage]": "0"}
-        get_resp = requests.get(url=full_endpoint,
-                                auth=self.magento_auth,
-                                params=params
-                                )
+    def get_page_fields(self) -> str:
+        """
+        This function returns the product fields that are requested, all fields without scope columns.
+        :return:
+        :rtype: str
+        """
+        return SCOPE_PRODUCT_FIELDS if self.scope_columns else None
+
+    def get_product_page(self, current_page: int, page_size: int, updated_since: str = None) -> Dict:
+        """
+        This function returns one page of the products endpoint.
+        :param current_page: The page number, starting with 1.
+        :type current_page: int
+        :param page_size:
+        :type page_size: int
+        :param updated_since: Only return products with a newer updated_at, format "YYYY-MM-DD HH:MM:SS".
+        :type updated_since: str
+        :return: The response with the keys items and total_count.
+        :rtype: Dict
+        """
+        get_resp = self.session.get(url=self.base_url + self.get_store_endpoint(PRODUCTS_ENDPOINT),
+                                    params=self.get_product_page_params(current_page, page_size, updated_since,
+                                                                        self.get_page_fields()),
+                                    timeout=self.timeout
+                                    )
 
         get_resp.raise_for_status()
-        product_items = get_resp.json()["items"]
 
-        return product_items
+        return get_resp.json()
+
+    async def get_product_page_async(self, client: AsyncMagentoClient, current_page: int, page_size: int,
+                                     updated_since: str = None) -> Dict:
+        """
+        This function is the asyncio version of get_product_page.
+        :param client:
+        :type client: AsyncMagentoClient
+        :param current_page:
+        :type current_page: int
+        :param page_size:
+        :type page_size: int
+        :param updated_since:
+        :type updated_since: str
+        :return:
+        :rtype: Dict
+        """
+        return await client.get_json(self.get_store_endpoint(PRODUCTS_ENDPOINT),
+                                     self.get_product_page_params(current_page, page_size, updated_since,
+                                                                  self.get_page_fields()))
+
+    def iter_products(self, page_size: int = None, max_workers: int = None,
+                      updated_since: str = None) -> Iterator[Dict]:
+        """
+        This function yields the product items page by page.
+        The first page returns the total count, the remaining pages get fetched in parallel
+        while at most max_workers pages are requested or waiting to be consumed.
+        :param page_size:
+        :type page_size: int
+        :param max_workers:
+        :type max_workers: int
+        :param updated_since: Only yield products with a newer updated_at.
+        :type updated_since: str
+        :return:
+        :rtype: Iterator[Dict]
+        """
+        page_size = page_size or self.page_size
+        max_workers = max_workers or self.max_workers
+
+        first_page = self.get_product_page(1, page_size, updated_since)
+        n_pages = math.ceil(first_page["total_count"] / page_size)
+        yield from first_page["items"]
+
+        next_pages = iter(range(2, n_pages + 1))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending_pages = deque(executor.submit(self.get_product_page, page, page_size, updated_since)
+                                  for page in islice(next_pages, max_workers))
+            while pending_pages:
+                product_page = pending_pages.popleft().result()
+                for page in islice(next_pages, 1):
+                    pending_pages.append(executor.submit(self.get_product_page, page, page_size, updated_since))
+                yield from product_page["items"]
 
     def get_product_attribute_frame(self):
         """
@@ -49,48 +276,181 @@ class MagentoItemHandler(MagentoConnectionHandler):
         :return:
         :rtype:
         """
-        magento_products = self.get_products()
+        return self.add_qtys(*self.get_product_frame_and_qtys())
 
-        products_list = []
-        product_dict = {}
-        attribute_code_type_dict = self.magento_attribute_handler.get_attribute_types()
-        attribute_id_value_dict = self.magento_attribute_handler.get_attribute_ids_and_values()
-        category_id_names = self.magento_attribute_handler.get_category_id_and_names()
+    def get_product_frame_builder(self) -> ColumnarFrameBuilder:
+        """
+        This function returns the builder of the product frame. With chunk_rows configured the products
+        are streamed: every chunk gets its text columns and is spilled to Parquet.
+        A handler with scope columns only keeps the id and the scope columns.
+        The rows keep the option and category ids, every chunk resolves them to labels before it gets transformed.
+        :return:
+        :rtype: ColumnarFrameBuilder
+        """
+        keep_columns = None
+        if self.scope_columns:
+            # The category names are resolved from the category ids
+            keep_columns = {"id", CATEGORY_COLUMN} | self.scope_columns
+        elif self.keep_columns:
+            keep_columns = set(self.keep_columns) | set(PRODUCT_FIELDS) | set(TEXT_COLUMNS) | {CATEGORY_COLUMN}
+        if not self.chunk_rows:
+            return ColumnarFrameBuilder(keep_columns=keep_columns, chunk_transform=self.resolve_attribute_labels)
+
+        return ColumnarFrameBuilder(chunk_rows=self.chunk_rows,
+                                    spill_dir=get_root() / self.spill_dir if self.spill_dir else None,
+                                    keep_columns=keep_columns,
+                                    chunk_transform=lambda chunk: add_text_columns(
+                                        self.resolve_attribute_labels(chunk)),
+                                    text_columns=FRAME_TEXT_COLUMNS)
+
+    def get_product_frame(self, updated_since: str = None) -> pd.DataFrame:
+        """
+        This function returns the products with all corresponding attribute values but without the qtys.
+        The pages are decoded one at a time and their rows appended to the product frame builder.
+        :param updated_since: Only return products with a newer updated_at.
+        :type updated_since: str
+        :return:
+        :rtype: pd.DataFrame
+        """
+        products_builder = self.get_product_frame_builder()
+        self.append_products(products_builder, self.iter_products(updated_since=updated_since))
+
+        return products_builder.build(categorical_columns=self.categorical_columns)
+
+    def append_products(self, products_builder: ColumnarFrameBuilder, magento_products: Iterable[Dict]):
+        """
+        This function appends one row with the raw attribute values per product item to the product frame builder.
+        The option and category ids are resolved per chunk by resolve_attribute_labels.
+        :param products_builder:
+        :type products_builder: ColumnarFrameBuilder
+        :param magento_products: Items of the products endpoint.
+        :type magento_products: Iterable[Dict]
+        :return:
+        :rtype:
+        """
         for item in magento_products:
-            product_dict["id"] = item["id"]
-            product_dict["sku"] = item["sku"]
-            product_dict["name"] = item["name"]
-            product_dict["price"] = item["price"]
-            product_dict["status"] = item["status"]
-            product_dict["type_id"] = item["type_id"]
-            product_dict["weight"] = item.get("weight", None)
-
-            attribute_types_to_convert_ids = ["select", "multiselect"]
-            for custom_attribute in item["custom_attributes"]:
-                attribute_code = custom_attribute['attribute_code']
-                attribute_value_identifier = custom_attribute["value"]
-                if attribute_code_type_dict[attribute_code] in attribute_types_to_convert_ids:
-                    attribute_value_identifier = attribute_value_identifier.split(
-                        ",") if attribute_value_identifier != "" else attribute_value_identifier
-                    attribute_value = ",".join(
-                        [attribute_id_value_dict[attribute_code][x] for x in attribute_value_identifier])
-                elif attribute_code == "category_ids":
-                    attribute_value = ",".join(attribute_value_identifier)
-                    product_dict["category_names"] = ",".join(
-                        category_id_names[ident] for ident in attribute_value_identifier)
-                else:
-                    attribute_value = attribute_value_identifier
-
-                product_dict[attribute_code] = [attribute_value]
-
-            products_list.append(pd.DataFrame(product_dict))
-            product_dict.clear()
-
-        full_df_without_qty = pd.concat(products_list, ignore_index=True)
-
-        qty_df = self.get_qtys()
-        values = {"qty": 99999999999}
-        full_df_with_qtys = pd.merge(full_df_without_qty, qty_df, on='id', how='left').fillna(value=values)
+            # Pages of a handler with scope columns only contain some of the product fields
+            product_dict = {field: item.get(field, None) for field in PRODUCT_FIELDS}
+            product_dict.update((custom_attribute["attribute_code"], custom_attribute["value"])
+                                for custom_attribute in item["custom_attributes"])
+            products_builder.append_row(product_dict)
+
+    def resolve_attribute_labels(self, product_df: pd.DataFrame) -> pd.DataFrame:
+        """
+        This function replaces the option ids of the select and multiselect attributes with their labels,
+        joins the category ids and adds the category names. The ids of all products are resolved at once,
+        unknown ids are skipped. The attributes and categories are fetched on first use.
+        :param product_df: Product rows with the raw attribute values of append_products.
+        :type product_df: pd.DataFrame
+        :return:
+        :rtype: pd.DataFrame
+        """
+        attribute_code_type_dict = self.magento_attribute_handler.get_attribute_types()
+        attribute_id_value_dict = self.get_attribute_id_value()
+        for attribute_code in product_df.columns:
+            if attribute_code_type_dict.get(attribute_code) in OPTION_ATTRIBUTE_TYPES:
+                product_df[attribute_code] = resolve_labels(product_df[attribute_code],
+                                                            attribute_id_value_dict.get(attribute_code, {}),
+                                                            attribute_code)
+
+        if CATEGORY_COLUMN in product_df.columns:
+            category_id_names = {str(category_id): name for category_id, name
+                                 in self.magento_attribute_handler.get_category_id_and_names().items()}
+            category_ids = product_df[CATEGORY_COLUMN]
+            product_df["category_names"] = resolve_labels(category_ids, category_id_names, "category_names")
+            product_df[CATEGORY_COLUMN] = resolve_labels(category_ids)
+
+        return product_df
+
+    async def fetch_product_frame_async(self, client: AsyncMagentoClient, updated_since: str = None) -> pd.DataFrame:
+        """
+        This function fetches the attributes, categories and product pages concurrently and returns the product frame.
+        Up to max_connections_per_host product pages are requested ahead while the pages are decoded in order.
+        :param client:
+        :type client: AsyncMagentoClient
+        :param updated_since: Only return products with a newer updated_at.
+        :type updated_since: str
+        :return: The product frame without the qtys.
+        :rtype: pd.DataFrame
+        """
+        page_size = self.page_size
+        first_page_task = asyncio.create_task(self.get_product_page_async(client, 1, page_size, updated_since))
+        await asyncio.gather(self.magento_attribute_handler.get_attributes_async(client),
+                             self.magento_attribute_handler.get_category_id_and_names_async(client))
+
+        first_page = await first_page_task
+        next_pages = iter(range(2, math.ceil(first_page["total_count"] / page_size) + 1))
+        pending_pages = deque(asyncio.create_task(self.get_product_page_async(client, page, page_size, updated_since))
+                              for page in islice(next_pages, client.max_connections_per_host))
+        products_builder = self.get_product_frame_builder()
+        try:
+            self.append_products(products_builder, first_page["items"])
+            del first_page
+            while pending_pages:
+                product_page = await pending_pages.popleft()
+                for page in islice(next_pages, 1):
+                    pending_pages.append(asyncio.create_task(self.get_product_page_async(client, page, page_size,
+                                                                                         updated_since)))
+                self.append_products(products_builder, product_page["items"])
+        except BaseException:
+            for pending_page in pending_pages:
+                pending_page.cancel()
+            products_builder.cleanup()
+            raise
+
+        return products_builder.build(categorical_columns=self.categorical_columns)
+
+    async def fetch_catalog_async(self, updated_since: str = None) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """
+        This function fetches the attributes, categories, qtys and product pages concurrently,
+        so the fetch takes about as long as its slowest endpoint instead of the sum of all endpoints.
+        :param updated_since: Only return products with a newer updated_at.
+        :type updated_since: str
+        :return: The product frame without the qtys and the qtys per product.
+        :rtype: Tuple[pd.DataFrame, pd.DataFrame]
+        """
+        async with self.get_async_client() as client:
+            qtys_task = asyncio.create_task(self.get_qtys_async(client))
+            try:
+                product_df = await self.fetch_product_frame_async(client, updated_since)
+            except BaseException:
+                qtys_task.cancel()
+                raise
+            qty_df = await qtys_task
+
+        return product_df, qty_df
+
+    def get_product_frame_and_qtys(self, updated_since: str = None) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """
+        This function returns the product frame without the qtys and the qtys per product.
+        With async_client set all endpoints are fetched concurrently, otherwise one after another.
+        :param updated_since: Only return products with a newer updated_at.
+        :type updated_since: str
+        :return:
+        :rtype: Tuple[pd.DataFrame, pd.DataFrame]
+        """
+        if self.async_client:
+            return asyncio.run(self.fetch_catalog_async(updated_since))
+
+        return self.get_product_frame(updated_since), self.get_qtys()
+
+    def add_qtys(self, full_df_without_qty: pd.DataFrame, qty_df: pd.DataFrame = None) -> pd.DataFrame:
+        """
+        This function adds the current qty of every product, products without stock item get an unlimited qty.
+        The qtys of products with several stock items, e.g. with multi-source inventory, are summed up.
+        The qty column is added to a new frame, the given frame is not changed.
+        :param full_df_without_qty:
+        :type full_df_without_qty: pd.DataFrame
+        :param qty_df: Already fetched qtys, by default they are fetched.
+        :type qty_df: pd.DataFrame
+        :return:
+        :rtype: pd.DataFrame
+        """
+        if qty_df is None:
+            qty_df = self.get_qtys()
+        qtys = qty_df.groupby("id")["qty"].sum()
+        full_df_with_qtys = full_df_without_qty.reset_index(drop=True)
+        full_df_with_qtys["qty"] = full_df_with_qtys["id"].map(qtys).fillna(99999999999)
 
         return full_df_with_qtys
 
@@ -103,24 +463,48 @@ class MagentoItemHandler(MagentoConnectionHandler):
         scope id is set to zero.
         """
 
-        full_endpoint = self.base_url + "/rest/all/V1/stockItems/lowStock"
+        get_resp = self.session.get(url=self.base_url + LOW_STOCK_ENDPOINT,
+                                    params=self.get_qty_params(),
+                                    timeout=self.timeout
+                                    )
 
+        get_resp.raise_for_status()
+
+        return self.to_qty_frame(get_resp.json())
+
+    async def get_qtys_async(self, client: AsyncMagentoClient) -> pd.DataFrame:
+        """
+        This function is the asyncio version of get_qtys.
+        :param client:
+        :type client: AsyncMagentoClient
+        :return:
+        :rtype: pd.DataFrame
+        """
+        return self.to_qty_frame(await client.get_json(LOW_STOCK_ENDPOINT, self.get_qty_params()))
+
+    @staticmethod
+    def get_qty_params() -> Dict:
+        """
+        This function returns the params of the lowStock endpoint that return the qtys of all products.
+        :return:
+        :rtype: Dict
+        """
         unlimited_product_count = 999999999999999
-        params = {"pageSize": unlimited_product_count,
-                  "qty": unlimited_product_count,
-                  "scopeId": 0}
-        get_resp = requests.get(url=full_endpoint,
-                                auth=self.magento_auth,
-                                params=params
-                                )
+        return {"pageSize": unlimited_product_count,
+                "qty": unlimited_product_count,
+                "scopeId": 0}
 
-        get_resp.raise_for_status()
-        product_qtys = get_resp.json()["items"]
-        dfs = []
-        for elem in product_qtys:
-            item_id = elem["product_id"]
-            qty = elem["qty"]
-            dfs.append(pd.DataFrame({"id": [item_id], "qty": [qty]}))
-        qty_df = pd.concat(dfs, ignore_index=True)
+    @staticmethod
+    def to_qty_frame(low_stock_response: Dict) -> pd.DataFrame:
+        """
+        This function returns the qty per product id of a lowStock response.
+        :param low_stock_response:
+        :type low_stock_response: Dict
+        :return:
+        :rtype: pd.DataFrame
+        """
+        product_qtys = low_stock_response["items"]
+        qty_df = pd.DataFrame({"id": [elem["product_id"] for elem in product_qtys],
+                               "qty": [elem["qty"] for elem in product_qtys]})
 
         return qty_df
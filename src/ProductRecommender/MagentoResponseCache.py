@@ -0,0 +1,96 @@
+"""
+This file contains the on-disk cache for Magento2 responses that rarely change, like attributes and categories.
+"""
+import hashlib
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Dict, Optional
+
+logger = logging.getLogger("MagentoResponseCache")
+
+
+class MagentoResponseCache:
+    """
+    This class stores json responses per base url, endpoint and params together with their validators.
+    """
+
+    def __init__(self, cache_dir, base_url: str, ttl: float):
+        base_url_key = hashlib.sha256(base_url.encode("utf8")).hexdigest()[:16]
+        self.cache_dir = Path(cache_dir) / base_url_key
+        self.ttl = ttl
+
+    def get_path(self, endpoint: str, params: Dict) -> Path:
+        """
+        This function returns the cache file of one request.
+        :param endpoint:
+        :type endpoint: str
+        :param params:
+        :type params: Dict
+        :return:
+        :rtype: Path
+        """
+        request_key = json.dumps([endpoint, params], sort_keys=True, default=str)
+        file_name = hashlib.sha256(request_key.encode("utf8")).hexdigest() + ".json"
+        return self.cache_dir / file_name
+
+    def load(self, endpoint: str, params: Dict) -> Optional[Dict]:
+        """
+        This function returns the cached entry with the keys body, etag, last_modified and fetched_at.
+        :param endpoint:
+        :type endpoint: str
+        :param params:
+        :type params: Dict
+        :return: None if nothing is cached or the file is broken.
+        :rtype: Optional[Dict]
+        """
+        path = self.get_path(endpoint, params)
+        if not path.exists():
+            return None
+
+        try:
+            with open(path, encoding="utf8") as cache_file:
+                return json.load(cache_file)
+        except (OSError, ValueError):
+            logger.warning(f"The cache file <{path}> could not be read and gets ignored.")
+            return None
+
+    def is_fresh(self, entry: Dict) -> bool:
+        """
+        This function checks if an entry is younger than the ttl and can be used without revalidation.
+        :param entry:
+        :type entry: Dict
+        :return:
+        :rtype: bool
+        """
+        return time.time() - entry["fetched_at"] < self.ttl
+
+    def store(self, endpoint: str, params: Dict, body, etag: str = None, last_modified: str = None):
+        """
+        This function writes an entry atomically, so parallel runs never read half written files.
+        :param endpoint:
+        :type endpoint: str
+        :param params:
+        :type params: Dict
+        :param body: The decoded json response.
+        :type body:
+        :param etag:
+        :type etag: str
+        :param last_modified:
+        :type last_modified: str
+        :return:
+        :rtype:
+        """
+        path = self.get_path(endpoint, params)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        entry = {"body": body,
+                 "etag": etag,
+                 "last_modified": last_modified,
+                 "fetched_at": time.time()}
+
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "w", encoding="utf8") as cache_file:
+            json.dump(entry, cache_file)
+        os.replace(tmp_path, path)
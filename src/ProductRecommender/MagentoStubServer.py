@@ -0,0 +1,255 @@
+"""
+This file contains a local stand-in of the Magento REST endpoints that the recommender uses.
+It answers products, products/attributes, categories and stockItems/lowStock of every store view
+from a SyntheticCatalog.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import re
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Tuple
+from urllib.parse import parse_qs, urlparse
+
+import requests
+
+from SyntheticCatalog import DEFAULT_STORE_CODE, SyntheticCatalog
+
+logger = logging.getLogger("MagentoStubServer")
+
+# The endpoints whose responses only depend on the store view
+STATIC_ENDPOINTS = ("products/attributes", "categories", "stockItems/lowStock")
+
+ENDPOINT_PATTERN = re.compile(r"^/rest/(?P<store_code>[^/]+)/V1/(?P<endpoint>.+)$")
+
+
+class MagentoStubRequestHandler(BaseHTTPRequestHandler):
+    """
+    This class answers the Magento requests from the catalog of the server.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def send_json(self, status: int, body):
+        """
+        This function sends a json response.
+        :param status:
+        :type status: int
+        :param body:
+        :type body:
+        :return:
+        :rtype:
+        """
+        payload = body if isinstance(body, bytes) else json.dumps(body).encode("utf8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        """
+        This function answers the GET requests of the Magento endpoints.
+        :return:
+        :rtype:
+        """
+        server = self.server
+        if server.latency_seconds:
+            time.sleep(server.latency_seconds)
+
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        match = ENDPOINT_PATTERN.match(url.path)
+        endpoint, store_code = (match.group("endpoint"), match.group("store_code")) if match else (None, None)
+
+        if endpoint == "products" and server.take_failure():
+            self.send_json(503, {"message": "Service Unavailable"})
+        elif endpoint == "products":
+            updated_since = None
+            if params.get("searchCriteria[filter_groups][0][filters][0][field]") == "updated_at":
+                updated_since = params["searchCriteria[filter_groups][0][filters][0][value]"]
+            self.send_json(200, server.catalog.get_product_page(int(params.get("searchCriteria[currentPage]", 1)),
+                                                                int(params.get("searchCriteria[pageSize]", 20)),
+                                                                updated_since, store_code))
+        elif endpoint in STATIC_ENDPOINTS:
+            self.send_json(200, server.get_static_response(endpoint, store_code))
+        else:
+            self.send_json(404, {"message": f"Request does not match any route: {url.path}"})
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class MagentoStubServer(ThreadingHTTPServer):
+    """
+    This class serves a SyntheticCatalog on a local port. Port 0 picks a free port.
+    The first fail_requests requests of the products endpoint are answered with 503 to test the retries.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, catalog: SyntheticCatalog, host: str = "127.0.0.1", port: int = 0,
+                 latency_ms: float = 0.0, fail_requests: int = 0):
+        super(MagentoStubServer, self).__init__((host, port), MagentoStubRequestHandler)
+        self.catalog = catalog
+        self.latency_seconds = latency_ms / 1000
+        self.fail_requests = fail_requests
+        self.failure_lock = threading.Lock()
+        # The responses that only depend on the store view are serialized once per store view
+        self.static_responses = {}
+        self.thread = None
+
+    def take_failure(self) -> bool:
+        """
+        This function returns if the current products request has to fail and counts it.
+        :return:
+        :rtype: bool
+        """
+        with self.failure_lock:
+            if self.fail_requests <= 0:
+                return False
+            self.fail_requests -= 1
+            return True
+
+    def get_static_response(self, endpoint: str, store_code: str) -> bytes:
+        """
+        This function returns the serialized response of a static endpoint for a store view.
+        :param endpoint: One of STATIC_ENDPOINTS.
+        :type endpoint: str
+        :param store_code:
+        :type store_code: str
+        :return:
+        :rtype: bytes
+        """
+        key = (endpoint, store_code)
+        if key not in self.static_responses:
+            if endpoint == "products/attributes":
+                response = self.catalog.get_attributes(store_code)
+            elif endpoint == "categories":
+                response = self.catalog.get_categories(store_code)
+            else:
+                response = self.catalog.get_low_stock()
+            self.static_responses[key] = json.dumps(response).encode("utf8")
+
+        return self.static_responses[key]
+
+    @property
+    def base_url(self) -> str:
+        """
+        This function returns the base url that is configured as Magento base_url.
+        :return:
+        :rtype: str
+        """
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "MagentoStubServer":
+        """
+        This function serves the requests in a background thread.
+        :return:
+        :rtype: MagentoStubServer
+        """
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        logger.info(f"Serving a catalog with {self.catalog.n_skus} products on {self.base_url}")
+        return self
+
+    def stop(self):
+        """
+        This function stops the background thread and closes the socket.
+        :return:
+        :rtype:
+        """
+        self.shutdown()
+        self.server_close()
+
+
+def serve_catalog(n_skus: int, seed: int, host: str, port: int, latency_ms: float):
+    """
+    This function generates a catalog and serves it until the process gets terminated.
+    :param n_skus:
+    :type n_skus: int
+    :param seed:
+    :type seed: int
+    :param host:
+    :type host: str
+    :param port:
+    :type port: int
+    :param latency_ms:
+    :type latency_ms: float
+    :return:
+    :rtype:
+    """
+    server = MagentoStubServer(SyntheticCatalog(n_skus, seed=seed), host, port, latency_ms)
+    server.serve_forever()
+
+
+def start_stub_process(n_skus: int, seed: int = 42, latency_ms: float = 0.0, host: str = "127.0.0.1",
+                       startup_timeout: float = 600) -> Tuple[multiprocessing.Process, str]:
+    """
+    This function serves a catalog from a separate process, so the stub neither shares the memory
+    nor the GIL with the measured pipeline. It returns when the stub answers requests.
+    :param n_skus:
+    :type n_skus: int
+    :param seed:
+    :type seed: int
+    :param latency_ms:
+    :type latency_ms: float
+    :param host:
+    :type host: str
+    :param startup_timeout: Seconds to wait for the catalog generation.
+    :type startup_timeout: float
+    :return: The process and the base url of the stub.
+    :rtype: Tuple[multiprocessing.Process, str]
+    """
+    with socket.socket() as free_socket:
+        free_socket.bind((host, 0))
+        port = free_socket.getsockname()[1]
+    base_url = f"http://{host}:{port}"
+
+    process = multiprocessing.Process(target=serve_catalog, args=(n_skus, seed, host, port, latency_ms), daemon=True)
+    process.start()
+    deadline = time.monotonic() + startup_timeout
+    while True:
+        try:
+            requests.get(f"{base_url}/rest/{DEFAULT_STORE_CODE}/V1/categories", timeout=5).raise_for_status()
+            break
+        except requests.exceptions.ConnectionError:
+            if not process.is_alive() or time.monotonic() > deadline:
+                process.terminate()
+                raise RuntimeError(f"The Magento stub with {n_skus} products did not start.")
+            time.sleep(0.2)
+
+    logger.info(f"Serving a catalog with {n_skus} products on {base_url} from process {process.pid}")
+    return process, base_url
+
+
+def main(args: List[str] = None):
+    """
+    This function serves a synthetic catalog until it gets interrupted.
+    :param args:
+    :type args: List[str]
+    :return:
+    :rtype:
+    """
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)8s] %(message)s")
+    parser = argparse.ArgumentParser(description="Serves a synthetic catalog with the Magento REST endpoints.")
+    parser.add_argument("--skus", type=int, default=10000, help="Number of products of the catalog.")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Delay added to every response.")
+    parsed_args = parser.parse_args(args)
+
+    server = MagentoStubServer(SyntheticCatalog(parsed_args.skus, seed=parsed_args.seed),
+                               parsed_args.host, parsed_args.port, parsed_args.latency_ms)
+    logger.info(f"Serving a catalog with {parsed_args.skus} products on {server.base_url}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+"""
+This file computes the recommendations of several store views from one fetch of the shared catalog.
+The products, prices, qtys and categories are fetched and selected once for all store views,
+every store view only fetches its names and text attributes and publishes to its own table.
+"""
+import asyncio
+import copy
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, List, Tuple
+
+import pandas as pd
+
+from CandidateFilter import CATEGORY_COLUMN
+from MagentoItemHandler import PRODUCT_FIELDS, MagentoItemHandler
+from ProductPreprocessing import TEXT_COLUMNS, add_documents, select_products
+from RecommenderPipeline import RecommenderPipeline
+from RunMetrics import get_row_count, run_metrics
+from util import get_config_file
+
+logger = logging.getLogger("MultiScopeRecommender")
+
+# The columns that differ between the store views, all other columns are shared
+SCOPE_COLUMNS = ("name",) + TEXT_COLUMNS
+
+# The stages that every store view runs on its own clean frame
+SCOPE_STAGES = ("featurize", "neighbours", "publish")
+
+
+def localize_products(product_df: pd.DataFrame, scope_df: pd.DataFrame, scope_columns: Iterable[str]) -> pd.DataFrame:
+    """
+    This function replaces the scope columns of the selected products with the values of a store view.
+    The imp_text of the shared products is dropped, it is built again from the text of the store view.
+    :param product_df: The output of select_products.
+    :type product_df: pd.DataFrame
+    :param scope_df: The product frame of the store view with the id and the scope columns.
+    :type scope_df: pd.DataFrame
+    :param scope_columns:
+    :type scope_columns: Iterable[str]
+    :return:
+    :rtype: pd.DataFrame
+    """
+    scope_df = scope_df.drop_duplicates("id").set_index("id")
+    columns = [column for column in scope_df.columns if column in set(scope_columns) or column == "imp_text"]
+    localized_df = product_df.drop(columns=[column for column in set(columns) | {"imp_text"}
+                                            if column in product_df.columns])
+
+    n_missing = int((~product_df["id"].isin(scope_df.index)).sum())
+    if n_missing:
+        logger.warning(f"{n_missing} products are missing in the store view, their text attributes stay empty")
+    for column in columns:
+        localized_df[column] = scope_df[column].reindex(product_df["id"]).set_axis(localized_df.index)
+
+    return localized_df
+
+
+class MultiScopeRecommender:
+    """
+    This class runs the recommender for the store views of multi_scope.scopes. The shared catalog and the
+    store views are fetched together and the store views are featurized and published concurrently,
+    store views with the same documents reuse the features and neighbours of the first of them.
+    """
+
+    def __init__(self, recommender_config: Dict = None, db_config: Dict = None, magento_item_handler=None,
+                 my_sql_handlers: Dict = None, artifact_dir=None, save_artifacts: bool = False):
+        self.recommender_config = recommender_config or get_config_file("RecommenderConf.yaml")
+        self.db_config = db_config or get_config_file("DBConf.yaml")
+        multi_scope_config = self.recommender_config.get("multi_scope", {})
+        self.scopes = multi_scope_config.get("scopes") or []
+        self.max_workers = multi_scope_config.get("max_workers", 2)
+        store_codes = [scope["store_code"] for scope in self.scopes]
+        if len(set(store_codes)) != len(store_codes):
+            raise ValueError(f"Every store view can only be configured once: {store_codes}")
+        self.my_sql_handlers = my_sql_handlers or {}
+        self.artifact_dir = Path(artifact_dir) if artifact_dir else None
+        self.save_artifacts = save_artifacts
+        self.stage_timings = {}
+
+        # Multi-scope runs are full runs, the shared pipeline only fetches and writes the metrics
+        self.pipeline = RecommenderPipeline(self.get_scope_config(), self.db_config,
+                                            magento_item_handler=magento_item_handler)
+        self.field_mode = self.pipeline.field_mode
+        field_columns = {field["column"] for field in self.pipeline.featurizer_config.get("fields") or []}
+        # The product fields besides the name and the category ids are the same in every store view
+        self.scope_columns = ((set(SCOPE_COLUMNS) | (field_columns if self.field_mode else set()))
+                              - (set(PRODUCT_FIELDS) - {"name"}) - {CATEGORY_COLUMN})
+
+    def get_scope_config(self, scope: Dict = None) -> Dict:
+        """
+        This function returns the recommender config of a store view, it always runs a full run
+        and writes the neighbour index of the store view if it has one.
+        :param scope: A scope of multi_scope.scopes, None for the shared catalog.
+        :type scope: Dict
+        :return:
+        :rtype: Dict
+        """
+        recommender_config = copy.deepcopy(self.recommender_config)
+        recommender_config["incremental"] = dict(recommender_config.get("incremental", {}), run_mode="full")
+        recommender_config["neighbour_index"] = dict(recommender_config.get("neighbour_index", {}),
+                                                     path=(scope or {}).get("neighbour_index_path") or "")
+
+        return recommender_config
+
+    def create_scope_pipeline(self, scope: Dict) -> RecommenderPipeline:
+        """
+        This function creates the pipeline that publishes the recommendations of a store view to its table.
+        :param scope:
+        :type scope: Dict
+        :return:
+        :rtype: RecommenderPipeline
+        """
+        store_code = scope["store_code"]
+        return RecommenderPipeline(self.get_scope_config(scope),
+                                   dict(self.db_config, table_name=scope["table_name"]),
+                                   artifact_dir=self.artifact_dir / store_code if self.artifact_dir else None,
+                                   save_artifacts=self.save_artifacts,
+                                   my_sql_handler=self.my_sql_handlers.get(store_code),
+                                   scope=store_code)
+
+    def get_scope_handlers(self) -> Dict[str, MagentoItemHandler]:
+        """
+        This function returns a MagentoItemHandler per store view that only requests the scope columns.
+        They share the connection of the shared handler.
+        :return:
+        :rtype: Dict[str, MagentoItemHandler]
+        """
+        magento_item_handler = self.pipeline.get_magento_item_handler()
+        return {scope["store_code"]: MagentoItemHandler(connection=magento_item_handler,
+                                                        store_code=scope["store_code"],
+                                                        scope_columns=self.scope_columns)
+                for scope in self.scopes}
+
+    async def fetch_async(self, scope_handlers: Dict[str, MagentoItemHandler]) \
+            -> Tuple[pd.DataFrame, Dict[str, pd.DataFrame]]:
+        """
+        This function fetches the shared catalog, the qtys and the store views concurrently with one client.
+        :param scope_handlers:
+        :type scope_handlers: Dict[str, MagentoItemHandler]
+        :return:
+        :rtype: Tuple[pd.DataFrame, Dict[str, pd.DataFrame]]
+        """
+        magento_item_handler = self.pipeline.get_magento_item_handler()
+        async with magento_item_handler.get_async_client() as client:
+            qty_df, product_df, *scope_dfs = await asyncio.gather(
+                magento_item_handler.get_qtys_async(client),
+                magento_item_handler.fetch_product_frame_async(client),
+                *[scope_handler.fetch_product_frame_async(client) for scope_handler in scope_handlers.values()])
+
+        return magento_item_handler.add_qtys(product_df, qty_df), dict(zip(scope_handlers, scope_dfs))
+
+    def fetch(self) -> Tuple[pd.DataFrame, Dict[str, pd.DataFrame]]:
+        """
+        This function fetches the shared catalog with its qtys and the product frame of every store view.
+        :return: The shared product frame and the product frame per store code.
+        :rtype: Tuple[pd.DataFrame, Dict[str, pd.DataFrame]]
+        """
+        magento_item_handler = self.pipeline.get_magento_item_handler()
+        scope_handlers = self.get_scope_handlers()
+        if magento_item_handler.async_client:
+            return asyncio.run(self.fetch_async(scope_handlers))
+
+        product_df_raw = magento_item_handler.get_product_attribute_frame()
+        return product_df_raw, {store_code: scope_handler.get_product_frame()
+                                for store_code, scope_handler in scope_handlers.items()}
+
+    def clean(self, product_df_raw: pd.DataFrame, scope_dfs: Dict[str, pd.DataFrame]) -> Dict[str, pd.DataFrame]:
+        """
+        This function selects the shared products once and adds the text of every store view to them.
+        :param product_df_raw:
+        :type product_df_raw: pd.DataFrame
+        :param scope_dfs:
+        :type scope_dfs: Dict[str, pd.DataFrame]
+        :return: The clean frame per store code.
+        :rtype: Dict[str, pd.DataFrame]
+        """
+        product_df = select_products(product_df_raw.copy())
+
+        return {store_code: add_documents(localize_products(product_df, scope_df, self.scope_columns),
+                                          build_text=not self.field_mode)
+                for store_code, scope_df in scope_dfs.items()}
+
+    def get_documents_hash(self, pipeline: RecommenderPipeline, product_df: pd.DataFrame) -> str:
+        """
+        This function returns a hash of the skus and documents of a clean frame.
+        Store views with the same hash get the same features and neighbours.
+        :param pipeline:
+        :type pipeline: RecommenderPipeline
+        :param product_df:
+        :type product_df: pd.DataFrame
+        :return:
+        :rtype: str
+        """
+        documents, _ = pipeline.build_documents(product_df)
+        hashes = pd.util.hash_pandas_object(pd.DataFrame({"sku": product_df["sku"].to_numpy(),
+                                                          "document": documents}), index=False)
+
+        return hashlib.sha1(hashes.to_numpy().tobytes()).hexdigest()
+
+    def build_scopes(self, pipelines: List[RecommenderPipeline], product_df: pd.DataFrame) -> Dict[str, Dict]:
+        """
+        This function runs the first pipeline on the clean frame and publishes its features and neighbours
+        with the other pipelines, which belong to store views with the same documents.
+        :param pipelines:
+        :type pipelines: List[RecommenderPipeline]
+        :param product_df:
+        :type product_df: pd.DataFrame
+        :return: The outputs per store code.
+        :rtype: Dict[str, Dict]
+        """
+        outputs = pipelines[0].run_stages(SCOPE_STAGES, {"clean": product_df})
+        scope_outputs = {pipelines[0].scope: outputs}
+        for pipeline in pipelines[1:]:
+            logger.info(f"The store view <{pipeline.scope}> has the documents of <{pipelines[0].scope}>")
+            scope_outputs[pipeline.scope] = pipeline.run_stages(["publish"], {"featurize": outputs["featurize"],
+                                                                              "neighbours": outputs["neighbours"]})
+
+        return scope_outputs
+
+    def run(self) -> Dict[str, Dict]:
+        """
+        This function fetches and cleans the catalog once and builds the store views in max_workers threads.
+        The stages of the store views are measured inside the scopes stage, which has their common peak RSS.
+        :return: The outputs per store code.
+        :rtype: Dict[str, Dict]
+        """
+        run_metrics.reset()
+        logger.info(f"Fetching the catalog and {len(self.scopes)} store views")
+        with run_metrics.measure_stage("fetch") as stage_metrics:
+            product_df_raw, scope_dfs = self.fetch()
+            stage_metrics["rows"] = get_row_count(product_df_raw)
+        self.stage_timings["fetch"] = stage_metrics["wall_time_seconds"]
+
+        with run_metrics.measure_stage("clean") as stage_metrics:
+            product_dfs = self.clean(product_df_raw, scope_dfs)
+            stage_metrics["rows"] = sum(len(product_df) for product_df in product_dfs.values())
+        self.stage_timings["clean"] = stage_metrics["wall_time_seconds"]
+        del product_df_raw, scope_dfs
+
+        groups = {}
+        pipelines = {}
+        for scope in self.scopes:
+            pipeline = self.create_scope_pipeline(scope)
+            documents_hash = self.get_documents_hash(pipeline, product_dfs[pipeline.scope])
+            groups.setdefault(documents_hash, []).append(pipeline)
+            pipelines[pipeline.scope] = pipeline
+
+        # The store views share the process, so only the scopes stage gets a peak RSS and not every store view
+        scope_outputs = {}
+        with run_metrics.measure_stage("scopes") as stage_metrics:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = [executor.submit(self.build_scopes, group, product_dfs[group[0].scope])
+                           for group in groups.values()]
+                for future in futures:
+                    scope_outputs.update(future.result())
+            stage_metrics["rows"] = sum(get_row_count(outputs["publish"]) or 0 for outputs in scope_outputs.values())
+        self.stage_timings["scopes"] = stage_metrics["wall_time_seconds"]
+
+        for pipeline in pipelines.values():
+            for stage, seconds in pipeline.stage_timings.items():
+                self.stage_timings[pipeline.get_stage_name(stage)] = seconds
+        self.pipeline.write_metrics()
+
+        return scope_outputs
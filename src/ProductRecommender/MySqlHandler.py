@@ -3,22 +3,55 @@ This file handles the communiation and transport the data to mysql database.
 
 """
 import mysql.connector
-from typing import Dict
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Tuple
+import hashlib
 import logging
+import time
+
+from RecommendationCodec import STORAGE_FORMATS, encode_string
+from RunMetrics import run_metrics
+from util import iter_chunks
 
 logger = logging.getLogger("MySqlHandler")
 
+# hash: diff the MD5 of the stored recommendations computed by MySQL, full: diff the stored recommendations
+DIFF_MODES = ("hash", "full")
+
+# The columns besides the sku and their definitions per storage format, all of them get diffed
+STORAGE_COLUMNS = {"text": (("recommondations", "TEXT DEFAULT NULL"),),
+                   "binary": (("neighbours", "BLOB DEFAULT NULL"),),
+                   "both": (("neighbours", "BLOB DEFAULT NULL"), ("recommondations", "TEXT DEFAULT NULL"))}
+
 
 class MySqlHandler:
     """
     this class handles the MySql Connection and transfers data.
     """
 
-    def __init__(self, mysql_user, mysql_pwd, db_name, host):
+    def __init__(self, mysql_user, mysql_pwd, db_name, host, batch_size=1000, diff_mode="hash", fetch_size=10000,
+                 pool_size=None, storage_format="text"):
+        if diff_mode not in DIFF_MODES:
+            raise ValueError(f"Unknown diff mode <{diff_mode}>, use one of {DIFF_MODES}.")
+        if storage_format not in STORAGE_FORMATS:
+            raise ValueError(f"Unknown storage format <{storage_format}>, use one of {STORAGE_FORMATS}.")
+        # an empty batch would swap an empty shadow table over the live table
+        for name, size in (("batch_size", batch_size), ("fetch_size", fetch_size)):
+            if not isinstance(size, int) or size < 1:
+                raise ValueError(f"The {name} has to be a positive integer, got <{size}>.")
         self.mysql_user = mysql_user
         self.mysql_pwd = mysql_pwd
         self.db_name = db_name
         self.host = host
+        self.batch_size = batch_size
+        self.diff_mode = diff_mode
+        # number of rows that the reader of the live table fetches at once
+        self.fetch_size = fetch_size
+        # size of the mysql.connector pool of the reader, the handlers of the same database share it
+        self.pool_size = pool_size
+        # text: the $$ joined skus, binary: the blobs of RecommendationCodec, both: the blobs and the text
+        self.storage_format = storage_format
+        self.value_columns = [column for column, _ in STORAGE_COLUMNS[storage_format]]
         self.connection = self.get_connection()
         self.cursor = self.connection.cursor()
 
@@ -40,15 +73,104 @@ class MySqlHandler:
             print("connection error")
             exit(1)
 
+    @contextmanager
+    def open_stream_cursor(self) -> Iterator:
+        """
+        This function yields an unbuffered cursor, so the rows of a select are streamed from the server.
+        With a pool_size the cursor belongs to a pooled connection, which goes back to the pool afterwards.
+        :return:
+        :rtype: Iterator
+        """
+        connection = None
+        if self.pool_size:
+            connection = mysql.connector.connect(user=self.mysql_user,
+                                                 password=self.mysql_pwd,
+                                                 host=self.host,
+                                                 database=self.db_name,
+                                                 pool_size=self.pool_size)
+        cursor = (connection or self.connection).cursor(buffered=False)
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+            if connection is not None:
+                connection.close()
+
+    def iter_rows(self, sql, params=None) -> Iterator[List[Tuple]]:
+        """
+        This function streams the result rows of a select in chunks of fetch_size rows
+        and counts the statement with all its rows in the run metrics.
+        :param sql:
+        :type sql: str
+        :param params:
+        :type params:
+        :return:
+        :rtype: Iterator[List[Tuple]]
+        """
+        start_time = time.perf_counter()
+        n_rows = 0
+        with self.open_stream_cursor() as cursor:
+            cursor.execute(sql, params or ())
+            rows = cursor.fetchmany(self.fetch_size)
+            while rows:
+                n_rows += len(rows)
+                yield rows
+                rows = cursor.fetchmany(self.fetch_size)
+        run_metrics.record_sql(sql.split(None, 1)[0].upper(), n_rows, time.perf_counter() - start_time)
+
+    def execute(self, sql, params=None, n_rows=0, fetch=False):
+        """
+        This function executes a statement and counts it with its rows in the run metrics.
+        :param sql:
+        :type sql: str
+        :param params:
+        :type params:
+        :param n_rows: The rows sent with the statement, the affected rows are counted if not given.
+        :type n_rows: int
+        :param fetch: Fetch and return all result rows.
+        :type fetch: bool
+        :return: The result rows if fetch is set.
+        :rtype:
+        """
+        start_time = time.perf_counter()
+        self.cursor.execute(sql, params)
+        result = self.cursor.fetchall() if fetch else None
+        run_metrics.record_sql(sql.split(None, 1)[0].upper(),
+                               len(result) if fetch else n_rows or max(self.cursor.rowcount, 0),
+                               time.perf_counter() - start_time)
+
+        return result
+
     def create_table_if_not_exists(self, table):
         """
-        This function creates the table
+        This function creates the table and adds the value columns of the storage format that an existing table
+        is missing, e.g. the neighbours column when a text table switches to the both format.
         :return:
         :rtype:
         """
-        mycursor = self.cursor
-        mycursor.execute(
-            f"CREATE TABLE IF NOT EXISTS {table} (sku VARCHAR(255) NOT NULL PRIMARY KEY, recommondations TEXT DEFAULT NULL)")
+        column_definitions = "".join(f", {column} {definition}"
+                                     for column, definition in STORAGE_COLUMNS[self.storage_format])
+        self.execute(f"CREATE TABLE IF NOT EXISTS {table} (sku VARCHAR(255) NOT NULL PRIMARY KEY{column_definitions})")
+
+        table_columns = set(self.get_table_columns(table))
+        for column, definition in STORAGE_COLUMNS[self.storage_format]:
+            if column not in table_columns:
+                logger.warning(f"Adding the column <{column}> of the storage format <{self.storage_format}> "
+                               f"to <{table}>, incremental runs only fill it for changed skus until a full run")
+                self.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+    def get_table_columns(self, table) -> List[str]:
+        """
+        This function returns the column names of a table.
+        :param table:
+        :type table:
+        :return:
+        :rtype: List[str]
+        """
+        rows = self.execute("SELECT COLUMN_NAME FROM information_schema.COLUMNS "
+                            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s", (table,), fetch=True)
+
+        return [row[0] for row in rows]
 
     @staticmethod
     def find_differences(remote_data: Dict, recommender_data: Dict):
@@ -72,64 +194,292 @@ class MySqlHandler:
 
         return differences_to_add_update, differences_to_delete
 
-    def upsert_data(self, table, remote_data, recommender_data):
+    def insert_batches(self, table, rows, stats, upsert=True):
         """
-        upsert
+        This function inserts (sku, values) rows with one multi-row statement per batch,
+        the values are a tuple with one value per value column of the storage format.
+        :param table:
+        :type table:
+        :param rows:
+        :type rows:
+        :param stats: The counters rows_upserted and batches get increased.
+        :type stats: Dict
+        :param upsert: Update the values of existing skus.
+        :type upsert: bool
         :return:
         :rtype:
         """
+        row_placeholder = "(" + ", ".join(["%s"] * (len(self.value_columns) + 1)) + ")"
+        for batch in iter_chunks(rows, self.batch_size):
+            placeholders = ", ".join([row_placeholder] * len(batch))
+            sql = f"INSERT INTO {table} (sku, {', '.join(self.value_columns)}) VALUES {placeholders}"
+            if upsert:
+                sql += " ON DUPLICATE KEY UPDATE " + ", ".join(f"{column} = VALUES({column})"
+                                                                for column in self.value_columns)
+            val = [value for esg_sku, values in batch for value in (esg_sku, *values)]
+            self.execute(sql, val, n_rows=len(batch))
+            stats["rows_upserted"] += len(batch)
+            stats["batches"] += 1
 
-        differences_to_add_update, differences_to_delete = self.find_differences(remote_data, recommender_data)
+    def delete_batches(self, table, skus, stats):
+        """
+        This function deletes the skus with one statement per batch.
+        :param table:
+        :type table:
+        :param skus:
+        :type skus:
+        :param stats: The counters rows_deleted and batches get increased.
+        :type stats: Dict
+        :return:
+        :rtype:
+        """
+        for batch in iter_chunks(skus, self.batch_size):
+            placeholders = ", ".join(["%s"] * len(batch))
+            sql = f"DELETE FROM {table} WHERE sku IN ({placeholders})"
+            self.execute(sql, batch, n_rows=len(batch))
+            stats["rows_deleted"] += len(batch)
+            stats["batches"] += 1
 
-        for esg_sku, string_rep_recomm in differences_to_add_update.items():
-            sql = f"INSERT INTO {table} (sku, recommondations) VALUES (%s, %s) ON DUPLICATE KEY UPDATE recommondations = VALUES(recommondations)"
-            val = (esg_sku, string_rep_recomm)
+    @staticmethod
+    def finish_stats(stats, start_time):
+        """
+        This function adds the duration and the throughput to the stats and logs them.
+        :param stats:
+        :type stats: Dict
+        :param start_time: The time.perf_counter() value of the start.
+        :type start_time: float
+        :return:
+        :rtype: Dict
+        """
+        duration = max(time.perf_counter() - start_time, 1e-9)
+        stats["seconds"] = duration
+        stats["rows_per_second"] = (stats["rows_upserted"] + stats["rows_deleted"]) / duration
+        stats["batches_per_second"] = stats["batches"] / duration
+        logger.info(f"Upserted {stats['rows_upserted']} and deleted {stats['rows_deleted']} rows "
+                    f"in {stats['batches']} batches ({stats['rows_per_second']:.0f} rows/s, "
+                    f"{stats['batches_per_second']:.1f} batches/s)")
 
-            self.cursor.execute(sql, val)
-            self.connection.commit()
+        return stats
+
+    def upsert_data(self, table, remote_data, recommender_data, recommender_keys):
+        """
+        This function upserts the changed and deletes the removed skus in batches of batch_size rows.
+        All statements run in one transaction which gets rolled back on failure.
+        :param recommender_keys: The values per sku that are compared with the remote data, e.g. their hashes.
+        :type recommender_keys: Dict
+        :return: The number of written rows and batches and the rows written per second.
+        :rtype: Dict
+        """
+
+        differences_to_add_update, differences_to_delete = self.find_differences(remote_data, recommender_keys)
+        differences_to_add_update = {sku: recommender_data[sku] for sku in differences_to_add_update}
+
+        stats = {"rows_upserted": 0, "rows_deleted": 0, "batches": 0}
+        start_time = time.perf_counter()
+        try:
+            self.insert_batches(table, differences_to_add_update.items(), stats)
+
+            self.delete_batches(table, differences_to_delete, stats)
 
-        for esg_sku in differences_to_delete:
-            sql = f"DELETE FROM {table} WHERE sku = %s"
-            val = (esg_sku, )
-            self.cursor.execute(sql, val)
             self.connection.commit()
+        except mysql.connector.Error:
+            logger.error("Upsert failed, rolling back the transaction")
+            self.connection.rollback()
+            raise
+
+        return self.finish_stats(stats, start_time)
+
+    def get_recommender_data(self, product_recommender_dict, product_recommender_blobs=None):
+        """
+        This function returns the values that are stored per sku in the value columns of the storage format:
+        the recommended skus joined to a string and the blob of RecommendationCodec.encode_batch.
+        :param product_recommender_dict: The recommended skus per sku, only used by the text and both formats.
+        :type product_recommender_dict: Dict
+        :param product_recommender_blobs: The blob per sku, only used by the binary and both formats.
+        :type product_recommender_blobs: Dict
+        :return: A tuple with one value per value column per sku.
+        :rtype: Dict
+        """
+        if self.storage_format != "text" and product_recommender_blobs is None:
+            raise ValueError(f"The storage format <{self.storage_format}> needs the recommendation blobs.")
+
+        if self.storage_format == "text":
+            return {sku: (encode_string(skus),) for sku, skus in product_recommender_dict.items()}
+        if self.storage_format == "binary":
+            return {sku: (blob,) for sku, blob in product_recommender_blobs.items()}
+
+        return {sku: (blob, encode_string(product_recommender_dict[sku]))
+                for sku, blob in product_recommender_blobs.items()}
 
-    def insert_data(self, table, product_recommender_dict):
+    def get_content_hash_sql(self) -> str:
+        """
+        This function returns the MySQL expression of the MD5 digest of the value columns.
+        Several columns are hashed by the concatenation of their MD5 hex digests, a NULL column makes it NULL.
+        :return:
+        :rtype: str
+        """
+        if len(self.value_columns) == 1:
+            return f"UNHEX(MD5({self.value_columns[0]}))"
+
+        return f"UNHEX(MD5(CONCAT({', '.join(f'MD5({column})' for column in self.value_columns)})))"
+
+    @staticmethod
+    def get_content_hashes(recommender_data):
+        """
+        This function returns the MD5 digest of the values per sku like the expression of get_content_hash_sql.
+        :param recommender_data: The output of get_recommender_data.
+        :type recommender_data: Dict
+        :return:
+        :rtype: Dict
+        """
+        def md5(value):
+            return hashlib.md5(value if isinstance(value, bytes) else value.encode("utf8"))
+
+        return {sku: md5(values[0]).digest() if len(values) == 1
+                else md5("".join(md5(value).hexdigest() for value in values)).digest()
+                for sku, values in recommender_data.items()}
+
+    def insert_data(self, table, product_recommender_dict, product_recommender_blobs=None):
         """
         This function inserts the relevant data.
+        The hash diff mode only reads the sku and the 16 byte MD5 of every row from the live table.
         :param table:
         :type table:
         :param product_recommender_dict:
         :type product_recommender_dict:
+        :param product_recommender_blobs:
+        :type product_recommender_blobs: Dict
         :return:
         :rtype:
         """
+        recommender_data = self.get_recommender_data(product_recommender_dict, product_recommender_blobs)
+        if self.diff_mode == "hash":
+            return self.upsert_data(table, self.get_remote_hashes(table), recommender_data,
+                                    self.get_content_hashes(recommender_data))
+
+        return self.upsert_data(table, self.get_remote_data(table), recommender_data, recommender_data)
+
+    def update_data(self, table, product_recommender_dict, skus_to_delete, product_recommender_blobs=None):
+        """
+        This function upserts the given skus and deletes the removed ones without reading the live table.
+        It is used by incremental runs that know which skus changed.
+        :param table:
+        :type table:
+        :param product_recommender_dict: The recommendations of the changed skus.
+        :type product_recommender_dict:
+        :param skus_to_delete:
+        :type skus_to_delete:
+        :param product_recommender_blobs: The blobs of the changed skus.
+        :type product_recommender_blobs: Dict
+        :return:
+        :rtype: Dict
+        """
+        recommender_data = self.get_recommender_data(product_recommender_dict, product_recommender_blobs)
+
+        stats = {"rows_upserted": 0, "rows_deleted": 0, "batches": 0}
+        start_time = time.perf_counter()
+        try:
+            self.insert_batches(table, recommender_data.items(), stats)
+            self.delete_batches(table, skus_to_delete, stats)
+            self.connection.commit()
+        except mysql.connector.Error:
+            logger.error("Update failed, rolling back the transaction")
+            self.connection.rollback()
+            raise
+
+        return self.finish_stats(stats, start_time)
+
+    def swap_data(self, table, product_recommender_dict, product_recommender_blobs=None):
+        """
+        This function bulk loads all recommendations into a shadow table and swaps it atomically
+        with the live table, so readers never see a half updated table. The old table gets dropped.
+        :param table:
+        :type table:
+        :param product_recommender_dict:
+        :type product_recommender_dict:
+        :param product_recommender_blobs:
+        :type product_recommender_blobs: Dict
+        :return:
+        :rtype: Dict
+        """
+        shadow_table = f"{table}_shadow"
+        old_table = f"{table}_old"
+        recommender_data = self.get_recommender_data(product_recommender_dict, product_recommender_blobs)
+
+        stats = {"rows_upserted": 0, "rows_deleted": 0, "batches": 0}
+        start_time = time.perf_counter()
+        self.execute(f"DROP TABLE IF EXISTS {shadow_table}")
+        self.execute(f"DROP TABLE IF EXISTS {old_table}")
+        self.create_table_if_not_exists(shadow_table)
+        try:
+            self.insert_batches(shadow_table, recommender_data.items(), stats, upsert=False)
+            self.connection.commit()
+        except mysql.connector.Error:
+            logger.error("Loading the shadow table failed, the live table stays untouched")
+            self.connection.rollback()
+            self.execute(f"DROP TABLE IF EXISTS {shadow_table}")
+            raise
 
-        remote_data = self.get_remote_data(table)
-        recommender_data = {}
-        for k, v in product_recommender_dict.items():
-            string_rep_recomm = "$$".join(v)
-            recommender_data[k] = string_rep_recomm
+        self.create_table_if_not_exists(table)
+        self.execute(f"RENAME TABLE {table} TO {old_table}, {shadow_table} TO {table}")
+        self.execute(f"DROP TABLE {old_table}")
+        logger.info(f"Swapped <{shadow_table}> in as <{table}>")
 
-        self.upsert_data(table, remote_data, recommender_data)
+        return self.finish_stats(stats, start_time)
+
+    def publish(self, table, product_recommender_dict, mode="upsert", product_recommender_blobs=None):
+        """
+        This function writes the recommendations with the selected publish mode.
+        upsert: diff against the live table and update it in place.
+        swap: load a shadow table and rename it to the live table.
+        :param table:
+        :type table:
+        :param product_recommender_dict:
+        :type product_recommender_dict:
+        :param mode:
+        :type mode: str
+        :param product_recommender_blobs: The blob per sku of the binary and both storage formats.
+        :type product_recommender_blobs: Dict
+        :return:
+        :rtype: Dict
+        """
+        if mode == "upsert":
+            return self.insert_data(table, product_recommender_dict, product_recommender_blobs)
+        if mode == "swap":
+            return self.swap_data(table, product_recommender_dict, product_recommender_blobs)
+
+        raise ValueError(f"Unknown publish mode <{mode}>, use upsert or swap.")
 
     def get_remote_data(self, table):
         """
         This function return the remote table.
         :param table:
         :type table:
-        :return:
-        :rtype:
+        :return: A tuple with the value of every value column per sku.
+        :rtype: Dict
         """
         logger.info("Getting remote data")
 
-        mycursor = self.cursor
-        mycursor.execute(
-            f"SELECT * FROM {table}")
-        myresult = mycursor.fetchall()
-
         remote_data = {}
-        for row in myresult:
-            remote_data[row[0]] = row[1]
+        for rows in self.iter_rows(f"SELECT sku, {', '.join(self.value_columns)} FROM {table}"):
+            remote_data.update((row[0], tuple(bytes(value) if isinstance(value, bytearray) else value
+                                              for value in row[1:])) for row in rows)
 
         return remote_data
+
+    def get_remote_hashes(self, table):
+        """
+        This function returns the MD5 digest of the value columns per sku of the remote table.
+        MySQL computes the hashes, so only the skus and 16 bytes per row are transferred.
+        :param table:
+        :type table:
+        :return:
+        :rtype: Dict
+        """
+        logger.info("Getting remote hashes")
+
+        remote_hashes = {}
+        for rows in self.iter_rows(f"SELECT sku, {self.get_content_hash_sql()} FROM {table}"):
+            remote_hashes.update(rows)
+
+        return remote_hashes
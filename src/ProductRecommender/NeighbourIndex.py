@@ -0,0 +1,262 @@
+"""
+This file writes and reads the memory-mapped neighbour index file.
+
+Layout: a 64 byte header followed by 64 byte aligned sections
+    sku_by_row      fixed width utf8 skus, one per row
+    sorted_skus     the same skus sorted for binary search
+    sorted_rows     int32 row of every sorted sku
+    neighbours      int32 (n_rows, k), -1 for missing neighbours
+    scores          float16 or float32 (n_rows, k)
+    flags           uint8 per row, bit 0 is set if the product is in stock
+    category_ids    int64 sorted ids of the categories
+    categories      uint8 (n_rows, ceil(n_categories / 8)) category bitset per row
+"""
+import logging
+import os
+import struct
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+logger = logging.getLogger("NeighbourIndex")
+
+MAGIC = b"PRNBRIDX"
+VERSION = 3
+FLAG_IN_STOCK = 1
+HEADER_FORMAT = "<8sIIQIIBI"
+HEADER_SIZE = 64
+SECTION_ALIGNMENT = 64
+SCORE_DTYPES = {2: np.float16, 4: np.float32}
+
+
+def align(offset: int) -> int:
+    """
+    This function rounds an offset up to the next section alignment.
+    :param offset:
+    :type offset: int
+    :return:
+    :rtype: int
+    """
+    return -(-offset // SECTION_ALIGNMENT) * SECTION_ALIGNMENT
+
+
+def get_sections(n_rows: int, k: int, sku_width: int, score_dtype,
+                 n_categories: int = 0) -> Dict[str, Tuple[int, np.dtype, Tuple]]:
+    """
+    This function returns the offset, dtype and shape of every section of the index.
+    :param n_rows:
+    :type n_rows: int
+    :param k:
+    :type k: int
+    :param sku_width:
+    :type sku_width: int
+    :param score_dtype:
+    :type score_dtype:
+    :param n_categories:
+    :type n_categories: int
+    :return:
+    :rtype: Dict[str, Tuple[int, np.dtype, Tuple]]
+    """
+    layout = [("sku_by_row", np.dtype(f"S{sku_width}"), (n_rows,)),
+              ("sorted_skus", np.dtype(f"S{sku_width}"), (n_rows,)),
+              ("sorted_rows", np.dtype(np.int32), (n_rows,)),
+              ("neighbours", np.dtype(np.int32), (n_rows, k)),
+              ("scores", np.dtype(score_dtype), (n_rows, k)),
+              ("flags", np.dtype(np.uint8), (n_rows,)),
+              ("category_ids", np.dtype(np.int64), (n_categories,)),
+              ("categories", np.dtype(np.uint8), (n_rows, -(-n_categories // 8)))]
+
+    sections = {}
+    offset = HEADER_SIZE
+    for name, dtype, shape in layout:
+        sections[name] = (offset, dtype, shape)
+        offset = align(offset + dtype.itemsize * int(np.prod(shape)))
+
+    return sections
+
+
+def write_neighbour_index(path, skus: Sequence[str], neighbour_indices: np.ndarray, neighbour_scores: np.ndarray,
+                          score_dtype: str = "float16", in_stock: np.ndarray = None,
+                          category_ids: np.ndarray = None, category_bitsets: np.ndarray = None):
+    """
+    This function writes the neighbour index to a temporary file and renames it to path,
+    so readers either see the old or the new index.
+    :param path:
+    :type path:
+    :param skus: The sku per row.
+    :type skus: Sequence[str]
+    :param neighbour_indices: Neighbour rows of shape (N, k).
+    :type neighbour_indices: np.ndarray
+    :param neighbour_scores: Neighbour scores of shape (N, k).
+    :type neighbour_scores: np.ndarray
+    :param score_dtype: float16 or float32
+    :type score_dtype: str
+    :param in_stock: Boolean stock status per row, all rows are in stock if not given.
+    :type in_stock: np.ndarray
+    :param category_ids: The sorted category ids of the category bitsets.
+    :type category_ids: np.ndarray
+    :param category_bitsets: The category bitset per row of CandidateFilter.get_category_bitsets.
+    :type category_bitsets: np.ndarray
+    :return:
+    :rtype:
+    """
+    path = Path(path)
+    score_dtype = np.dtype(score_dtype)
+    encoded_skus = np.array([str(sku).encode("utf8") for sku in skus], dtype=object)
+    sku_width = max([len(sku) for sku in encoded_skus] + [1])
+    sku_by_row = encoded_skus.astype(f"S{sku_width}")
+    sorted_rows = np.argsort(sku_by_row, kind="stable").astype(np.int32)
+    n_rows, k = neighbour_indices.shape
+    if in_stock is None:
+        in_stock = np.ones(n_rows, dtype=bool)
+    if category_ids is None:
+        category_ids = np.empty(0, dtype=np.int64)
+        category_bitsets = np.zeros((n_rows, 0), dtype=np.uint8)
+
+    arrays = {"sku_by_row": sku_by_row,
+              "sorted_skus": sku_by_row[sorted_rows],
+              "sorted_rows": sorted_rows,
+              "neighbours": neighbour_indices.astype(np.int32),
+              "scores": neighbour_scores.astype(score_dtype),
+              "flags": np.where(in_stock, FLAG_IN_STOCK, 0).astype(np.uint8),
+              "category_ids": np.asarray(category_ids, dtype=np.int64),
+              "categories": np.asarray(category_bitsets, dtype=np.uint8)}
+    sections = get_sections(n_rows, k, sku_width, score_dtype, len(category_ids))
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "wb") as index_file:
+        header = struct.pack(HEADER_FORMAT, MAGIC, VERSION, HEADER_SIZE, n_rows, k, sku_width, score_dtype.itemsize,
+                             len(category_ids))
+        index_file.write(header.ljust(HEADER_SIZE, b"\0"))
+        for name, (offset, _, _) in sections.items():
+            index_file.write(b"\0" * (offset - index_file.tell()))
+            index_file.write(np.ascontiguousarray(arrays[name]).tobytes())
+    os.replace(tmp_path, path)
+    logger.info(f"Wrote neighbour index with {n_rows} rows and {k} neighbours to <{path}>")
+
+
+class NeighbourIndexReader:
+    """
+    This class answers neighbour lookups from the memory-mapped index file.
+    The file is opened on the first lookup and only the touched pages get read,
+    so many processes can share one index through the page cache.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.arrays = None
+        self.n_rows = 0
+        self.k = 0
+        self.version = None
+
+    def open(self):
+        """
+        This function reads the header and maps the sections.
+        :return:
+        :rtype:
+        """
+        with open(self.path, "rb") as index_file:
+            header = index_file.read(HEADER_SIZE)
+        magic, version, header_size, n_rows, k, sku_width, score_itemsize, n_categories = struct.unpack_from(
+            HEADER_FORMAT, header)
+        if magic != MAGIC:
+            raise ValueError(f"The file <{self.path}> is no neighbour index.")
+        if version != VERSION or score_itemsize not in SCORE_DTYPES:
+            raise ValueError(f"Unsupported neighbour index version {version} with {score_itemsize} byte scores, "
+                             f"expected version {VERSION}.")
+
+        arrays = {}
+        sections = get_sections(n_rows, k, sku_width, SCORE_DTYPES[score_itemsize], n_categories)
+        for name, (offset, dtype, shape) in sections.items():
+            if int(np.prod(shape)) == 0:
+                arrays[name] = np.zeros(shape, dtype=dtype)
+                continue
+            arrays[name] = np.memmap(self.path, dtype=dtype, mode="r", offset=offset, shape=shape)
+
+        self.arrays = arrays
+        self.n_rows = n_rows
+        self.k = k
+        self.version = version
+
+    def get_arrays(self) -> Dict[str, np.memmap]:
+        """
+        This function returns the mapped sections and opens the file if needed.
+        :return:
+        :rtype: Dict[str, np.memmap]
+        """
+        if self.arrays is None:
+            self.open()
+
+        return self.arrays
+
+    def row(self, sku: str) -> Optional[int]:
+        """
+        This function returns the row of a sku by binary search or None if the sku is unknown.
+        :param sku:
+        :type sku: str
+        :return:
+        :rtype: Optional[int]
+        """
+        arrays = self.get_arrays()
+        encoded_sku = sku.encode("utf8")
+        position = int(np.searchsorted(arrays["sorted_skus"], encoded_sku))
+        if position >= self.n_rows or arrays["sorted_skus"][position] != encoded_sku:
+            return None
+
+        return int(arrays["sorted_rows"][position])
+
+    def sku(self, row: int) -> str:
+        """
+        This function returns the sku of a row.
+        :param row:
+        :type row: int
+        :return:
+        :rtype: str
+        """
+        return self.get_arrays()["sku_by_row"][row].decode("utf8")
+
+    def in_stock(self, row: int) -> bool:
+        """
+        This function returns the stock status of a row.
+        :param row:
+        :type row: int
+        :return:
+        :rtype: bool
+        """
+        return bool(self.get_arrays()["flags"][row] & FLAG_IN_STOCK)
+
+    def neighbours(self, sku: str, n: int = None) -> List[Tuple[str, float]]:
+        """
+        This function returns the first n neighbours of a sku with their scores in descending order.
+        :param sku:
+        :type sku: str
+        :param n: Number of neighbours, defaults to all stored neighbours.
+        :type n: int
+        :return: An empty list if the sku is unknown.
+        :rtype: List[Tuple[str, float]]
+        """
+        row = self.row(sku)
+        if row is None:
+            return []
+
+        arrays = self.get_arrays()
+        neighbour_rows = arrays["neighbours"][row, :n]
+        scores = arrays["scores"][row, :n]
+        sku_by_row = arrays["sku_by_row"]
+
+        return [(sku_by_row[neighbour_row].decode("utf8"), float(score))
+                for neighbour_row, score in zip(neighbour_rows.tolist(), scores.tolist()) if neighbour_row >= 0]
+
+    def close(self):
+        """
+        This function drops the memory maps.
+        :return:
+        :rtype:
+        """
+        self.arrays = None
+
+    def __len__(self):
+        self.get_arrays()
+        return self.n_rows
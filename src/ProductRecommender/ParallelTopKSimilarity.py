@@ -0,0 +1,165 @@
+"""
+This file computes the top-k cosine similarities with a pool of processes.
+The normalized csr arrays are written once to memory-mapped files which all workers share through the page cache.
+"""
+import logging
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Tuple
+
+import numpy as np
+from scipy import sparse
+
+from TopKSimilarity import get_block_size, prepare_matrix, select_top_k, similarity_block, top_k_rows
+
+logger = logging.getLogger("ParallelTopKSimilarity")
+
+# The memory-mapped matrices of a worker process, set by init_worker
+worker_matrices = {}
+
+
+def save_csr_arrays(directory: Path, name: str, matrix: sparse.csr_matrix):
+    """
+    This function writes the data, indices and indptr arrays and the shape of a csr matrix as .npy files.
+    :param directory:
+    :type directory: Path
+    :param name:
+    :type name: str
+    :param matrix:
+    :type matrix: sparse.csr_matrix
+    :return:
+    :rtype:
+    """
+    np.save(directory / f"{name}_data.npy", matrix.data)
+    np.save(directory / f"{name}_indices.npy", matrix.indices)
+    np.save(directory / f"{name}_indptr.npy", matrix.indptr)
+    np.save(directory / f"{name}_shape.npy", np.array(matrix.shape, dtype=np.int64))
+
+
+def load_csr_arrays(directory: Path, name: str) -> sparse.csr_matrix:
+    """
+    This function opens a csr matrix written by save_csr_arrays without reading the arrays into memory.
+    :param directory:
+    :type directory: Path
+    :param name:
+    :type name: str
+    :return:
+    :rtype: sparse.csr_matrix
+    """
+    data = np.load(directory / f"{name}_data.npy", mmap_mode="r")
+    indices = np.load(directory / f"{name}_indices.npy", mmap_mode="r")
+    indptr = np.load(directory / f"{name}_indptr.npy", mmap_mode="r")
+    shape = tuple(np.load(directory / f"{name}_shape.npy"))
+
+    return sparse.csr_matrix((data, indices, indptr), shape=shape, copy=False)
+
+
+def init_worker(matrix_dir: str):
+    """
+    This function opens the shared matrices once per worker process.
+    :param matrix_dir:
+    :type matrix_dir: str
+    :return:
+    :rtype:
+    """
+    worker_matrices["matrix"] = load_csr_arrays(Path(matrix_dir), "matrix")
+    worker_matrices["matrix_t"] = load_csr_arrays(Path(matrix_dir), "matrix_t")
+
+
+def top_k_task(row_ids: np.ndarray, k: int, exclude_self: bool) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    This function computes the top-k neighbours of one row block inside a worker process.
+    :param row_ids:
+    :type row_ids: np.ndarray
+    :param k:
+    :type k: int
+    :param exclude_self:
+    :type exclude_self: bool
+    :return:
+    :rtype: Tuple[np.ndarray, np.ndarray]
+    """
+    score_block = similarity_block(worker_matrices["matrix"], worker_matrices["matrix_t"], row_ids, exclude_self)
+    return select_top_k(score_block, k)
+
+
+def parallel_top_k_rows(vecs: sparse.spmatrix, row_ids: np.ndarray, k: int, block_size: int = 256,
+                        max_block_mb: float = None, n_workers: int = None, exclude_self: bool = True,
+                        tmp_dir: str = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    This function computes the k most similar rows of the given rows against all rows with n_workers processes.
+    Every row block is one task and the per-block results are merged into the output arrays.
+    With one worker the rows are computed in this process.
+    :param vecs: Sparse document vectors, e.g. the output of the TfidfVectorizer.
+    :type vecs: sparse.spmatrix
+    :param row_ids:
+    :type row_ids: np.ndarray
+    :param k: Number of neighbours per row.
+    :type k: int
+    :param block_size: Number of rows multiplied at once per worker.
+    :type block_size: int
+    :param max_block_mb: Optional upper bound of the memory used by the blocks of all workers together.
+    :type max_block_mb: float
+    :param n_workers: Number of processes, defaults to the number of cpus.
+    :type n_workers: int
+    :param exclude_self: Skip the row itself as neighbour.
+    :type exclude_self: bool
+    :param tmp_dir: Directory of the memory-mapped files, defaults to the system temp directory.
+    :type tmp_dir: str
+    :return: The neighbour indices (int32) and scores (float32) of shape (len(row_ids), k) in descending order.
+    :rtype: Tuple[np.ndarray, np.ndarray]
+    """
+    n_workers = n_workers or os.cpu_count() or 1
+    if n_workers <= 1:
+        return top_k_rows(vecs, row_ids, k, block_size, max_block_mb, exclude_self)
+
+    matrix, matrix_t = prepare_matrix(vecs)
+    row_ids = np.asarray(row_ids, dtype=np.int64)
+    n_rows = matrix.shape[0]
+    k = max(0, min(k, n_rows - 1 if exclude_self else n_rows))
+    block_size = get_block_size(n_rows, block_size, max_block_mb / n_workers if max_block_mb else None)
+
+    neighbour_indices = np.empty((len(row_ids), k), dtype=np.int32)
+    neighbour_scores = np.empty((len(row_ids), k), dtype=np.float32)
+
+    logger.info(f"Computing top {k} neighbours for {len(row_ids)} of {n_rows} rows "
+                f"in blocks of {block_size} rows with {n_workers} workers")
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as matrix_dir:
+        save_csr_arrays(Path(matrix_dir), "matrix", matrix)
+        save_csr_arrays(Path(matrix_dir), "matrix_t", matrix_t)
+        del matrix, matrix_t
+
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=init_worker, initargs=(matrix_dir,)) as executor:
+            block_starts = {executor.submit(top_k_task, row_ids[start:start + block_size], k, exclude_self): start
+                            for start in range(0, len(row_ids), block_size)}
+            for future in as_completed(block_starts):
+                start = block_starts[future]
+                block_indices, block_scores = future.result()
+                neighbour_indices[start:start + len(block_indices)] = block_indices
+                neighbour_scores[start:start + len(block_scores)] = block_scores
+
+    return neighbour_indices, neighbour_scores
+
+
+def parallel_top_k_cosine_similarity(vecs: sparse.spmatrix, k: int, block_size: int = 256,
+                                     max_block_mb: float = None, n_workers: int = None,
+                                     exclude_self: bool = True) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    This function computes for every row the k most similar rows by cosine similarity with n_workers processes.
+    :param vecs:
+    :type vecs: sparse.spmatrix
+    :param k:
+    :type k: int
+    :param block_size:
+    :type block_size: int
+    :param max_block_mb:
+    :type max_block_mb: float
+    :param n_workers:
+    :type n_workers: int
+    :param exclude_self:
+    :type exclude_self: bool
+    :return: The neighbour indices (int32) and scores (float32) of shape (N, k) in descending score order.
+    :rtype: Tuple[np.ndarray, np.ndarray]
+    """
+    return parallel_top_k_rows(vecs, np.arange(vecs.shape[0]), k, block_size, max_block_mb, n_workers, exclude_self)
@@ -0,0 +1,224 @@
+"""
+This file cleans the raw Magento product frame and builds the text that gets vectorized.
+"""
+from typing import Dict, List, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from util import get_config_file
+
+# The attributes that build the text of a product
+TEXT_COLUMNS = ("short_description", "esg_hersteller", "category_names", "esg_produktgruppe", "esg_farben",
+                "esg_produktsparte", "esg_product_name_keywords")
+
+
+def change_category_name_string(input_str: Union[str, float], split_by=",") -> str:
+    """
+
+    :param split_by:
+    :param input_str:
+    :return:
+    :rtype:
+    """
+
+    splitted_categorys = input_str.split(split_by)
+    new_cat_names = []
+    for cat in splitted_categorys:
+        new_cat_name = "<" + cat + ">"
+        new_cat_names.append(new_cat_name)
+
+    return " ".join(new_cat_names)
+
+
+def add_config_groups(input_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    This function adds the configurable group of every product, i.e. the third part of the esg sku.
+    Products without a group are dropped and the rows are ordered by group in order of their first appearance.
+    :param input_df:
+    :type input_df:
+    :return:
+    :rtype:
+    """
+    input_df["esg_sku_tmp"] = (input_df.loc[:, "sku"].str.split("-").str[2])
+    config_groups = input_df.groupby(["esg_sku_tmp"]).ngroup()
+    input_df["group_id"] = config_groups
+
+    grouped_df = input_df[config_groups.notna()]
+    group_order, _ = pd.factorize(grouped_df["group_id"])
+    grouped_df = grouped_df.iloc[np.argsort(group_order, kind="stable")].reset_index(drop=True)
+
+    return grouped_df
+
+
+def remove_simple_from_its_configurable(input_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Remove the simple products if they have configurable or bundle as parent.
+    We want to reocmmend only visible products!
+    :param input_df:
+    :type input_df:
+    :return:
+    :rtype:
+    """
+
+    grouped_df = add_config_groups(input_df)
+    groups = grouped_df.groupby("group_id", sort=False)
+    grouped_df["summed_qtys"] = groups["qty"].transform("sum")
+
+    has_parent = grouped_df["type_id"].isin(["bundle", "configurable"]).groupby(grouped_df["group_id"]).transform("any")
+    cleaned_df = grouped_df[~(has_parent & (grouped_df["type_id"] == "simple"))].reset_index(drop=True)
+
+    return cleaned_df
+
+
+def get_price_bands(price_ranges: List[Dict]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    This function returns the names and the edges of the configured price ranges.
+    The ranges have to be sorted and contiguous, a price belongs to a range if min <= price < max.
+    :param price_ranges: List of dicts with the keys name, min and max.
+    :type price_ranges: List[Dict]
+    :return:
+    :rtype: Tuple[np.ndarray, np.ndarray]
+    """
+    names = np.array([price_range["name"] for price_range in price_ranges], dtype=object)
+    edges = [price_ranges[0]["min"]]
+    for price_range in price_ranges:
+        if price_range["min"] != edges[-1] or price_range["max"] <= price_range["min"]:
+            raise ValueError(f"The price range <{price_range['name']}> does not continue the previous range.")
+        edges.append(price_range["max"])
+
+    return names, np.array(edges, dtype=float)
+
+
+def create_price_ranges(input_df: pd.DataFrame, price_ranges: List[Dict] = None) -> pd.DataFrame:
+    """
+    This function adds the names of the price ranges of all products in the same configurable group.
+    :param input_df:
+    :type input_df:
+    :param price_ranges: The price ranges, by default loaded from RecommenderConf.yaml.
+    :type price_ranges: List[Dict]
+    :return:
+    :rtype:
+    """
+    if price_ranges is None:
+        price_ranges = get_config_file("RecommenderConf.yaml")["price_ranges"]
+    names, edges = get_price_bands(price_ranges)
+
+    price_ranges_df = add_config_groups(input_df)
+    prices = price_ranges_df.loc[:, "price"].to_numpy(dtype=float)
+    band_ids = np.searchsorted(edges, prices, side="right") - 1
+    in_band = (band_ids >= 0) & (band_ids < len(names))
+
+    band_names = pd.Series(names[band_ids[in_band]], index=price_ranges_df.index[in_band])
+    group_price_ranges = band_names.groupby(price_ranges_df.loc[in_band, "group_id"], sort=False).agg(" ".join)
+    price_ranges_df["price_ranges"] = price_ranges_df.loc[:, "group_id"].map(group_price_ranges).fillna("")
+
+    return price_ranges_df
+
+
+def get_in_stock(product_df: pd.DataFrame) -> np.ndarray:
+    """
+    This function returns per product if it is enabled and has a qty left in its configurable group.
+    :param product_df: A frame with the status and summed_qtys columns.
+    :type product_df: pd.DataFrame
+    :return:
+    :rtype: np.ndarray
+    """
+    return (~((product_df["status"] == 2) | (product_df["summed_qtys"] == 0))).to_numpy()
+
+
+def add_text_columns(product_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    This function converts the text attributes to tokens and adds the imp_text column with the text of every product
+    without its price range. It only uses the row itself, so the streaming ingestion applies it per chunk.
+    :param product_df:
+    :type product_df: pd.DataFrame
+    :return:
+    :rtype: pd.DataFrame
+    """
+    for column_name in TEXT_COLUMNS:
+        if column_name not in product_df.columns:
+            product_df[column_name] = pd.Series(np.nan, index=product_df.index, dtype=object)
+
+    product_df["category_names"] = product_df.loc[:, "category_names"].fillna("").apply(change_category_name_string,
+                                                                                        split_by=",")
+    product_df["esg_produktgruppe"] = product_df.loc[:, "esg_produktgruppe"] \
+        .fillna("") \
+        .apply(change_category_name_string, split_by=",")
+
+    product_df["esg_product_name_keywords"] = (product_df
+                                               .loc[:, "esg_product_name_keywords"]
+                                               .fillna("")
+                                               .apply(change_category_name_string, split_by="|"))
+    product_df["esg_farben"] = product_df.loc[:, "esg_farben"].fillna("").apply(change_category_name_string,
+                                                                                split_by=",")
+
+    product_df["imp_text"] = product_df.loc[:, "short_description"].astype(object).str.replace(",", "") \
+                        + " " + product_df.loc[:, "esg_hersteller"].astype(object) \
+                        + " " + product_df.loc[:, "category_names"] + " " + product_df.loc[:, "esg_produktgruppe"] \
+                        + " " + product_df.loc[:, "esg_farben"] + " " + product_df.loc[:, "esg_produktsparte"] \
+                        + " " + product_df.loc[:, "esg_product_name_keywords"]
+
+    return product_df
+
+
+def select_products(product_df_raw: pd.DataFrame) -> pd.DataFrame:
+    """
+    This function adds the price ranges and removes the simple products of configurables.
+    The selected products do not depend on the text attributes, so all store views share them.
+    :param product_df_raw: The output of MagentoItemHandler.get_product_attribute_frame.
+    :type product_df_raw: pd.DataFrame
+    :return:
+    :rtype: pd.DataFrame
+    """
+    product_df_price_ranges = create_price_ranges(product_df_raw)
+
+    return remove_simple_from_its_configurable(product_df_price_ranges)
+
+
+def add_documents(product_df: pd.DataFrame, build_text: bool = True) -> pd.DataFrame:
+    """
+    This function adds the imp column with the text of every selected product and the ids column.
+    Frames of the streaming ingestion already contain the imp_text of add_text_columns.
+    :param product_df: The output of select_products.
+    :type product_df: pd.DataFrame
+    :param build_text: False skips the imp column, the fields featurizer vectorizes the fields directly.
+    :type build_text: bool
+    :return:
+    :rtype: pd.DataFrame
+    """
+    if build_text:
+        if "imp_text" not in product_df.columns:
+            product_df = add_text_columns(product_df)
+
+        product_df["imp"] = product_df.loc[:, "imp_text"].astype(object) + " " + product_df.loc[:, "price_ranges"]
+
+    product_df["ids"] = [i for i in range(0, product_df.shape[0])]
+
+    return product_df
+
+
+def clean_product_frame(product_df_raw: pd.DataFrame, build_text: bool = True) -> pd.DataFrame:
+    """
+    This function removes the simple products of configurables and adds the imp column with the text of every product.
+    Out of stock and disabled products stay in the frame, they are filtered from the candidate neighbours with
+    get_in_stock, so a changed stock needs no new similarity search.
+    :param product_df_raw: The output of MagentoItemHandler.get_product_attribute_frame.
+    :type product_df_raw: pd.DataFrame
+    :param build_text: False skips the imp column, the fields featurizer vectorizes the fields directly.
+    :type build_text: bool
+    :return:
+    :rtype: pd.DataFrame
+    """
+    return add_documents(select_products(product_df_raw), build_text)
+
+
+def get_documents(product_df: pd.DataFrame) -> np.ndarray:
+    """
+    This function returns the imp text of every product as the documents for the vectorizer.
+    :param product_df:
+    :type product_df: pd.DataFrame
+    :return:
+    :rtype: np.ndarray
+    """
+    return product_df["imp"].apply(lambda x: np.str_(x)).to_numpy(dtype=str)
@@ -0,0 +1,111 @@
+"""
+This file encodes the recommendations of a product as a compact binary blob for the recommendations table.
+A blob is a format version byte and the number of recommendations (uint16) followed by the Magento product ids
+(int32) and the scores (float16) of the recommendations, all little endian. The text format joins the recommended
+skus with $$, decode_to_string converts a blob to it for consumers of the text format.
+"""
+import struct
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+
+# text: the $$ joined skus, binary: the blob, both: the blob and the $$ joined skus of the text format
+STORAGE_FORMATS = ("text", "binary", "both")
+
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<BH")
+ID_DTYPE = np.dtype("<i4")
+SCORE_DTYPE = np.dtype("<f2")
+
+SKU_SEPARATOR = "$$"
+
+
+def encode_recommendations(product_ids: np.ndarray, scores: np.ndarray) -> bytes:
+    """
+    This function encodes the recommendations of one product.
+    :param product_ids: The Magento product ids of the recommendations.
+    :type product_ids: np.ndarray
+    :param scores: The score per recommendation.
+    :type scores: np.ndarray
+    :return:
+    :rtype: bytes
+    """
+    return (HEADER.pack(FORMAT_VERSION, len(product_ids))
+            + np.asarray(product_ids).astype(ID_DTYPE).tobytes()
+            + np.asarray(scores).astype(SCORE_DTYPE).tobytes())
+
+
+def decode_recommendations(blob: bytes) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    This function decodes a blob of encode_recommendations.
+    :param blob:
+    :type blob: bytes
+    :return: The product ids (int32) and the scores (float16) of the recommendations.
+    :rtype: Tuple[np.ndarray, np.ndarray]
+    """
+    if len(blob) < HEADER.size:
+        raise ValueError(f"A recommendations blob has at least {HEADER.size} bytes, got {len(blob)}.")
+    version, n_recommendations = HEADER.unpack_from(blob)
+    if version != FORMAT_VERSION:
+        raise ValueError(f"Unsupported recommendations format version {version}, expected {FORMAT_VERSION}.")
+    if len(blob) != HEADER.size + n_recommendations * (ID_DTYPE.itemsize + SCORE_DTYPE.itemsize):
+        raise ValueError(f"The recommendations blob has {len(blob)} bytes, "
+                         f"which does not match its {n_recommendations} recommendations.")
+
+    product_ids = np.frombuffer(blob, dtype=ID_DTYPE, count=n_recommendations, offset=HEADER.size)
+    scores = np.frombuffer(blob, dtype=SCORE_DTYPE, count=n_recommendations,
+                           offset=HEADER.size + product_ids.nbytes)
+
+    return product_ids, scores
+
+
+def encode_batch(recommended_rows: np.ndarray, recommended_scores: np.ndarray,
+                 product_ids: np.ndarray) -> List[bytes]:
+    """
+    This function encodes the output of BatchRecommender.select_recommendations, one blob per row.
+    :param recommended_rows: Recommended rows of shape (N, n), the missing recommendations are -1 at the end.
+    :type recommended_rows: np.ndarray
+    :param recommended_scores: The scores of shape (N, n).
+    :type recommended_scores: np.ndarray
+    :param product_ids: The Magento product id per row.
+    :type product_ids: np.ndarray
+    :return:
+    :rtype: List[bytes]
+    """
+    product_ids = np.asarray(product_ids)
+    if len(product_ids) and (product_ids.min() < np.iinfo(ID_DTYPE).min or product_ids.max() > np.iinfo(ID_DTYPE).max):
+        raise ValueError("The product ids do not fit into the int32 ids of the recommendations format.")
+
+    counts = (recommended_rows >= 0).sum(axis=1)
+    recommended_ids = np.where(recommended_rows >= 0, product_ids[recommended_rows], 0).astype(ID_DTYPE)
+    recommended_scores = recommended_scores.astype(SCORE_DTYPE)
+
+    return [HEADER.pack(FORMAT_VERSION, count) + ids[:count].tobytes() + scores[:count].tobytes()
+            for count, ids, scores in zip(counts.tolist(), recommended_ids, recommended_scores)]
+
+
+def encode_string(skus: Sequence[str]) -> str:
+    """
+    This function joins recommended skus to the text format.
+    :param skus:
+    :type skus: Sequence[str]
+    :return:
+    :rtype: str
+    """
+    return SKU_SEPARATOR.join(skus)
+
+
+def decode_to_string(blob: bytes, sku_by_product_id: Dict[int, str]) -> str:
+    """
+    This function converts a blob to the text format, product ids without sku are skipped.
+    :param blob:
+    :type blob: bytes
+    :param sku_by_product_id:
+    :type sku_by_product_id: Dict[int, str]
+    :return:
+    :rtype: str
+    """
+    product_ids, _ = decode_recommendations(blob)
+
+    return encode_string([sku_by_product_id[product_id] for product_id in product_ids.tolist()
+                          if product_id in sku_by_product_id])
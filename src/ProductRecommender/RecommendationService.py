@@ -0,0 +1,500 @@
+"""
+This file contains a small HTTP service that answers recommendations from the neighbour index.
+
+Endpoints:
+    GET  /recommend/{sku}?n=10&category=same
+    POST /recommend/batch   {"skus": ["..."], "n": 10, "category": "same"}
+    GET  /stats
+
+The optional category is "same", which keeps the neighbours that share a category with the sku,
+or a category id, which keeps the neighbours of that category.
+"""
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, unquote, urlparse
+
+import numpy as np
+
+from CandidateFilter import get_category_bit, shares_category
+from NeighbourIndex import FLAG_IN_STOCK, NeighbourIndexReader
+from util import get_config_file, get_root
+
+logger = logging.getLogger("RecommendationService")
+
+# The cached value of unknown skus, None is a cache miss
+UNKNOWN_SKU = object()
+
+
+class LruCache:
+    """
+    This class is a thread-safe least recently used cache with hit and miss counters.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        This function returns the cached value or None and counts the hit or miss.
+        :param key:
+        :type key:
+        :return:
+        :rtype:
+        """
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        """
+        This function caches a value and evicts the least recently used entry if the cache is full.
+        :param key:
+        :type key:
+        :param value:
+        :type value:
+        :return:
+        :rtype:
+        """
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        """
+        This function removes all entries.
+        :return:
+        :rtype:
+        """
+        with self.lock:
+            self.entries.clear()
+
+    def get_stats(self) -> Dict:
+        """
+        This function returns the size and the hit and miss counters.
+        :return:
+        :rtype: Dict
+        """
+        with self.lock:
+            return {"size": len(self.entries), "max_size": self.max_size, "hits": self.hits, "misses": self.misses}
+
+
+class RecommendationService:
+    """
+    This class answers recommendations from the neighbour index and reloads it when a new index gets published.
+    Every loaded index gets a new generation, which is part of the cache keys, so requests that still compute
+    with the old index can not cache their results for the new one.
+    """
+
+    def __init__(self, index_path, cache_size: int = 100000, reload_interval: float = 5.0, default_n: int = 20,
+                 latency_window: int = 10000):
+        self.index_path = index_path
+        self.reload_interval = reload_interval
+        self.default_n = default_n
+        self.cache = LruCache(cache_size)
+        self.latencies = deque(maxlen=latency_window)
+        self.n_requests = 0
+        # The reader and the generation of the loaded index, they are replaced together
+        self.index_state = (None, 0)
+        self.index_signature = None
+        self.last_reload_check = 0.0
+        self.reload_lock = threading.Lock()
+        self.reload()
+
+    def get_index_signature(self):
+        """
+        This function returns what identifies the current index file, a new published file changes it.
+        :return:
+        :rtype:
+        """
+        stat = os.stat(self.index_path)
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def reload(self):
+        """
+        This function opens the current index file as the next generation and clears the cache.
+        Requests that still use the old reader keep working on the old mapped file.
+        :return:
+        :rtype:
+        """
+        with self.reload_lock:
+            signature = self.get_index_signature()
+            reader = NeighbourIndexReader(self.index_path)
+            reader.open()
+            self.index_state = (reader, self.index_state[1] + 1)
+            self.index_signature = signature
+            self.cache.clear()
+        logger.info(f"Loaded neighbour index <{self.index_path}> with {reader.n_rows} rows")
+
+    def reload_if_changed(self):
+        """
+        This function reloads the index if the file changed, at most once per reload interval.
+        :return:
+        :rtype:
+        """
+        now = time.monotonic()
+        if now - self.last_reload_check < self.reload_interval:
+            return
+        self.last_reload_check = now
+
+        try:
+            signature = self.get_index_signature()
+        except OSError:
+            logger.warning(f"The neighbour index <{self.index_path}> can not be read, keeping the loaded index")
+            return
+        if signature != self.index_signature:
+            self.reload()
+
+    def compute_recommendations(self, reader: NeighbourIndexReader, sku: str, n: int,
+                                category: str = None) -> Optional[List[str]]:
+        """
+        This function returns the first n in-stock neighbours of a sku without the sku itself.
+        The candidates are filtered with the stock flags and the category bitsets of the index.
+        :param reader:
+        :type reader: NeighbourIndexReader
+        :param sku:
+        :type sku: str
+        :param n:
+        :type n: int
+        :param category: None, same or a category id.
+        :type category: str
+        :return: None if the sku is unknown.
+        :rtype: Optional[List[str]]
+        """
+        row = reader.row(sku)
+        if row is None:
+            return None
+
+        arrays = reader.get_arrays()
+        neighbour_rows = np.asarray(arrays["neighbours"][row])
+        neighbour_rows = neighbour_rows[(neighbour_rows >= 0) & (neighbour_rows != row)]
+        neighbour_rows = neighbour_rows[(arrays["flags"][neighbour_rows] & FLAG_IN_STOCK).astype(bool)]
+        if category == "same":
+            neighbour_rows = neighbour_rows[shares_category(arrays["categories"], np.array([row]),
+                                                            neighbour_rows[None, :])[0]]
+        elif category is not None:
+            category_byte, category_bit = get_category_bit(arrays["category_ids"], int(category))
+            if category_byte < 0:
+                return []
+            neighbour_rows = neighbour_rows[(arrays["categories"][neighbour_rows, category_byte]
+                                             & category_bit).astype(bool)]
+
+        recommended_skus = []
+        for neighbour_sku in arrays["sku_by_row"][neighbour_rows]:
+            if len(recommended_skus) >= n:
+                break
+            neighbour_sku = neighbour_sku.decode("utf8")
+            if neighbour_sku != sku:
+                recommended_skus.append(neighbour_sku)
+
+        return recommended_skus
+
+    @property
+    def reader(self) -> NeighbourIndexReader:
+        """
+        This function returns the reader of the loaded index.
+        :return:
+        :rtype: NeighbourIndexReader
+        """
+        return self.index_state[0]
+
+    def get_n(self, reader: NeighbourIndexReader, n: int = None) -> int:
+        """
+        This function returns the number of recommendations of a request, at most the neighbours of the index.
+        :param reader:
+        :type reader: NeighbourIndexReader
+        :param n: None for the default_n.
+        :type n: int
+        :return:
+        :rtype: int
+        """
+        n = self.default_n if n is None else n
+        if n < 1:
+            raise ValueError(f"n has to be at least 1, got {n}")
+
+        return min(n, reader.k)
+
+    def recommend_with_index(self, reader: NeighbourIndexReader, generation: int, sku: str, n: int,
+                             category: str = None) -> Optional[List[str]]:
+        """
+        This function returns the recommendations of a sku from the cache or the given index.
+        :param reader:
+        :type reader: NeighbourIndexReader
+        :param generation: The generation of the reader.
+        :type generation: int
+        :param sku:
+        :type sku: str
+        :param n: The output of get_n.
+        :type n: int
+        :param category:
+        :type category: str
+        :return: None if the sku is unknown.
+        :rtype: Optional[List[str]]
+        """
+        cache_key = (generation, sku, n, category)
+        recommended_skus = self.cache.get(cache_key)
+        if recommended_skus is None:
+            recommended_skus = self.compute_recommendations(reader, sku, n, category)
+            self.cache.put(cache_key, UNKNOWN_SKU if recommended_skus is None else recommended_skus)
+
+        return None if recommended_skus is UNKNOWN_SKU else recommended_skus
+
+    def recommend(self, sku: str, n: int = None, category: str = None) -> Optional[List[str]]:
+        """
+        This function returns the recommendations of a sku from the cache or the index.
+        :param sku:
+        :type sku: str
+        :param n: None for the default_n, at most the neighbours of the index are returned.
+        :type n: int
+        :param category: None, same or a category id.
+        :type category: str
+        :return: None if the sku is unknown.
+        :rtype: Optional[List[str]]
+        """
+        reader, generation = self.index_state
+
+        return self.recommend_with_index(reader, generation, sku, self.get_n(reader, n), category)
+
+    def recommend_batch(self, skus: List[str], n: int = None, category: str = None) -> Dict[str, Optional[List[str]]]:
+        """
+        This function returns the recommendations of many skus, all of them from the same index.
+        :param skus:
+        :type skus: List[str]
+        :param n:
+        :type n: int
+        :param category: None, same or a category id.
+        :type category: str
+        :return:
+        :rtype: Dict[str, Optional[List[str]]]
+        """
+        reader, generation = self.index_state
+        n = self.get_n(reader, n)
+
+        return {sku: self.recommend_with_index(reader, generation, sku, n, category) for sku in skus}
+
+    def record_latency(self, seconds: float):
+        """
+        This function records the duration of one request.
+        :param seconds:
+        :type seconds: float
+        :return:
+        :rtype:
+        """
+        self.latencies.append(seconds)
+        self.n_requests += 1
+
+    def get_stats(self) -> Dict:
+        """
+        This function returns the cache counters, the latency percentiles in ms and the index info.
+        :return:
+        :rtype: Dict
+        """
+        reader, generation = self.index_state
+        latencies = np.array(self.latencies, dtype=float) * 1000
+        latency_stats = {"p50_ms": None, "p99_ms": None}
+        if len(latencies) > 0:
+            latency_stats = {"p50_ms": float(np.percentile(latencies, 50)),
+                             "p99_ms": float(np.percentile(latencies, 99))}
+
+        return {"requests": self.n_requests,
+                "latency": latency_stats,
+                "cache": self.cache.get_stats(),
+                "index": {"path": str(self.index_path), "rows": reader.n_rows, "k": reader.k,
+                          "version": reader.version, "generation": generation}}
+
+
+def parse_category(category) -> Optional[str]:
+    """
+    This function validates the category of a request.
+    :param category: None, same or a category id.
+    :type category:
+    :return:
+    :rtype: Optional[str]
+    """
+    if category is None or category == "same":
+        return category
+
+    return str(int(category))
+
+
+class RecommendationRequestHandler(BaseHTTPRequestHandler):
+    """
+    This class maps the HTTP requests to the RecommendationService of the server.
+    """
+
+    def send_json(self, status: int, body):
+        """
+        This function sends a json response.
+        :param status:
+        :type status: int
+        :param body:
+        :type body:
+        :return:
+        :rtype:
+        """
+        payload = json.dumps(body).encode("utf8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        """
+        This function answers GET /recommend/{sku}?n=&category= and GET /stats.
+        :return:
+        :rtype:
+        """
+        service = self.server.service
+        service.reload_if_changed()
+        url = urlparse(self.path)
+
+        if url.path == "/stats":
+            self.send_json(200, service.get_stats())
+            return
+
+        if not url.path.startswith("/recommend/") or url.path == "/recommend/batch":
+            self.send_json(404, {"error": "unknown endpoint"})
+            return
+
+        start_time = time.perf_counter()
+        try:
+            self.answer_recommend(service, unquote(url.path[len("/recommend/"):]), parse_qs(url.query))
+        finally:
+            service.record_latency(time.perf_counter() - start_time)
+
+    def answer_recommend(self, service: RecommendationService, sku: str, query: Dict):
+        """
+        This function answers the recommendations of one sku.
+        :param service:
+        :type service: RecommendationService
+        :param sku:
+        :type sku: str
+        :param query: The parsed query string with the optional n and category.
+        :type query: Dict
+        :return:
+        :rtype:
+        """
+        try:
+            n = int(query["n"][0]) if "n" in query else None
+            category = parse_category(query.get("category", [None])[0])
+            recommended_skus = service.recommend(sku, n, category)
+        except ValueError:
+            self.send_json(400, {"error": "n has to be a positive integer and category same or a category id"})
+            return
+
+        if recommended_skus is None:
+            self.send_json(404, {"error": f"unknown sku {sku}"})
+        else:
+            self.send_json(200, {"sku": sku, "recommendations": recommended_skus})
+
+    def do_POST(self):
+        """
+        This function answers POST /recommend/batch.
+        :return:
+        :rtype:
+        """
+        service = self.server.service
+        service.reload_if_changed()
+
+        if urlparse(self.path).path != "/recommend/batch":
+            self.send_json(404, {"error": "unknown endpoint"})
+            return
+
+        start_time = time.perf_counter()
+        try:
+            self.answer_recommend_batch(service)
+        finally:
+            service.record_latency(time.perf_counter() - start_time)
+
+    def answer_recommend_batch(self, service: RecommendationService):
+        """
+        This function answers the recommendations of the skus of the json body.
+        :param service:
+        :type service: RecommendationService
+        :return:
+        :rtype:
+        """
+        try:
+            content_length = int(self.headers.get("Content-Length", 0))
+            request_body = json.loads(self.rfile.read(content_length) or b"{}")
+            skus = [str(sku) for sku in request_body["skus"]]
+            n = int(request_body["n"]) if request_body.get("n") is not None else None
+            category = parse_category(request_body.get("category"))
+            recommendations = service.recommend_batch(skus, n, category)
+        except (KeyError, TypeError, ValueError):
+            self.send_json(400, {"error": "expected a json body with skus and optional positive n and category"})
+            return
+
+        self.send_json(200, {"recommendations": recommendations})
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def create_server(service: RecommendationService, host: str, port: int) -> ThreadingHTTPServer:
+    """
+    This function creates the HTTP server of a service.
+    :param service:
+    :type service: RecommendationService
+    :param host:
+    :type host: str
+    :param port:
+    :type port: int
+    :return:
+    :rtype: ThreadingHTTPServer
+    """
+    server = ThreadingHTTPServer((host, port), RecommendationRequestHandler)
+    server.service = service
+    return server
+
+
+def main(args: List[str] = None):
+    """
+    This function starts the service with the settings of RecommenderConf.yaml.
+    :param args:
+    :type args: List[str]
+    :return:
+    :rtype:
+    """
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)8s] %(message)s")
+    recommender_config = get_config_file("RecommenderConf.yaml")
+    service_config = recommender_config.get("service", {})
+
+    parser = argparse.ArgumentParser(description="Serves the product recommendations over HTTP.")
+    parser.add_argument("--host", default=service_config.get("host", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=service_config.get("port", 8080))
+    index_path = recommender_config.get("neighbour_index", {}).get("path")
+    parser.add_argument("--index-path", default=get_root() / index_path if index_path else None)
+    parsed_args = parser.parse_args(args)
+    if not parsed_args.index_path:
+        parser.error("no neighbour index configured, set neighbour_index.path in RecommenderConf.yaml "
+                     "or pass --index-path")
+
+    service = RecommendationService(parsed_args.index_path,
+                                    cache_size=service_config.get("cache_size", 100000),
+                                    reload_interval=service_config.get("reload_interval", 5.0),
+                                    default_n=service_config.get("default_n", 20))
+    server = create_server(service, parsed_args.host, parsed_args.port)
+    logger.info(f"Serving recommendations on {parsed_args.host}:{parsed_args.port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+"""
+This file benchmarks the RecommenderPipeline on synthetic catalogs.
+Every catalog size runs all stages against a local Magento stub and a SQLite stand-in of MySQL.
+The wall time, throughput and peak RSS per stage are compared with stored baselines,
+a stage that got slower or bigger than the tolerance allows fails the run.
+"""
+import argparse
+import copy
+import json
+import logging
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List
+
+from MagentoItemHandler import MagentoItemHandler
+from MagentoStubServer import start_stub_process
+from RecommenderPipeline import RecommenderPipeline
+from RunMetrics import run_metrics
+from SqliteHandler import SqliteHandler
+from util import get_config_file, get_root
+
+logger = logging.getLogger("RecommenderBenchmark")
+
+
+def get_benchmark_config(recommender_config: Dict) -> Dict:
+    """
+    This function returns the recommender config of a benchmark run, which never touches the production state.
+    :param recommender_config:
+    :type recommender_config: Dict
+    :return:
+    :rtype: Dict
+    """
+    benchmark_config = copy.deepcopy(recommender_config)
+    benchmark_config["incremental"] = {"run_mode": "full"}
+    benchmark_config["neighbour_index"] = {"path": ""}
+    benchmark_config["metrics"] = {"report_path": "", "prometheus_path": ""}
+
+    return benchmark_config
+
+
+def run_benchmark(n_skus: int, seed: int = 42, latency_ms: float = 0.0, recommender_config: Dict = None) -> Dict:
+    """
+    This function runs all stages of the pipeline on a synthetic catalog with n_skus products.
+    :param n_skus:
+    :type n_skus: int
+    :param seed:
+    :type seed: int
+    :param latency_ms: Delay of every Magento response.
+    :type latency_ms: float
+    :param recommender_config:
+    :type recommender_config: Dict
+    :return: Wall time, rows, throughput and peak RSS per stage, requests, bytes and latency per Magento endpoint,
+        statements and rows per MySQL statement type and the info of the stages, e.g. the recall of the ann backend.
+    :rtype: Dict
+    """
+    recommender_config = get_benchmark_config(recommender_config or get_config_file("RecommenderConf.yaml"))
+    stub_process, base_url = start_stub_process(n_skus, seed=seed, latency_ms=latency_ms)
+    try:
+        connection_settings = {"base_url": base_url, "cache_dir": "",
+                               "consumer_key": "benchmark", "consumer_key_secret": "benchmark",
+                               "access_token": "benchmark", "access_token_secret": "benchmark"}
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            pipeline = RecommenderPipeline(recommender_config=recommender_config,
+                                           db_config={"table_name": "product_recommender"},
+                                           magento_item_handler=MagentoItemHandler(connection_settings),
+                                           my_sql_handler=SqliteHandler(Path(tmp_dir) / "recommender.db"))
+            start_time = time.perf_counter()
+            pipeline.run()
+            total_seconds = time.perf_counter() - start_time
+            report = run_metrics.get_report()
+    finally:
+        stub_process.terminate()
+        stub_process.join()
+
+    stages = {}
+    for stage, stage_metrics in report["stages"].items():
+        rows = stage_metrics["rows"] or 0
+        stages[stage] = {"wall_time_seconds": stage_metrics["wall_time_seconds"],
+                         "rows": stage_metrics["rows"],
+                         "rows_per_second": rows / max(stage_metrics["wall_time_seconds"], 1e-9),
+                         "peak_rss_mb": stage_metrics["peak_rss_mb"]}
+    http = {endpoint: {"requests": endpoint_metrics["requests"],
+                       "bytes": endpoint_metrics["bytes"],
+                       "mean_latency_ms": 1000 * endpoint_metrics["seconds"] / max(endpoint_metrics["requests"], 1)}
+            for endpoint, endpoint_metrics in report["http"].items()}
+
+    return {"n_skus": n_skus, "total_seconds": total_seconds, "stages": stages, "http": http,
+            "mysql": report["mysql"], "info": report["info"]}
+
+
+def compare_with_baseline(result: Dict, baseline: Dict, tolerance: float, min_seconds: float = 0.5,
+                          min_mb: float = 50) -> List[str]:
+    """
+    This function returns the regressions of a benchmark result against its baseline.
+    Differences below min_seconds and min_mb are ignored, they are noise for the small stages.
+    :param result: The output of run_benchmark.
+    :type result: Dict
+    :param baseline: The stored output of run_benchmark for the same catalog size.
+    :type baseline: Dict
+    :param tolerance: Allowed relative growth, e.g. 0.25 for 25%.
+    :type tolerance: float
+    :param min_seconds:
+    :type min_seconds: float
+    :param min_mb:
+    :type min_mb: float
+    :return: One message per regression.
+    :rtype: List[str]
+    """
+    regressions = []
+    for stage, stage_metrics in result["stages"].items():
+        baseline_metrics = baseline["stages"].get(stage)
+        if baseline_metrics is None:
+            continue
+        for key, min_difference in (("wall_time_seconds", min_seconds), ("peak_rss_mb", min_mb)):
+            value, baseline_value = stage_metrics[key], baseline_metrics[key]
+            if value is None or baseline_value is None:
+                continue
+            if value > baseline_value * (1 + tolerance) and value - baseline_value > min_difference:
+                regressions.append(f"{result['n_skus']} skus, stage {stage}: {key} {value:.2f} "
+                                   f"exceeds the baseline {baseline_value:.2f} by more than {tolerance:.0%}")
+
+    return regressions
+
+
+def load_baselines(path: Path) -> Dict:
+    """
+    This function loads the baselines per catalog size.
+    :param path:
+    :type path: Path
+    :return:
+    :rtype: Dict
+    """
+    if not path.exists():
+        return {}
+
+    with open(path, encoding="utf8") as baseline_file:
+        return json.load(baseline_file)
+
+
+def save_json(path: Path, content: Dict):
+    """
+    This function writes a json file and creates its directory.
+    :param path:
+    :type path: Path
+    :param content:
+    :type content: Dict
+    :return:
+    :rtype:
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w", encoding="utf8") as json_file:
+        json.dump(content, json_file, indent=2)
+
+
+def print_result(result: Dict):
+    """
+    This function prints the stages of a benchmark result as a table.
+    :param result:
+    :type result: Dict
+    :return:
+    :rtype:
+    """
+    print(f"{result['n_skus']} skus, {result['total_seconds']:.1f}s")
+    print(f"{'stage':<12}{'seconds':>10}{'rows':>10}{'rows/s':>12}{'peak MB':>10}")
+    for stage, stage_metrics in result["stages"].items():
+        print(f"{stage:<12}{stage_metrics['wall_time_seconds']:>10.2f}{stage_metrics['rows'] or 0:>10}"
+              f"{stage_metrics['rows_per_second']:>12.0f}{stage_metrics['peak_rss_mb'] or 0:>10.0f}")
+
+
+def main(args: List[str] = None) -> int:
+    """
+    This function runs the benchmark for every catalog size and compares the results with the baselines.
+    :param args:
+    :type args: List[str]
+    :return: 1 if a stage regressed, else 0.
+    :rtype: int
+    """
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s [%(levelname)8s] %(message)s")
+    benchmark_config = get_config_file("RecommenderConf.yaml").get("benchmark", {})
+
+    parser = argparse.ArgumentParser(description="Benchmarks the recommender on synthetic catalogs.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=benchmark_config.get("sizes", [1000, 10000]),
+                        help="Number of products per catalog.")
+    parser.add_argument("--seed", type=int, default=benchmark_config.get("seed", 42))
+    parser.add_argument("--latency-ms", type=float, default=benchmark_config.get("latency_ms", 0.0),
+                        help="Delay of every Magento response.")
+    parser.add_argument("--tolerance", type=float, default=benchmark_config.get("tolerance", 0.25),
+                        help="Allowed relative growth of the wall time and peak RSS per stage.")
+    parser.add_argument("--baseline-path", type=Path,
+                        default=get_root() / benchmark_config.get("baseline_path", "benchmarks/baselines.json"))
+    parser.add_argument("--report-path", type=Path, default=None, help="Write all results to this json file.")
+    parser.add_argument("--update-baselines", action="store_true",
+                        help="Store the results as new baselines instead of comparing them.")
+    parsed_args = parser.parse_args(args)
+
+    baselines = load_baselines(parsed_args.baseline_path)
+    results = {}
+    regressions = []
+    for n_skus in parsed_args.sizes:
+        result = run_benchmark(n_skus, seed=parsed_args.seed, latency_ms=parsed_args.latency_ms)
+        results[str(n_skus)] = result
+        print_result(result)
+        if parsed_args.update_baselines:
+            continue
+        if str(n_skus) in baselines:
+            regressions.extend(compare_with_baseline(result, baselines[str(n_skus)], parsed_args.tolerance))
+        else:
+            print(f"No baseline for {n_skus} skus, store one with --update-baselines")
+
+    if parsed_args.report_path:
+        save_json(parsed_args.report_path, results)
+    if parsed_args.update_baselines:
+        baselines.update(results)
+        save_json(parsed_args.baseline_path, baselines)
+        print(f"Stored the baselines of {', '.join(results)} skus in {parsed_args.baseline_path}")
+
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,654 @@
+"""
+This file contains the RecommenderPipeline that runs the recommender in the stages
+fetch, clean, featurize, neighbours and publish.
+"""
+import json
+import logging
+from contextlib import nullcontext
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Tuple
+
+import joblib
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from ApproximateNeighbours import approximate_top_k_cosine_similarity, recall_at_k
+from BatchRecommender import get_sku_codes, select_recommendations, to_recommender_dict, to_skus
+from CandidateFilter import get_affected_rows, get_category_bitsets
+from Featurizer import FieldVectorizer, create_vectorizer, get_config_signature, get_field_fingerprints, \
+    get_vectorizer_report, get_vectorizer_signature
+from IncrementalRecommender import IncrementalState, get_watermark, merge_changed_products, update_neighbours, \
+    update_vectors
+from MagentoItemHandler import MagentoItemHandler
+from MySqlHandler import MySqlHandler
+from NeighbourIndex import write_neighbour_index
+from ParallelTopKSimilarity import parallel_top_k_cosine_similarity
+from ProductPreprocessing import clean_product_frame, get_documents, get_in_stock
+from RecommendationCodec import encode_batch
+from RunMetrics import get_row_count, profile_stage, run_metrics
+from util import get_config_file, get_root
+
+logger = logging.getLogger("RecommenderPipeline")
+
+STAGES = ("fetch", "clean", "featurize", "neighbours", "publish")
+
+# The stages whose output is the input of a stage
+STAGE_INPUTS = {"fetch": (),
+                "clean": ("fetch",),
+                "featurize": ("clean",),
+                "neighbours": ("featurize",),
+                "publish": ("featurize", "neighbours")}
+
+
+def get_product_ids(product_df: pd.DataFrame) -> np.ndarray:
+    """
+    This function returns the Magento product id per product, they identify the recommendations of a blob.
+    :param product_df:
+    :type product_df: pd.DataFrame
+    :return:
+    :rtype: np.ndarray
+    """
+    return pd.to_numeric(product_df["id"]).to_numpy(dtype=np.int64)
+
+
+class RecommenderPipeline:
+    """
+    This class runs the recommender stage by stage. Every stage takes the outputs of the previous stages
+    and returns its own output, which can be saved to and resumed from an artifact directory.
+    """
+
+    def __init__(self, recommender_config: Dict = None, db_config: Dict = None, artifact_dir=None,
+                 save_artifacts: bool = False, magento_item_handler=None, my_sql_handler=None,
+                 profile_stages: Iterable[str] = None, profiler: str = None, scope: str = None):
+        self.recommender_config = recommender_config or get_config_file("RecommenderConf.yaml")
+        self.db_config = db_config or get_config_file("DBConf.yaml")
+        self.similarity_config = self.recommender_config["similarity"]
+        self.top_k = self.similarity_config["top_k"]
+        self.candidates_k = max(self.similarity_config.get("candidates_k") or self.top_k, self.top_k)
+        self.featurizer_config = self.recommender_config.get("featurizer", {})
+        self.field_mode = self.featurizer_config.get("mode", "tfidf") == "fields"
+        self.metrics_config = self.recommender_config.get("metrics", {})
+        self.profile_stages = set(profile_stages if profile_stages is not None
+                                  else self.metrics_config.get("profile_stages") or [])
+        self.profiler = profiler or self.metrics_config.get("profiler", "cprofile")
+        self.artifact_dir = Path(artifact_dir) if artifact_dir else None
+        self.save_artifacts = save_artifacts
+        self.magento_item_handler = magento_item_handler
+        self.my_sql_handler = my_sql_handler
+        self.stage_timings = {}
+        # The store view of a multi-scope run, it is added to the stage names of the run metrics
+        self.scope = scope
+
+        incremental_config = self.recommender_config.get("incremental", {})
+        self.incremental_state = None
+        self.previous_state = None
+        if incremental_config.get("run_mode", "full") == "incremental":
+            self.incremental_state = IncrementalState(get_root() / incremental_config["state_dir"])
+            self.previous_state = self.incremental_state.load()
+            if self.previous_state is not None and (get_vectorizer_signature(self.previous_state["vectorizer"])
+                                                    != get_config_signature(self.featurizer_config)):
+                logger.info("The featurizer config changed since the last run, running a full run")
+                self.previous_state = None
+
+    def get_magento_item_handler(self):
+        """
+        This function returns the MagentoItemHandler and creates it on first use.
+        :return:
+        :rtype: MagentoItemHandler
+        """
+        if self.magento_item_handler is None:
+            self.magento_item_handler = MagentoItemHandler()
+
+        return self.magento_item_handler
+
+    def get_my_sql_handler(self):
+        """
+        This function returns the MySqlHandler and creates it on first use.
+        :return:
+        :rtype: MySqlHandler
+        """
+        if self.my_sql_handler is None:
+            self.my_sql_handler = MySqlHandler(self.db_config["user"],
+                                               self.db_config["password"],
+                                               self.db_config["database"],
+                                               self.db_config["host"],
+                                               batch_size=self.db_config.get("batch_size", 1000),
+                                               diff_mode=self.db_config.get("diff_mode", "hash"),
+                                               fetch_size=self.db_config.get("fetch_size", 10000),
+                                               pool_size=self.db_config.get("pool_size"),
+                                               storage_format=self.db_config.get("storage_format", "text"))
+
+        return self.my_sql_handler
+
+    def fetch(self) -> pd.DataFrame:
+        """
+        This function fetches the products with their attributes and qtys from Magento.
+        Incremental runs only fetch the products updated since the last run and merge them into the saved products.
+        :return:
+        :rtype: pd.DataFrame
+        """
+        magento_item_handler = self.get_magento_item_handler()
+        if self.previous_state is None:
+            product_df_raw_without_qty, qty_df = magento_item_handler.get_product_frame_and_qtys()
+        else:
+            changed_products, qty_df = magento_item_handler.get_product_frame_and_qtys(
+                updated_since=self.previous_state["watermark"])
+            product_df_raw_without_qty = merge_changed_products(self.previous_state["raw_products"],
+                                                                changed_products)
+
+        return magento_item_handler.add_qtys(product_df_raw_without_qty, qty_df)
+
+    def clean(self, product_df_raw: pd.DataFrame) -> pd.DataFrame:
+        """
+        This function removes the products that should not be recommended and builds the text per product.
+        The fields featurizer vectorizes the fields directly and needs no text.
+        :param product_df_raw:
+        :type product_df_raw: pd.DataFrame
+        :return:
+        :rtype: pd.DataFrame
+        """
+        return clean_product_frame(product_df_raw.copy(), build_text=not self.field_mode)
+
+    def featurize(self, product_df: pd.DataFrame) -> Dict:
+        """
+        This function vectorizes the text per product. The fields featurizer vectorizes the fields of the
+        product frame and its documents are fingerprints of the field values.
+        The stock mask and the category bitsets filter the candidate neighbours of the products.
+        :param product_df:
+        :type product_df: pd.DataFrame
+        :return: A dict with the keys skus, product_ids, documents, in_stock, category_ids, category_bitsets,
+            vectorizer and vectors. Incremental runs add previous_rows and changed_rows.
+        :rtype: Dict
+        """
+        documents, vectorizer_inputs = self.build_documents(product_df)
+        skus = product_df.loc[:, "sku"].to_numpy()
+        features = {"skus": skus, "product_ids": get_product_ids(product_df), "documents": documents,
+                    "in_stock": get_in_stock(product_df)}
+        features["category_ids"], features["category_bitsets"] = get_category_bitsets(product_df)
+
+        if self.previous_state is None:
+            features["vectorizer"] = create_vectorizer(**self.featurizer_config)
+            features["vectors"] = features["vectorizer"].fit_transform(
+                documents if vectorizer_inputs is None else vectorizer_inputs)
+        else:
+            features["vectorizer"] = self.previous_state["vectorizer"]
+            features["vectors"], features["previous_rows"], features["changed_rows"] = update_vectors(
+                self.previous_state, skus, documents, vectorizer_inputs)
+
+        vectorizer_report = get_vectorizer_report(features["vectorizer"], features["vectors"])
+        run_metrics.record_info(self.get_stage_name("featurizer"), vectorizer_report)
+        logger.info(f"Featurized {len(skus)} products with the {vectorizer_report['mode']} featurizer: "
+                    f"{vectorizer_report['vocabulary_size']} tokens in {vectorizer_report['vocabulary_mb']:.1f} MB, "
+                    f"vectors {vectorizer_report['vectors_mb']:.1f} MB ({vectorizer_report['dtype']})")
+
+        return features
+
+    def build_documents(self, product_df: pd.DataFrame) -> Tuple[np.ndarray, Optional[pd.DataFrame]]:
+        """
+        This function returns the documents of the products and the input of the vectorizer,
+        None if the vectorizer vectorizes the documents.
+        :param product_df:
+        :type product_df: pd.DataFrame
+        :return:
+        :rtype: Tuple[np.ndarray, Optional[pd.DataFrame]]
+        """
+        if self.field_mode:
+            return get_field_fingerprints(product_df, self.featurizer_config["fields"]), product_df
+
+        return get_documents(product_df), None
+
+    def neighbours(self, features: Dict) -> Dict:
+        """
+        This function computes the candidates_k nearest neighbours per product, the candidates of the
+        published top_k recommendations. Full runs of the ann backend search approximately and record their
+        recall@k against the exact search. Incremental runs update the changed products exactly.
+        :param features:
+        :type features: Dict
+        :return: A dict with the keys indices, scores and changed_rows, the rows whose neighbours got computed.
+        :rtype: Dict
+        """
+        k = self.candidates_k
+        block_size = self.similarity_config["block_size"]
+        max_block_mb = self.similarity_config.get("max_block_mb")
+
+        if (self.previous_state is None or features.get("previous_rows") is None) \
+                and self.similarity_config.get("backend", "exact") == "ann":
+            indices, scores = self.approximate_neighbours(features["vectors"], k, block_size, max_block_mb)
+            changed_rows = np.arange(len(features["skus"]))
+        elif self.previous_state is None or features.get("previous_rows") is None:
+            indices, scores = parallel_top_k_cosine_similarity(features["vectors"], k=k, block_size=block_size,
+                                                               max_block_mb=max_block_mb,
+                                                               n_workers=self.similarity_config.get("n_workers", 1))
+            changed_rows = np.arange(len(features["skus"]))
+        else:
+            indices, scores, changed_rows = update_neighbours(self.previous_state,
+                                                              features["vectors"],
+                                                              features["previous_rows"],
+                                                              features["changed_rows"],
+                                                              k=k,
+                                                              block_size=block_size,
+                                                              max_block_mb=max_block_mb)
+
+        return {"indices": indices, "scores": scores, "changed_rows": changed_rows}
+
+    def approximate_neighbours(self, vectors: sparse.spmatrix, k: int, block_size: int,
+                               max_block_mb: float = None):
+        """
+        This function searches the neighbours with the ann backend and records its recall@k in the run metrics.
+        :param vectors:
+        :type vectors: sparse.spmatrix
+        :param k:
+        :type k: int
+        :param block_size:
+        :type block_size: int
+        :param max_block_mb:
+        :type max_block_mb: float
+        :return: The neighbour indices and scores.
+        :rtype: Tuple[np.ndarray, np.ndarray]
+        """
+        ann_config = self.similarity_config.get("ann", {})
+        seed = ann_config.get("seed", 42)
+        indices, scores = approximate_top_k_cosine_similarity(vectors, k,
+                                                              n_components=ann_config.get("n_components", 128),
+                                                              reducer=ann_config.get("reducer", "svd"),
+                                                              n_lists=ann_config.get("n_lists"),
+                                                              n_probe=ann_config.get("n_probe", 8),
+                                                              n_candidates=ann_config.get("n_candidates"),
+                                                              seed=seed,
+                                                              block_size=block_size,
+                                                              max_block_mb=max_block_mb)
+
+        if ann_config.get("recall_samples", 1000):
+            recall = recall_at_k(vectors, indices, scores, ann_config.get("recall_samples", 1000), seed=seed,
+                                 block_size=block_size, max_block_mb=max_block_mb)
+            run_metrics.record_info(self.get_stage_name("ann"), recall)
+            logger.info(f"The ann neighbours have a recall@{recall['k']} of {recall['recall']:.3f} and "
+                        f"{recall['score_ratio']:.3f} of the exact scores on {recall['n_samples']} sampled products")
+
+        return indices, scores
+
+    def publish(self, features: Dict, neighbours: Dict) -> Dict:
+        """
+        This function writes the top_k in-stock candidates of the changed rows to the database
+        in the storage format of the MySqlHandler.
+        Incremental runs also write the rows with a candidate whose stock changed since the last run.
+        :param features:
+        :type features: Dict
+        :param neighbours:
+        :type neighbours: Dict
+        :return: The write stats of the MySqlHandler.
+        :rtype: Dict
+        """
+        self.write_index(features, neighbours)
+
+        skus = features["skus"]
+        sku_codes = get_sku_codes(skus)
+        changed_rows = neighbours["changed_rows"]
+        if self.previous_state is not None and features.get("previous_rows") is not None:
+            restocked_rows, _, _ = self.filter_stock_changes(neighbours["indices"], neighbours["scores"], skus,
+                                                             self.get_previous_in_stock(features),
+                                                             features["in_stock"], sku_codes)
+            changed_rows = np.union1d(changed_rows, restocked_rows)
+        recommended_rows, recommended_scores = select_recommendations(changed_rows, neighbours["indices"],
+                                                                      neighbours["scores"], skus, self.top_k,
+                                                                      allowed=features["in_stock"],
+                                                                      sku_codes=sku_codes)
+
+        table_name = self.db_config["table_name"]
+        my_sql_handler = self.get_my_sql_handler()
+        product_recommender_dict, product_recommender_blobs = self.get_publish_data(
+            my_sql_handler.storage_format, features, changed_rows, recommended_rows, recommended_scores)
+        my_sql_handler.create_table_if_not_exists(table_name)
+        if self.previous_state is None:
+            return my_sql_handler.publish(table_name, product_recommender_dict,
+                                          mode=self.db_config.get("publish_mode", "upsert"),
+                                          product_recommender_blobs=product_recommender_blobs)
+
+        removed_skus = np.setdiff1d(self.previous_state["skus"], skus).tolist()
+        return my_sql_handler.update_data(table_name, product_recommender_dict, removed_skus,
+                                          product_recommender_blobs)
+
+    @staticmethod
+    def get_publish_data(storage_format: str, features: Dict, rows: np.ndarray, recommended_rows: np.ndarray,
+                         recommended_scores: np.ndarray) -> Tuple[Optional[Dict], Optional[Dict]]:
+        """
+        This function returns the recommended skus per sku for the text format and the blob per sku
+        of RecommendationCodec for the binary format, both formats need both.
+        :param storage_format: text, binary or both
+        :type storage_format: str
+        :param features:
+        :type features: Dict
+        :param rows: The rows that get published.
+        :type rows: np.ndarray
+        :param recommended_rows: The output of select_recommendations for the rows.
+        :type recommended_rows: np.ndarray
+        :param recommended_scores:
+        :type recommended_scores: np.ndarray
+        :return: The recommended skus and the blobs per sku, None if the storage format does not need them.
+        :rtype: Tuple[Optional[Dict], Optional[Dict]]
+        """
+        skus = features["skus"]
+        product_recommender_dict = None
+        if storage_format != "binary":
+            product_recommender_dict = to_recommender_dict(skus[rows], to_skus(recommended_rows, skus))
+
+        product_recommender_blobs = None
+        if storage_format != "text":
+            if features.get("product_ids") is None:
+                raise ValueError("The binary storage format needs the product ids, run the featurize stage again.")
+            product_recommender_blobs = dict(zip(skus[rows].tolist(), encode_batch(
+                recommended_rows, recommended_scores, features["product_ids"])))
+
+        return product_recommender_dict, product_recommender_blobs
+
+    def get_previous_in_stock(self, features: Dict) -> np.ndarray:
+        """
+        This function returns the stock mask of the last run per product of an incremental run.
+        New products keep their current stock, their rows get computed anyway.
+        :param features:
+        :type features: Dict
+        :return:
+        :rtype: np.ndarray
+        """
+        previous_rows = features["previous_rows"]
+        known = previous_rows >= 0
+        previous_in_stock = features["in_stock"].copy()
+        previous_in_stock[known] = self.previous_state["in_stock"][previous_rows[known]]
+
+        return previous_in_stock
+
+    def filter_stock_changes(self, indices: np.ndarray, scores: np.ndarray, skus: np.ndarray,
+                             previous_in_stock: np.ndarray, in_stock: np.ndarray,
+                             sku_codes: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        This function returns the rows whose recommendations changed with the stock and the rows and scores
+        of their new recommendations.
+        Only the rows with a candidate whose stock changed get filtered with both stock masks.
+        :param indices: The candidate neighbours of all products.
+        :type indices: np.ndarray
+        :param scores:
+        :type scores: np.ndarray
+        :param skus:
+        :type skus: np.ndarray
+        :param previous_in_stock:
+        :type previous_in_stock: np.ndarray
+        :param in_stock:
+        :type in_stock: np.ndarray
+        :param sku_codes: The output of BatchRecommender.get_sku_codes for the skus.
+        :type sku_codes: np.ndarray
+        :return:
+        :rtype: Tuple[np.ndarray, np.ndarray, np.ndarray]
+        """
+        if sku_codes is None:
+            sku_codes = get_sku_codes(skus)
+        affected_rows = get_affected_rows(indices, previous_in_stock != in_stock)
+        previous_rows, _ = select_recommendations(affected_rows, indices, scores, skus, self.top_k,
+                                                  allowed=previous_in_stock, sku_codes=sku_codes)
+        recommended_rows, recommended_scores = select_recommendations(affected_rows, indices, scores, skus,
+                                                                      self.top_k, allowed=in_stock,
+                                                                      sku_codes=sku_codes)
+        changed = (previous_rows != recommended_rows).any(axis=1)
+        logger.info(f"{int(np.count_nonzero(previous_in_stock != in_stock))} products changed their stock, "
+                    f"the recommendations of {int(np.count_nonzero(changed))} products changed")
+
+        return affected_rows[changed], recommended_rows[changed], recommended_scores[changed]
+
+    def refresh_stock(self) -> Dict:
+        """
+        This function republishes the recommendations after a stock change without a new similarity search.
+        Only the qtys are fetched, the stock mask of the saved products is recomputed and the saved candidates
+        are filtered again. Only the rows whose recommendations changed are written. It needs the saved state
+        of an incremental run, status changes update updated_at and are handled by the next incremental run.
+        :return: The write stats of the MySqlHandler.
+        :rtype: Dict
+        """
+        if self.previous_state is None:
+            raise ValueError("The stock refresh needs the saved state of a previous incremental run.")
+
+        run_metrics.reset()
+        with run_metrics.measure_stage("refresh_stock") as stage_metrics:
+            state = self.previous_state
+            magento_item_handler = self.get_magento_item_handler()
+            product_df_raw = magento_item_handler.add_qtys(state["raw_products"], magento_item_handler.get_qtys())
+            product_df = clean_product_frame(product_df_raw, build_text=False)
+            skus = state["skus"]
+            if not np.array_equal(product_df["sku"].to_numpy(), skus):
+                raise ValueError("The saved products do not match the saved neighbours, run the pipeline again.")
+
+            in_stock = get_in_stock(product_df)
+            indices = state["neighbour_indices"]
+            scores = state["neighbour_scores"]
+            changed_rows, recommended_rows, recommended_scores = self.filter_stock_changes(
+                indices, scores, skus, state["in_stock"], in_stock)
+
+            features = {"skus": skus, "product_ids": get_product_ids(product_df), "in_stock": in_stock}
+            features["category_ids"], features["category_bitsets"] = get_category_bitsets(product_df)
+            self.write_index(features, {"indices": indices, "scores": scores})
+
+            my_sql_handler = self.get_my_sql_handler()
+            table_name = self.db_config["table_name"]
+            product_recommender_dict, product_recommender_blobs = self.get_publish_data(
+                my_sql_handler.storage_format, features, changed_rows, recommended_rows, recommended_scores)
+            my_sql_handler.create_table_if_not_exists(table_name)
+            stats = my_sql_handler.update_data(table_name, product_recommender_dict, [], product_recommender_blobs)
+            self.incremental_state.save_in_stock(in_stock)
+            stage_metrics["rows"] = len(changed_rows)
+        self.stage_timings["refresh_stock"] = stage_metrics["wall_time_seconds"]
+        self.write_metrics()
+
+        return stats
+
+    def write_index(self, features: Dict, neighbours: Dict):
+        """
+        This function writes the memory-mapped neighbour index of all products if an index path is configured.
+        :param features:
+        :type features: Dict
+        :param neighbours:
+        :type neighbours: Dict
+        :return:
+        :rtype:
+        """
+        index_config = self.recommender_config.get("neighbour_index", {})
+        if not index_config.get("path"):
+            return
+
+        write_neighbour_index(get_root() / index_config["path"],
+                              features["skus"],
+                              neighbours["indices"],
+                              neighbours["scores"],
+                              score_dtype=index_config.get("score_dtype", "float16"),
+                              in_stock=features.get("in_stock"),
+                              category_ids=features.get("category_ids"),
+                              category_bitsets=features.get("category_bitsets"))
+
+    def save_artifact(self, stage: str, output):
+        """
+        This function saves the output of a stage to the artifact directory.
+        :param stage:
+        :type stage: str
+        :param output:
+        :type output:
+        :return:
+        :rtype:
+        """
+        self.artifact_dir.mkdir(parents=True, exist_ok=True)
+        if stage == "fetch":
+            output.to_parquet(self.artifact_dir / "raw_products.parquet")
+        elif stage == "clean":
+            output.to_parquet(self.artifact_dir / "products.parquet")
+        elif stage == "featurize":
+            pd.DataFrame({"sku": output["skus"], "product_id": output["product_ids"], "document": output["documents"],
+                          "in_stock": output["in_stock"]}).to_parquet(self.artifact_dir / "documents.parquet")
+            sparse.save_npz(self.artifact_dir / "vectors.npz", sparse.csr_matrix(output["vectors"]))
+            np.savez(self.artifact_dir / "categories.npz",
+                     category_ids=output["category_ids"],
+                     category_bitsets=output["category_bitsets"])
+            joblib.dump(output["vectorizer"], self.artifact_dir / "vectorizer.joblib")
+            if output.get("previous_rows") is not None:
+                np.savez(self.artifact_dir / "feature_rows.npz",
+                         previous_rows=output["previous_rows"],
+                         changed_rows=output["changed_rows"])
+        elif stage == "neighbours":
+            np.savez(self.artifact_dir / "neighbours.npz", **output)
+        elif stage == "publish":
+            with open(self.artifact_dir / "publish.json", "w", encoding="utf8") as publish_file:
+                json.dump(output, publish_file)
+
+    def load_artifact(self, stage: str):
+        """
+        This function loads the saved output of a stage from the artifact directory.
+        :param stage:
+        :type stage: str
+        :return:
+        :rtype:
+        """
+        if self.artifact_dir is None:
+            raise ValueError(f"The output of the stage <{stage}> is needed but no artifact directory is set.")
+
+        logger.info(f"Loading the output of <{stage}> from <{self.artifact_dir}>")
+        if stage == "fetch":
+            return pd.read_parquet(self.artifact_dir / "raw_products.parquet")
+        if stage == "clean":
+            return pd.read_parquet(self.artifact_dir / "products.parquet")
+        if stage == "featurize":
+            documents = pd.read_parquet(self.artifact_dir / "documents.parquet")
+            features = {"skus": documents["sku"].to_numpy(),
+                        "product_ids": documents["product_id"].to_numpy() if "product_id" in documents else None,
+                        "documents": documents["document"].to_numpy(dtype=str),
+                        "in_stock": documents["in_stock"].to_numpy(dtype=bool),
+                        "vectors": sparse.load_npz(self.artifact_dir / "vectors.npz").tocsr(),
+                        "vectorizer": joblib.load(self.artifact_dir / "vectorizer.joblib")}
+            if (self.artifact_dir / "categories.npz").exists():
+                features.update(np.load(self.artifact_dir / "categories.npz"))
+            if (self.artifact_dir / "feature_rows.npz").exists():
+                features.update(np.load(self.artifact_dir / "feature_rows.npz"))
+            return self.apply_field_weights(features)
+        if stage == "neighbours":
+            return dict(np.load(self.artifact_dir / "neighbours.npz"))
+
+        raise ValueError(f"The stage <{stage}> has no artifact.")
+
+    def apply_field_weights(self, features: Dict) -> Dict:
+        """
+        This function rescales the vectors of a loaded fields featurizer to the configured field weights,
+        so the weights can be tuned by running the stages from neighbours on without tokenizing again.
+        :param features:
+        :type features: Dict
+        :return:
+        :rtype: Dict
+        """
+        vectorizer = features["vectorizer"]
+        if not isinstance(vectorizer, FieldVectorizer) or not self.field_mode:
+            return features
+
+        weights = {field["column"]: float(field.get("weight", 1.0)) for field in self.featurizer_config["fields"]}
+        if [field["column"] for field in vectorizer.fields] != list(weights):
+            raise ValueError("The fields of the featurize artifact differ from the configured fields, "
+                             "run the featurize stage again.")
+        if list(weights.values()) != vectorizer.get_weights():
+            logger.info(f"Rescaling the loaded vectors to the field weights {weights}")
+            features["vectors"] = vectorizer.reweight(features["vectors"], list(weights.values()))
+
+        return features
+
+    def run(self, stages: Iterable[str] = STAGES) -> Dict:
+        """
+        This function runs the given stages in pipeline order. Inputs that were not computed in this run
+        are loaded from the artifact directory. After a complete incremental run the state gets saved.
+        :param stages:
+        :type stages: Iterable[str]
+        :return: The output per stage.
+        :rtype: Dict
+        """
+        run_metrics.reset()
+        outputs = self.run_stages(stages)
+
+        if self.incremental_state is not None and "publish" in outputs:
+            self.save_incremental_state(outputs)
+
+        self.write_metrics()
+
+        return outputs
+
+    def run_stages(self, stages: Iterable[str], outputs: Dict = None) -> Dict:
+        """
+        This function runs the given stages in pipeline order and measures every stage in the run metrics.
+        Inputs that are neither given nor computed in this run are loaded from the artifact directory.
+        :param stages:
+        :type stages: Iterable[str]
+        :param outputs: Outputs of earlier stages, e.g. the shared clean frame of a multi-scope run.
+        :type outputs: Dict
+        :return: The given outputs and the output per stage.
+        :rtype: Dict
+        """
+        stages = [stage for stage in STAGES if stage in set(stages)]
+        outputs = dict(outputs or {})
+        for stage in stages:
+            inputs = []
+            for input_stage in STAGE_INPUTS[stage]:
+                if input_stage not in outputs:
+                    outputs[input_stage] = self.load_artifact(input_stage)
+                inputs.append(outputs[input_stage])
+
+            stage_name = self.get_stage_name(stage)
+            logger.info(f"Running stage <{stage_name}>")
+            profile_context = nullcontext()
+            if stage in self.profile_stages:
+                profile_context = profile_stage(stage_name, self.profiler,
+                                                get_root() / self.metrics_config.get("profile_dir", "profiles"))
+            with run_metrics.measure_stage(stage_name) as stage_metrics, profile_context:
+                outputs[stage] = getattr(self, stage)(*inputs)
+                stage_metrics["rows"] = get_row_count(outputs[stage])
+            self.stage_timings[stage] = stage_metrics["wall_time_seconds"]
+            peak_rss = "" if stage_metrics["peak_rss_mb"] is None else \
+                f" with a peak RSS of {stage_metrics['peak_rss_mb']:.0f} MB"
+            logger.info(f"Stage <{stage_name}> took {self.stage_timings[stage]:.2f}s{peak_rss}")
+
+            if self.save_artifacts and self.artifact_dir is not None:
+                self.save_artifact(stage, outputs[stage])
+
+        return outputs
+
+    def get_stage_name(self, stage: str) -> str:
+        """
+        This function returns the name of a stage in the run metrics, stages of a store view end with [store_code].
+        :param stage:
+        :type stage: str
+        :return:
+        :rtype: str
+        """
+        return stage if self.scope is None else f"{stage}[{self.scope}]"
+
+    def write_metrics(self):
+        """
+        This function writes the run report and the Prometheus textfile if their paths are configured.
+        Relative paths are resolved against the package root.
+        :return:
+        :rtype:
+        """
+        if self.metrics_config.get("report_path"):
+            run_metrics.write_report(get_root() / self.metrics_config["report_path"])
+        if self.metrics_config.get("prometheus_path"):
+            run_metrics.write_prometheus_textfile(get_root() / self.metrics_config["prometheus_path"])
+
+    def save_incremental_state(self, outputs: Dict):
+        """
+        This function saves the state for the next incremental run.
+        :param outputs:
+        :type outputs: Dict
+        :return:
+        :rtype:
+        """
+        product_df_raw = outputs["fetch"] if "fetch" in outputs else self.load_artifact("fetch")
+        previous_watermark = None if self.previous_state is None else self.previous_state["watermark"]
+        features = outputs["featurize"]
+        neighbours = outputs["neighbours"]
+        self.incremental_state.save(get_watermark(product_df_raw, previous_watermark),
+                                    product_df_raw.drop(columns="qty"),
+                                    features["skus"],
+                                    features["documents"],
+                                    features["in_stock"],
+                                    features["vectorizer"],
+                                    features["vectors"],
+                                    neighbours["indices"],
+                                    neighbours["scores"])
@@ -0,0 +1,339 @@
+"""
+This file collects the metrics of a recommender run: wall time, peak RSS and rows per stage,
+requests and bytes per Magento endpoint and statements and rows per MySQL statement type.
+The metrics are written to a JSON report and optionally to a Prometheus textfile.
+"""
+import cProfile
+import json
+import logging
+import os
+import pstats
+import resource
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, Optional
+
+logger = logging.getLogger("RunMetrics")
+
+PROFILERS = ("cprofile", "tracemalloc")
+
+
+def read_peak_rss_mb() -> float:
+    """
+    This function returns the peak resident set size of this process in MB.
+    :return:
+    :rtype: float
+    """
+    try:
+        with open("/proc/self/status", encoding="utf8") as status_file:
+            for line in status_file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+
+    # ru_maxrss is in KB on Linux and can not be reset
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def reset_peak_rss():
+    """
+    This function resets the peak resident set size on Linux, so it can be measured per stage.
+    On other systems the peak of the whole run is reported.
+    :return:
+    :rtype:
+    """
+    try:
+        with open("/proc/self/clear_refs", "w", encoding="utf8") as clear_refs_file:
+            clear_refs_file.write("5")
+    except OSError:
+        pass
+
+
+def get_row_count(output) -> Optional[int]:
+    """
+    This function returns the number of rows of a stage output.
+    :param output: A frame, a dict with skus or indices or the publish stats.
+    :type output:
+    :return: None if the output has no rows.
+    :rtype: Optional[int]
+    """
+    if hasattr(output, "shape"):
+        return int(output.shape[0])
+    if isinstance(output, dict):
+        if "skus" in output:
+            return len(output["skus"])
+        if "indices" in output:
+            return len(output["indices"])
+        if "rows_upserted" in output:
+            return output["rows_upserted"] + output["rows_deleted"]
+
+    return None
+
+
+class RunMetrics:
+    """
+    This class collects the metrics of one run. It is thread safe, so the Magento handlers
+    can record their requests from the download threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.n_open_stages = 0
+        self.stages = {}
+        self.http = {}
+        self.mysql = {}
+        self.info = {}
+        self.started_at = time.time()
+
+    def reset(self):
+        """
+        This function removes all collected metrics.
+        :return:
+        :rtype:
+        """
+        with self.lock:
+            self.stages = {}
+            self.http = {}
+            self.mysql = {}
+            self.info = {}
+            self.started_at = time.time()
+
+    @contextmanager
+    def measure_stage(self, stage: str) -> Iterator[Dict]:
+        """
+        This function measures the wall time and the peak RSS of the stage in the with block.
+        The caller can set the rows of the yielded dict.
+        The peak RSS belongs to the whole process, so it is only reset by a stage that starts while no other stage
+        is open. Stages that start inside another stage, e.g. the concurrent store views of a multi-scope run,
+        get no peak RSS of their own, the enclosing stage has the peak of all of them.
+        :param stage:
+        :type stage: str
+        :return:
+        :rtype: Iterator[Dict]
+        """
+        stage_metrics = {"rows": None}
+        with self.lock:
+            is_nested = self.n_open_stages > 0
+            self.n_open_stages += 1
+            if not is_nested:
+                reset_peak_rss()
+        start_time = time.perf_counter()
+        try:
+            yield stage_metrics
+        finally:
+            stage_metrics["wall_time_seconds"] = time.perf_counter() - start_time
+            stage_metrics["peak_rss_mb"] = None if is_nested else read_peak_rss_mb()
+            stage_metrics["peak_rss_children_mb"] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+            with self.lock:
+                self.n_open_stages -= 1
+                self.stages[stage] = stage_metrics
+
+    def record_http(self, endpoint: str, n_bytes: int, status_code: int, seconds: float):
+        """
+        This function counts one response of a Magento endpoint.
+        :param endpoint: The url path without the base url and query.
+        :type endpoint: str
+        :param n_bytes:
+        :type n_bytes: int
+        :param status_code:
+        :type status_code: int
+        :param seconds:
+        :type seconds: float
+        :return:
+        :rtype:
+        """
+        with self.lock:
+            endpoint_metrics = self.http.setdefault(endpoint, {"requests": 0, "bytes": 0, "errors": 0,
+                                                               "not_modified": 0, "cache_hits": 0, "seconds": 0.0})
+            endpoint_metrics["requests"] += 1
+            endpoint_metrics["bytes"] += n_bytes
+            endpoint_metrics["seconds"] += seconds
+            if status_code == 304:
+                endpoint_metrics["not_modified"] += 1
+            elif status_code >= 400:
+                endpoint_metrics["errors"] += 1
+
+    def record_http_cache_hit(self, endpoint: str):
+        """
+        This function counts a response that was served from the on-disk cache without a request.
+        :param endpoint:
+        :type endpoint: str
+        :return:
+        :rtype:
+        """
+        with self.lock:
+            endpoint_metrics = self.http.setdefault(endpoint, {"requests": 0, "bytes": 0, "errors": 0,
+                                                               "not_modified": 0, "cache_hits": 0, "seconds": 0.0})
+            endpoint_metrics["cache_hits"] += 1
+
+    def record_sql(self, statement_type: str, n_rows: int, seconds: float):
+        """
+        This function counts one executed MySQL statement.
+        :param statement_type: The first keyword of the statement, e.g. INSERT.
+        :type statement_type: str
+        :param n_rows: The rows sent or affected by the statement.
+        :type n_rows: int
+        :param seconds:
+        :type seconds: float
+        :return:
+        :rtype:
+        """
+        with self.lock:
+            statement_metrics = self.mysql.setdefault(statement_type, {"statements": 0, "rows": 0, "seconds": 0.0})
+            statement_metrics["statements"] += 1
+            statement_metrics["rows"] += n_rows
+            statement_metrics["seconds"] += seconds
+
+    def record_info(self, name: str, values: Dict):
+        """
+        This function stores additional values of the run under a name, e.g. the featurizer report.
+        :param name:
+        :type name: str
+        :param values:
+        :type values: Dict
+        :return:
+        :rtype:
+        """
+        with self.lock:
+            self.info[name] = dict(values)
+
+    def get_report(self) -> Dict:
+        """
+        This function returns all metrics as a json serializable dict.
+        :return:
+        :rtype: Dict
+        """
+        with self.lock:
+            return {"started_at": self.started_at,
+                    "finished_at": time.time(),
+                    "stages": {stage: dict(values) for stage, values in self.stages.items()},
+                    "http": {endpoint: dict(values) for endpoint, values in self.http.items()},
+                    "mysql": {statement: dict(values) for statement, values in self.mysql.items()},
+                    "info": {name: dict(values) for name, values in self.info.items()}}
+
+    def write_report(self, path):
+        """
+        This function writes the json run report.
+        :param path:
+        :type path:
+        :return:
+        :rtype:
+        """
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w", encoding="utf8") as report_file:
+            json.dump(self.get_report(), report_file, indent=2)
+        logger.info(f"Wrote the run report to <{path}>")
+
+    def get_prometheus_text(self) -> str:
+        """
+        This function returns the metrics in the Prometheus text exposition format.
+        :return:
+        :rtype: str
+        """
+        report = self.get_report()
+        metrics = [("recommender_stage_wall_time_seconds", "gauge", "Wall time per stage.",
+                    "stage", report["stages"], "wall_time_seconds"),
+                   ("recommender_stage_peak_rss_bytes", "gauge", "Peak resident set size per stage.",
+                    "stage", report["stages"], "peak_rss_mb"),
+                   ("recommender_stage_rows", "gauge", "Output rows per stage.",
+                    "stage", report["stages"], "rows"),
+                   ("recommender_http_requests_total", "counter", "Magento requests per endpoint.",
+                    "endpoint", report["http"], "requests"),
+                   ("recommender_http_response_bytes_total", "counter", "Magento response bytes per endpoint.",
+                    "endpoint", report["http"], "bytes"),
+                   ("recommender_http_errors_total", "counter", "Magento error responses per endpoint.",
+                    "endpoint", report["http"], "errors"),
+                   ("recommender_http_cache_hits_total", "counter", "Magento responses served from the cache.",
+                    "endpoint", report["http"], "cache_hits"),
+                   ("recommender_mysql_statements_total", "counter", "MySQL statements per statement type.",
+                    "statement", report["mysql"], "statements"),
+                   ("recommender_mysql_rows_total", "counter", "MySQL rows per statement type.",
+                    "statement", report["mysql"], "rows")]
+
+        lines = []
+        for name, metric_type, help_text, label, values, key in metrics:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for label_value, value in values.items():
+                if value.get(key) is None:
+                    continue
+                number = value[key] * 1024 * 1024 if key == "peak_rss_mb" else value[key]
+                escaped_label_value = label_value.replace("\\", "\\\\").replace('"', '\\"')
+                lines.append(f'{name}{{{label}="{escaped_label_value}"}} {number}')
+        lines.append("# HELP recommender_last_run_timestamp_seconds End of the last run.")
+        lines.append("# TYPE recommender_last_run_timestamp_seconds gauge")
+        lines.append(f"recommender_last_run_timestamp_seconds {report['finished_at']}")
+
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus_textfile(self, path):
+        """
+        This function writes the metrics for the node exporter textfile collector.
+        The file is renamed into place, so the collector never reads a partial file.
+        :param path:
+        :type path:
+        :return:
+        :rtype:
+        """
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "w", encoding="utf8") as prometheus_file:
+            prometheus_file.write(self.get_prometheus_text())
+        os.replace(tmp_path, path)
+        logger.info(f"Wrote the Prometheus metrics to <{path}>")
+
+
+@contextmanager
+def profile_stage(stage: str, profiler: str, profile_dir):
+    """
+    This function profiles the with block with cProfile or tracemalloc and writes the result to the profile directory.
+    cProfile writes <stage>.prof, which can be opened with pstats or snakeviz, and a <stage>.txt summary.
+    tracemalloc writes the 25 lines with the most allocated memory to <stage>_tracemalloc.txt.
+    :param stage:
+    :type stage: str
+    :param profiler: cprofile or tracemalloc
+    :type profiler: str
+    :param profile_dir:
+    :type profile_dir:
+    :return:
+    :rtype:
+    """
+    if profiler not in PROFILERS:
+        raise ValueError(f"Unknown profiler <{profiler}>, use one of {PROFILERS}.")
+
+    profile_dir = Path(profile_dir)
+    profile_dir.mkdir(parents=True, exist_ok=True)
+    if profiler == "cprofile":
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            profile.dump_stats(profile_dir / f"{stage}.prof")
+            with open(profile_dir / f"{stage}.txt", "w", encoding="utf8") as summary_file:
+                pstats.Stats(profile, stream=summary_file).sort_stats("cumulative").print_stats(40)
+            logger.info(f"Wrote the cProfile stats of <{stage}> to <{profile_dir}>")
+    else:
+        tracemalloc.start()
+        try:
+            yield
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            with open(profile_dir / f"{stage}_tracemalloc.txt", "w", encoding="utf8") as summary_file:
+                summary_file.write(f"current {current / 1024 / 1024:.1f} MB, peak {peak / 1024 / 1024:.1f} MB\n")
+                for statistic in snapshot.statistics("lineno")[:25]:
+                    summary_file.write(f"{statistic}\n")
+            logger.info(f"Wrote the tracemalloc stats of <{stage}> to <{profile_dir}>")
+
+
+# The metrics of the current run, shared by the pipeline and the Magento and MySQL handlers
+run_metrics = RunMetrics()
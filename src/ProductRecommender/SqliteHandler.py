@@ -0,0 +1,135 @@
+"""
+This file contains a SQLite stand-in of the MySqlHandler for benchmarks and local runs without a MySQL server.
+The MySQL statements of the MySqlHandler are translated to SQLite.
+"""
+import hashlib
+import re
+import sqlite3
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+from MySqlHandler import MySqlHandler
+from RunMetrics import run_metrics
+
+
+def md5_hex(value):
+    """
+    This function computes the MD5 of a text or blob value like the MD5 function of MySQL.
+    :param value:
+    :type value:
+    :return:
+    :rtype: str
+    """
+    if value is None:
+        return None
+
+    return hashlib.md5(value if isinstance(value, bytes) else str(value).encode("utf8")).hexdigest()
+
+
+def concat(*values):
+    """
+    This function concatenates text values like the CONCAT function of MySQL, a NULL value makes the result NULL.
+    :param values:
+    :type values:
+    :return:
+    :rtype: str
+    """
+    if any(value is None for value in values):
+        return None
+
+    return "".join(str(value) for value in values)
+
+
+class SqliteHandler(MySqlHandler):
+    """
+    This class writes the recommendations to a SQLite database file instead of MySQL.
+    """
+
+    def __init__(self, database_path=":memory:", batch_size=1000, diff_mode="hash", fetch_size=10000,
+                 storage_format="text"):
+        super(SqliteHandler, self).__init__(None, None, str(database_path), None, batch_size=batch_size,
+                                            diff_mode=diff_mode, fetch_size=fetch_size, storage_format=storage_format)
+
+    def get_connection(self):
+        """
+        This function opens the SQLite database and adds the MySQL functions MD5, UNHEX and CONCAT.
+        :return:
+        :rtype:
+        """
+        connection = sqlite3.connect(self.db_name, check_same_thread=False)
+        connection.create_function("MD5", 1, md5_hex, deterministic=True)
+        connection.create_function("UNHEX", 1, lambda value: None if value is None else bytes.fromhex(value),
+                                   deterministic=True)
+        connection.create_function("CONCAT", -1, concat, deterministic=True)
+
+        return connection
+
+    @contextmanager
+    def open_stream_cursor(self) -> Iterator:
+        """
+        This function yields a cursor of the database, SQLite cursors always step through the result rows.
+        :return:
+        :rtype: Iterator
+        """
+        cursor = self.connection.cursor()
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+
+    def get_table_columns(self, table):
+        """
+        This function returns the column names of a table.
+        :param table:
+        :type table:
+        :return:
+        :rtype: List[str]
+        """
+        return [row[1] for row in self.execute(f"PRAGMA table_info({table})", fetch=True)]
+
+    @staticmethod
+    def translate(sql: str) -> str:
+        """
+        This function translates the MySQL statements of the MySqlHandler to SQLite.
+        :param sql:
+        :type sql: str
+        :return:
+        :rtype: str
+        """
+        sql = sql.replace("%s", "?")
+        sql = sql.replace("ON DUPLICATE KEY UPDATE", "ON CONFLICT(sku) DO UPDATE SET")
+        sql = re.sub(r"VALUES\((\w+)\)", r"excluded.\1", sql)
+        rename = re.fullmatch(r"RENAME TABLE (\w+) TO (\w+), (\w+) TO (\w+)", sql)
+        if rename:
+            sql = (f"ALTER TABLE {rename.group(1)} RENAME TO {rename.group(2)}; "
+                   f"ALTER TABLE {rename.group(3)} RENAME TO {rename.group(4)}")
+
+        return sql
+
+    def execute(self, sql, params=None, n_rows=0, fetch=False):
+        """
+        This function executes a translated statement and counts it in the run metrics.
+        :param sql:
+        :type sql: str
+        :param params:
+        :type params:
+        :param n_rows:
+        :type n_rows: int
+        :param fetch:
+        :type fetch: bool
+        :return:
+        :rtype:
+        """
+        start_time = time.perf_counter()
+        sqlite_sql = self.translate(sql)
+        if ";" in sqlite_sql:
+            self.cursor.executescript(sqlite_sql)
+        else:
+            self.cursor.execute(sqlite_sql, params or ())
+        result = self.cursor.fetchall() if fetch else None
+        run_metrics.record_sql(sql.split(None, 1)[0].upper(),
+                               len(result) if fetch else n_rows or max(self.cursor.rowcount, 0),
+                               time.perf_counter() - start_time)
+
+        return result
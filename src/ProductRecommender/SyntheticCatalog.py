@@ -0,0 +1,377 @@
+"""
+This file generates synthetic Magento catalogs for benchmarks.
+The attributes follow conf/MagentoAttributeConf.yaml, the skus follow the esg sku pattern
+<brand>-<sparte>-<group> for configurables and <brand>-<sparte>-<group>-<variant> for their simples,
+and the products reference the leaves of a generated category tree.
+Store views other than all get a translated text, every token gets the store code as suffix.
+Only compact numpy arrays are kept per product, the Magento items are built when a page gets requested.
+"""
+import copy
+import logging
+import re
+from datetime import datetime, timedelta
+from typing import Dict, List
+
+import numpy as np
+
+from util import get_config_file
+
+logger = logging.getLogger("SyntheticCatalog")
+
+SYLLABLES = ["ka", "ri", "mo", "la", "te", "su", "no", "vi", "ge", "pa", "lo", "mi", "da", "ne", "ro", "si"]
+TOP_LEVEL_FIELDS = ("sku", "name", "price", "weight")
+UPDATED_AT_FORMAT = "%Y-%m-%d %H:%M:%S"
+DEFAULT_STORE_CODE = "all"
+# The tokens of the TfidfVectorizer, translating them one by one keeps the similarities of the products
+TOKEN_PATTERN = re.compile(r"(?u)\b\w\w+\b")
+
+
+def make_words(n_words: int, rng: np.random.Generator) -> List[str]:
+    """
+    This function returns n distinct pronounceable words.
+    :param n_words:
+    :type n_words: int
+    :param rng:
+    :type rng: np.random.Generator
+    :return:
+    :rtype: List[str]
+    """
+    n_syllables = max(2, int(np.ceil(np.log(4 * n_words) / np.log(len(SYLLABLES)))))
+    words = []
+    for word_id in rng.choice(len(SYLLABLES) ** n_syllables, n_words, replace=False):
+        syllables = []
+        for _ in range(n_syllables):
+            word_id, syllable = divmod(int(word_id), len(SYLLABLES))
+            syllables.append(SYLLABLES[syllable])
+        words.append("".join(syllables))
+
+    return words
+
+
+def localize_text(text: str, store_code: str = None) -> str:
+    """
+    This function translates a text to a store view by appending the store code to every token.
+    :param text:
+    :type text: str
+    :param store_code: The text is not changed for None and all.
+    :type store_code: str
+    :return:
+    :rtype: str
+    """
+    if not store_code or store_code == DEFAULT_STORE_CODE:
+        return text
+
+    return TOKEN_PATTERN.sub(lambda match: match.group(0) + store_code, text)
+
+
+class SyntheticCatalog:
+    """
+    This class generates a reproducible catalog with n_skus products and answers the Magento endpoints from it.
+    """
+
+    def __init__(self, n_skus: int, seed: int = 42, n_options: int = 12, n_extra_attributes: int = 15,
+                 configurable_share: float = 0.3, disabled_share: float = 0.05, out_of_stock_share: float = 0.1,
+                 attribute_conf: Dict = None):
+        self.n_skus = n_skus
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+        self.attribute_conf = attribute_conf or get_config_file("MagentoAttributeConf.yaml")
+        self.base_time = datetime(2022, 1, 1)
+
+        self.attributes = self.make_attributes(n_options)
+        self.categories, self.leaf_category_ids = self.make_categories()
+        self.extra_attribute_codes = list(self.rng.choice(
+            [code for code in self.attributes if code not in self.text_attribute_codes()],
+            size=min(n_extra_attributes, len(self.attributes) - len(self.text_attribute_codes())), replace=False))
+        self.make_products(configurable_share, disabled_share, out_of_stock_share)
+        logger.info(f"Generated a catalog with {self.n_skus} products in {self.group_ids.max() + 1} groups")
+
+    @staticmethod
+    def text_attribute_codes() -> List[str]:
+        """
+        This function returns the attributes that build the text of a product in ProductPreprocessing.
+        :return:
+        :rtype: List[str]
+        """
+        return ["short_description", "esg_hersteller", "esg_produktgruppe", "esg_farben", "esg_produktsparte",
+                "esg_product_name_keywords", "category_ids"]
+
+    def make_attributes(self, n_options: int) -> Dict[str, Dict]:
+        """
+        This function builds the attributes of the attribute conf with generated options
+        for the select and multiselect attributes.
+        :param n_options: Number of options per select and multiselect attribute.
+        :type n_options: int
+        :return: The Magento attribute per attribute code.
+        :rtype: Dict[str, Dict]
+        """
+        specs = [spec for group in self.attribute_conf["attribute_codes"].values() for spec in group.values()]
+        specs.append({"attribute_code": "short_description", "frontend_input": "textarea",
+                      "default_frontend_label": "Short Description"})
+        specs.append({"attribute_code": "category_ids", "frontend_input": "text",
+                      "default_frontend_label": "Categories"})
+        option_counts = {"esg_hersteller": 4 * n_options ** 2 // 3, "esg_produktgruppe": 5 * n_options,
+                         "esg_farben": 2 * n_options, "esg_produktsparte": n_options // 2}
+
+        attributes = {}
+        next_option_id = 1000
+        for spec in specs:
+            attribute_code = spec.get("attribute_code")
+            if not attribute_code or not spec.get("frontend_input") or attribute_code in TOP_LEVEL_FIELDS:
+                continue
+            attribute = {"attribute_code": attribute_code,
+                         "frontend_input": spec["frontend_input"],
+                         "default_frontend_label": spec.get("default_frontend_label", attribute_code)}
+            if spec["frontend_input"] in ("select", "multiselect"):
+                n_attribute_options = option_counts.get(attribute_code, n_options)
+                words = make_words(n_attribute_options, self.rng)
+                attribute["options"] = [{"label": " ", "value": ""}] + [
+                    {"label": word.capitalize(), "value": str(next_option_id + i)} for i, word in enumerate(words)]
+                next_option_id += n_attribute_options
+            attributes[attribute_code] = attribute
+
+        return attributes
+
+    def make_categories(self, n_top: int = 8, n_children: int = 6, n_leaves: int = 5):
+        """
+        This function builds a category tree with three levels below the default category.
+        :param n_top:
+        :type n_top: int
+        :param n_children:
+        :type n_children: int
+        :param n_leaves:
+        :type n_leaves: int
+        :return: The categories response and the leaf category ids.
+        :rtype: Tuple[Dict, np.ndarray]
+        """
+        words = make_words(n_top + n_top * n_children + n_top * n_children * n_leaves, self.rng)
+        next_id = iter(range(3, 3 + len(words)))
+        next_word = iter(words)
+        leaf_ids = []
+
+        def make_category(level: int, children: List[Dict]) -> Dict:
+            return {"id": next(next_id), "parent_id": 0, "name": next(next_word).capitalize(), "is_active": True,
+                    "level": level, "product_count": 0, "children_data": children}
+
+        top_categories = []
+        for _ in range(n_top):
+            child_categories = []
+            for _ in range(n_children):
+                leaves = [make_category(4, []) for _ in range(n_leaves)]
+                leaf_ids.extend(leaf["id"] for leaf in leaves)
+                child_categories.append(make_category(3, leaves))
+            top_categories.append(make_category(2, child_categories))
+
+        default_category = {"id": 2, "parent_id": 1, "name": "Default Category", "is_active": True, "level": 1,
+                            "product_count": 0, "children_data": top_categories}
+        categories = {"id": 1, "parent_id": 0, "name": "Root Catalog", "is_active": True, "level": 0,
+                      "product_count": 0, "children_data": [default_category]}
+
+        return categories, np.array(leaf_ids)
+
+    def make_products(self, configurable_share: float, disabled_share: float, out_of_stock_share: float):
+        """
+        This function draws the arrays that describe every product.
+        Configurables are followed by their 2 to 6 simples, which share the brand, group and category.
+        :param configurable_share: Share of the groups that are configurables.
+        :type configurable_share: float
+        :param disabled_share:
+        :type disabled_share: float
+        :param out_of_stock_share:
+        :type out_of_stock_share: float
+        :return:
+        :rtype:
+        """
+        rng = self.rng
+        n_skus = self.n_skus
+
+        is_configurable_group = rng.random(n_skus) < configurable_share
+        group_sizes = np.where(is_configurable_group, rng.integers(3, 8, n_skus), 1)
+        group_starts = np.concatenate([[0], np.cumsum(group_sizes)])
+        n_groups = int(np.searchsorted(group_starts, n_skus, side="left"))
+        group_starts = group_starts[:n_groups]
+        self.group_ids = np.repeat(np.arange(n_groups), group_sizes[:n_groups])[:n_skus]
+        self.variants = np.arange(n_skus) - group_starts[self.group_ids]
+        self.is_configurable = is_configurable_group[self.group_ids] & (self.variants == 0)
+        self.has_parent = is_configurable_group[self.group_ids] & (self.variants > 0)
+
+        def draw_per_group(n_values: int) -> np.ndarray:
+            return rng.integers(0, n_values, n_groups)[self.group_ids]
+
+        self.brands = np.array(["GJ", "MKR", "ESG", "TSC"])[draw_per_group(4)]
+        self.hersteller = draw_per_group(len(self.attributes["esg_hersteller"]["options"]) - 1)
+        self.produktgruppe = draw_per_group(len(self.attributes["esg_produktgruppe"]["options"]) - 1)
+        self.produktsparte = draw_per_group(len(self.attributes["esg_produktsparte"]["options"]) - 1)
+        self.categories_of_product = self.leaf_category_ids[draw_per_group(len(self.leaf_category_ids))]
+        self.farben = rng.integers(0, len(self.attributes["esg_farben"]["options"]) - 1, (n_skus, 2))
+        self.keywords = rng.integers(0, 400, (n_groups, 4))[self.group_ids]
+        self.keyword_words = make_words(400, rng)
+        self.extra_values = rng.integers(0, 1 << 30, (n_skus, len(self.extra_attribute_codes)))
+
+        self.prices = np.round(np.exp(rng.normal(6, 1.2, n_groups)), 2)[self.group_ids]
+        self.status = np.where(rng.random(n_skus) < disabled_share, 2, 1)
+        self.qtys = np.where(rng.random(n_skus) < out_of_stock_share, 0, rng.integers(1, 50, n_skus))
+        self.updated_at_seconds = np.sort(rng.integers(0, 365 * 24 * 3600, n_skus))[rng.permutation(n_skus)]
+
+    def get_sku(self, row: int) -> str:
+        """
+        This function returns the sku of a product.
+        :param row:
+        :type row: int
+        :return:
+        :rtype: str
+        """
+        sparte_option = self.attributes["esg_produktsparte"]["options"][self.produktsparte[row] + 1]
+        sku = f"{self.brands[row]}-{sparte_option['label'][:2].upper()}-{100000 + self.group_ids[row]}"
+        if self.has_parent[row]:
+            sku += f"-{50 + self.variants[row]}"
+
+        return sku
+
+    def get_updated_at(self, row: int) -> str:
+        """
+        This function returns the updated_at of a product.
+        :param row:
+        :type row: int
+        :return:
+        :rtype: str
+        """
+        return (self.base_time + timedelta(seconds=int(self.updated_at_seconds[row]))).strftime(UPDATED_AT_FORMAT)
+
+    def get_option_value(self, attribute_code: str, option: int) -> str:
+        """
+        This function returns the id of the option-th option of an attribute.
+        :param attribute_code:
+        :type attribute_code: str
+        :param option:
+        :type option: int
+        :return:
+        :rtype: str
+        """
+        return self.attributes[attribute_code]["options"][option + 1]["value"]
+
+    def get_extra_value(self, attribute_code: str, value: int) -> str:
+        """
+        This function returns the value of an attribute that is not part of the product text.
+        :param attribute_code:
+        :type attribute_code: str
+        :param value:
+        :type value: int
+        :return:
+        :rtype: str
+        """
+        attribute = self.attributes[attribute_code]
+        if attribute["frontend_input"] in ("select", "multiselect"):
+            return self.get_option_value(attribute_code, value % (len(attribute["options"]) - 1))
+        if attribute["frontend_input"] == "boolean":
+            return str(value % 2)
+
+        return f"{attribute_code}-{value % 1000}"
+
+    def get_product(self, row: int, store_code: str = None) -> Dict:
+        """
+        This function builds the Magento item of a product.
+        :param row:
+        :type row: int
+        :param store_code: The store view of the name and the text attributes.
+        :type store_code: str
+        :return:
+        :rtype: Dict
+        """
+        keywords = [localize_text(self.keyword_words[keyword], store_code) for keyword in self.keywords[row]]
+        hersteller = localize_text(self.attributes["esg_hersteller"]["options"][self.hersteller[row] + 1]["label"],
+                                   store_code)
+        custom_attributes = [
+            {"attribute_code": "short_description",
+             "value": f"{hersteller} {' '.join(keywords[:2])}, {keywords[3]}"},
+            {"attribute_code": "esg_hersteller",
+             "value": self.get_option_value("esg_hersteller", self.hersteller[row])},
+            {"attribute_code": "esg_produktgruppe",
+             "value": self.get_option_value("esg_produktgruppe", self.produktgruppe[row])},
+            {"attribute_code": "esg_farben",
+             "value": ",".join(self.get_option_value("esg_farben", farbe) for farbe in np.unique(self.farben[row]))},
+            {"attribute_code": "esg_produktsparte",
+             "value": self.get_option_value("esg_produktsparte", self.produktsparte[row])},
+            {"attribute_code": "esg_product_name_keywords", "value": "|".join(keywords)},
+            {"attribute_code": "category_ids", "value": [str(self.categories_of_product[row])]}]
+        for attribute_code, value in zip(self.extra_attribute_codes, self.extra_values[row]):
+            custom_attributes.append({"attribute_code": attribute_code,
+                                      "value": self.get_extra_value(attribute_code, int(value))})
+
+        return {"id": row + 1,
+                "sku": self.get_sku(row),
+                "name": f"{hersteller} {' '.join(keywords[:3])}".title(),
+                "attribute_set_id": 4,
+                "price": float(self.prices[row]),
+                "status": int(self.status[row]),
+                "visibility": 1 if self.has_parent[row] else 4,
+                "type_id": "configurable" if self.is_configurable[row] else "simple",
+                "weight": 0.01,
+                "updated_at": self.get_updated_at(row),
+                "custom_attributes": custom_attributes}
+
+    def get_product_page(self, current_page: int, page_size: int, updated_since: str = None,
+                         store_code: str = None) -> Dict:
+        """
+        This function answers one page of the products endpoint.
+        :param current_page: The page number, starting with 1.
+        :type current_page: int
+        :param page_size:
+        :type page_size: int
+        :param updated_since: Only return products with a newer updated_at.
+        :type updated_since: str
+        :param store_code:
+        :type store_code: str
+        :return:
+        :rtype: Dict
+        """
+        if updated_since:
+            since_seconds = (datetime.strptime(updated_since, UPDATED_AT_FORMAT) - self.base_time).total_seconds()
+            rows = np.flatnonzero(self.updated_at_seconds > since_seconds)
+        else:
+            rows = np.arange(self.n_skus)
+
+        page_rows = rows[(current_page - 1) * page_size:current_page * page_size]
+        return {"items": [self.get_product(int(row), store_code) for row in page_rows],
+                "search_criteria": {"current_page": current_page, "page_size": page_size},
+                "total_count": len(rows)}
+
+    def get_attributes(self, store_code: str = None) -> Dict:
+        """
+        This function answers the products/attributes endpoint, the option labels are translated to the store view.
+        :param store_code:
+        :type store_code: str
+        :return:
+        :rtype: Dict
+        """
+        attributes = copy.deepcopy(list(self.attributes.values()))
+        for attribute in attributes:
+            for option in attribute.get("options", []):
+                option["label"] = localize_text(option["label"], store_code)
+
+        return {"items": attributes, "total_count": len(attributes)}
+
+    def get_categories(self, store_code: str = None) -> Dict:
+        """
+        This function answers the categories endpoint, the names are translated to the store view.
+        :param store_code:
+        :type store_code: str
+        :return:
+        :rtype: Dict
+        """
+        def localize_category(category: Dict) -> Dict:
+            return dict(category, name=localize_text(category["name"], store_code),
+                        children_data=[localize_category(child) for child in category["children_data"]])
+
+        return localize_category(self.categories)
+
+    def get_low_stock(self) -> Dict:
+        """
+        This function answers the stockItems/lowStock endpoint, products that are not configurables have a qty.
+        :return:
+        :rtype: Dict
+        """
+        rows = np.flatnonzero(~self.is_configurable)
+        return {"items": [{"product_id": int(row) + 1, "qty": float(self.qtys[row]), "stock_id": 1}
+                          for row in rows],
+                "total_count": len(rows)}
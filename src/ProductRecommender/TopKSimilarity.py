@@ -0,0 +1,193 @@
+"""
+This file computes the top-k cosine similarities of the products without building the dense N x N matrix.
+"""
+import logging
+from typing import Tuple
+
+import numpy as np
+from scipy import sparse
+from sklearn.preprocessing import normalize
+
+logger = logging.getLogger("TopKSimilarity")
+
+# float32 scores, int64 argpartition indices and float32 candidate scores per cell of a block
+BYTES_PER_BLOCK_CELL = 16
+
+
+def get_block_size(n_rows: int, block_size: int, max_block_mb: float = None) -> int:
+    """
+    This function returns the number of rows that are multiplied at once.
+    If max_block_mb is set the block size gets reduced until one block fits into the memory budget.
+    :param n_rows:
+    :type n_rows: int
+    :param block_size:
+    :type block_size: int
+    :param max_block_mb:
+    :type max_block_mb: float
+    :return:
+    :rtype: int
+    """
+    block_size = max(1, int(block_size))
+    if max_block_mb:
+        rows_in_budget = int(max_block_mb * 1024 * 1024 // max(1, n_rows * BYTES_PER_BLOCK_CELL))
+        block_size = max(1, min(block_size, rows_in_budget))
+
+    return block_size
+
+
+def select_top_k(score_block: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    This function selects the k highest scores per row of a dense score block in descending order.
+    Equal scores are ordered by their column index, also at the k-th score where the lowest columns are kept.
+    :param score_block:
+    :type score_block: np.ndarray
+    :param k:
+    :type k: int
+    :return: The column indices and the scores of the selected neighbours, both of shape (rows, k).
+    :rtype: Tuple[np.ndarray, np.ndarray]
+    """
+    n_block_rows, n_cols = score_block.shape
+    k = min(k, n_cols)
+    if k <= 0:
+        return np.empty((n_block_rows, 0), dtype=np.int32), np.empty((n_block_rows, 0), dtype=np.float32)
+
+    if k < n_cols:
+        candidates = np.argpartition(score_block, n_cols - k, axis=1)[:, n_cols - k:]
+        candidate_scores = np.take_along_axis(score_block, candidates, axis=1)
+        # argpartition keeps any of the columns that tie with the k-th score, these rows are sorted completely
+        kth_scores = candidate_scores.min(axis=1, keepdims=True)
+        n_tied = (score_block == kth_scores).sum(axis=1) - (candidate_scores == kth_scores).sum(axis=1)
+        tied_rows = np.flatnonzero(n_tied > 0)
+        if len(tied_rows) > 0:
+            candidates[tied_rows] = np.argsort(-score_block[tied_rows], axis=1, kind="stable")[:, :k]
+            candidate_scores[tied_rows] = np.take_along_axis(score_block[tied_rows], candidates[tied_rows], axis=1)
+    else:
+        candidates = np.tile(np.arange(n_cols), (n_block_rows, 1))
+        candidate_scores = score_block
+
+    order = np.lexsort((candidates, -candidate_scores), axis=1)
+    top_indices = np.take_along_axis(candidates, order, axis=1).astype(np.int32)
+    top_scores = np.take_along_axis(candidate_scores, order, axis=1).astype(np.float32)
+
+    return top_indices, top_scores
+
+
+def prepare_matrix(vecs: sparse.spmatrix) -> Tuple[sparse.csr_matrix, sparse.csr_matrix]:
+    """
+    This function returns the l2 normalized float32 matrix and its transposed csr matrix,
+    so that the dot product of two rows is their cosine similarity.
+    :param vecs:
+    :type vecs: sparse.spmatrix
+    :return:
+    :rtype: Tuple[sparse.csr_matrix, sparse.csr_matrix]
+    """
+    # float32 vectors are not converted, they have to be copied to keep the vectors of the caller unnormalized
+    matrix = normalize(sparse.csr_matrix(vecs, dtype=np.float32), norm="l2", copy=vecs.dtype == np.float32)
+    return matrix, matrix.T.tocsr()
+
+
+def similarity_block(matrix: sparse.csr_matrix, matrix_t: sparse.csr_matrix, row_ids: np.ndarray,
+                     exclude_self: bool = True) -> np.ndarray:
+    """
+    This function returns the dense cosine similarities of the given rows against all rows.
+    :param matrix: The l2 normalized matrix.
+    :type matrix: sparse.csr_matrix
+    :param matrix_t: The transposed matrix in csr format.
+    :type matrix_t: sparse.csr_matrix
+    :param row_ids:
+    :type row_ids: np.ndarray
+    :param exclude_self: Set the similarity of a row to itself to -inf.
+    :type exclude_self: bool
+    :return:
+    :rtype: np.ndarray
+    """
+    score_block = (matrix[row_ids] @ matrix_t).toarray().astype(np.float32, copy=False)
+    if exclude_self:
+        score_block[np.arange(len(row_ids)), row_ids] = -np.inf
+
+    return score_block
+
+
+def top_k_rows(vecs: sparse.spmatrix, row_ids: np.ndarray, k: int, block_size: int = 256, max_block_mb: float = None,
+               exclude_self: bool = True) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    This function computes the k most similar rows of the given rows against all rows.
+    The rows are multiplied in blocks, so only one dense block of shape (block_size, N) is in memory.
+    :param vecs: Sparse document vectors, e.g. the output of the TfidfVectorizer.
+    :type vecs: sparse.spmatrix
+    :param row_ids:
+    :type row_ids: np.ndarray
+    :param k: Number of neighbours per row.
+    :type k: int
+    :param block_size: Number of rows multiplied at once.
+    :type block_size: int
+    :param max_block_mb: Optional upper bound of the memory used by one block.
+    :type max_block_mb: float
+    :param exclude_self: Skip the row itself as neighbour.
+    :type exclude_self: bool
+    :return: The neighbour indices (int32) and scores (float32) of shape (len(row_ids), k) in descending order.
+    :rtype: Tuple[np.ndarray, np.ndarray]
+    """
+    matrix, matrix_t = prepare_matrix(vecs)
+    row_ids = np.asarray(row_ids, dtype=np.int64)
+    n_rows = matrix.shape[0]
+    k = max(0, min(k, n_rows - 1 if exclude_self else n_rows))
+    block_size = get_block_size(n_rows, block_size, max_block_mb)
+
+    neighbour_indices = np.empty((len(row_ids), k), dtype=np.int32)
+    neighbour_scores = np.empty((len(row_ids), k), dtype=np.float32)
+
+    logger.info(f"Computing top {k} neighbours for {len(row_ids)} of {n_rows} rows in blocks of {block_size} rows")
+    for start in range(0, len(row_ids), block_size):
+        stop = min(start + block_size, len(row_ids))
+        score_block = similarity_block(matrix, matrix_t, row_ids[start:stop], exclude_self)
+        neighbour_indices[start:stop], neighbour_scores[start:stop] = select_top_k(score_block, k)
+
+    return neighbour_indices, neighbour_scores
+
+
+def top_k_cosine_similarity(vecs: sparse.spmatrix, k: int, block_size: int = 256, max_block_mb: float = None,
+                            exclude_self: bool = True) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    This function computes for every row the k most similar rows by cosine similarity.
+    :param vecs: Sparse document vectors, e.g. the output of the TfidfVectorizer.
+    :type vecs: sparse.spmatrix
+    :param k: Number of neighbours per row.
+    :type k: int
+    :param block_size: Number of rows multiplied at once.
+    :type block_size: int
+    :param max_block_mb: Optional upper bound of the memory used by one block.
+    :type max_block_mb: float
+    :param exclude_self: Skip the row itself as neighbour.
+    :type exclude_self: bool
+    :return: The neighbour indices (int32) and scores (float32) of shape (N, k) in descending score order.
+    :rtype: Tuple[np.ndarray, np.ndarray]
+    """
+    return top_k_rows(vecs, np.arange(vecs.shape[0]), k, block_size, max_block_mb, exclude_self)
+
+
+def max_similarity_to_rows(vecs: sparse.spmatrix, row_ids: np.ndarray, block_size: int = 256,
+                           max_block_mb: float = None) -> np.ndarray:
+    """
+    This function returns for every row the highest cosine similarity to any of the given rows, besides itself.
+    :param vecs:
+    :type vecs: sparse.spmatrix
+    :param row_ids:
+    :type row_ids: np.ndarray
+    :param block_size:
+    :type block_size: int
+    :param max_block_mb:
+    :type max_block_mb: float
+    :return: An array of shape (N,), -inf if no other row was given.
+    :rtype: np.ndarray
+    """
+    matrix, matrix_t = prepare_matrix(vecs)
+    row_ids = np.asarray(row_ids, dtype=np.int64)
+    block_size = get_block_size(matrix.shape[0], block_size, max_block_mb)
+
+    max_scores = np.full(matrix.shape[0], -np.inf, dtype=np.float32)
+    for start in range(0, len(row_ids), block_size):
+        score_block = similarity_block(matrix, matrix_t, row_ids[start:start + block_size])
+        np.maximum(max_scores, score_block.max(axis=0), out=max_scores)
+
+    return max_scores
@@ -0,0 +1,7 @@
+"""
+This file puts the ProductRecommender modules on the path of the tests, they import each other by module name.
+"""
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
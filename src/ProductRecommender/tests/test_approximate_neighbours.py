@@ -0,0 +1,26 @@
+"""
+This file tests the ann backend on catalogs with too few products for neighbours.
+"""
+import numpy as np
+import pytest
+from scipy import sparse
+
+from ApproximateNeighbours import approximate_top_k_cosine_similarity, recall_at_k
+
+
+@pytest.mark.parametrize("n_rows", [0, 1])
+def test_catalog_without_neighbours(n_rows):
+    vecs = sparse.random(n_rows, 10, density=0.5, format="csr", random_state=0)
+    indices, scores = approximate_top_k_cosine_similarity(vecs, k=5)
+
+    assert indices.shape == scores.shape == (n_rows, 0)
+    assert indices.dtype == np.int32 and scores.dtype == np.float32
+    assert recall_at_k(vecs, indices, scores)["recall"] == 1.0
+
+
+def test_small_catalog_finds_every_other_row():
+    vecs = sparse.random(3, 10, density=0.8, format="csr", random_state=0)
+    indices, _ = approximate_top_k_cosine_similarity(vecs, k=5)
+
+    assert indices.shape == (3, 2)
+    assert all(set(row) == set(range(3)) - {row_id} for row_id, row in enumerate(indices.tolist()))
@@ -0,0 +1,35 @@
+"""
+This file tests the bulk resolution of attribute option and category ids to their labels.
+"""
+import logging
+
+import numpy as np
+import pandas as pd
+
+from MagentoItemHandler import resolve_labels
+
+LABELS = {"1": "red", "2": "blue", "3": "green"}
+
+
+def test_resolve_labels():
+    values = pd.Series(["1", "2,3", "", np.nan, ["3", 1], [], "1"], index=[10, 11, 12, 13, 14, 15, 16])
+    resolved = resolve_labels(values, LABELS, "esg_farben")
+
+    assert resolved.index.tolist() == values.index.tolist()
+    assert resolved.tolist()[:3] == ["red", "blue,green", ""]
+    assert np.isnan(resolved[13])
+    assert resolved.tolist()[4:] == ["green,red", "", "red"]
+
+
+def test_unknown_ids_are_skipped(caplog):
+    with caplog.at_level(logging.WARNING, logger="MagentoItemHandler"):
+        resolved = resolve_labels(pd.Series(["1,99", "98", "99"]), LABELS, "esg_farben")
+
+    assert resolved.tolist() == ["red", "", ""]
+    assert "2 ids of <esg_farben> have no label" in caplog.text
+
+
+def test_ids_without_labels_are_joined():
+    resolved = resolve_labels(pd.Series([["3", "4"], np.nan, "5", []], dtype=object))
+
+    assert resolved[0] == "3,4" and np.isnan(resolved[1]) and resolved[2] == "5" and resolved[3] == ""
@@ -0,0 +1,72 @@
+"""
+This file tests the batched recommendations against a per product loop over the neighbours.
+"""
+import numpy as np
+import pytest
+
+from BatchRecommender import get_sku_codes, recommend_batch, select_recommendations, to_recommender_dict
+from CandidateFilter import shares_category
+
+N_ROWS = 200
+K = 12
+
+
+@pytest.fixture(scope="module")
+def catalog():
+    rng = np.random.default_rng(0)
+    skus = np.array([f"sku-{i // 2 if i % 10 == 0 else i}" for i in range(N_ROWS)], dtype=object)
+    indices = rng.integers(0, N_ROWS, (N_ROWS, K))
+    indices[:, 0] = np.arange(N_ROWS)
+    indices[rng.random((N_ROWS, K)) < 0.1] = -1
+    scores = np.round(rng.random((N_ROWS, K)), 1).astype(np.float32)
+    allowed = rng.random(N_ROWS) < 0.8
+    category_bitsets = rng.integers(0, 4, (N_ROWS, 1)).astype(np.uint8)
+    return skus, indices, scores, allowed, category_bitsets
+
+
+def loop_recommendations(row, skus, indices, scores, n_products, allowed, category_bitsets):
+    candidates = []
+    for position in np.lexsort((np.arange(K), -scores[row])):
+        candidate = indices[row, position]
+        if (candidate >= 0 and candidate != row and skus[candidate] != skus[row]
+                and (allowed is None or allowed[candidate])
+                and (category_bitsets is None or shares_category(category_bitsets, np.array([row]),
+                                                                 np.array([[candidate]]))[0, 0])):
+            candidates.append(skus[candidate])
+    return candidates[:n_products]
+
+
+@pytest.mark.parametrize("use_allowed, use_categories", [(False, False), (True, False), (True, True)])
+@pytest.mark.parametrize("block_size", [1, 7, 8192])
+def test_equals_loop(catalog, use_allowed, use_categories, block_size):
+    skus, indices, scores, allowed, category_bitsets = catalog
+    allowed = allowed if use_allowed else None
+    category_bitsets = category_bitsets if use_categories else None
+    row_ids = np.arange(N_ROWS)[::-1]
+
+    recommendations = recommend_batch(row_ids, indices, scores, skus, 5, allowed, category_bitsets, block_size)
+
+    assert recommendations.shape == (N_ROWS, 5)
+    assert to_recommender_dict(skus[row_ids], recommendations) == {
+        skus[row]: loop_recommendations(row, skus, indices, scores, 5, allowed, category_bitsets) for row in row_ids}
+
+
+def test_missing_recommendations_are_padded(catalog):
+    skus, indices, scores, allowed, _ = catalog
+    recommended_rows, recommended_scores = select_recommendations([3], indices, scores, skus, n_products=K + 5,
+                                                                  allowed=allowed)
+    n_valid = len(loop_recommendations(3, skus, indices, scores, K + 5, allowed, None))
+
+    assert (recommended_rows[0, n_valid:] == -1).all() and (recommended_scores[0, n_valid:] == 0).all()
+    assert (recommended_rows[0, :n_valid] >= 0).all()
+    assert (np.diff(recommended_scores[0, :n_valid]) <= 0).all()
+
+
+def test_precomputed_sku_codes(catalog):
+    skus, indices, scores, allowed, _ = catalog
+    row_ids = np.arange(0, N_ROWS, 3)
+    sku_codes = get_sku_codes(skus)
+
+    assert sku_codes[10] == sku_codes[5] and sku_codes[2] != sku_codes[3]
+    assert recommend_batch(row_ids, indices, scores, skus, allowed=allowed, sku_codes=sku_codes).tolist() == \
+        recommend_batch(row_ids, indices, scores, skus, allowed=allowed).tolist()
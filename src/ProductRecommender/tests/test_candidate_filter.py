@@ -0,0 +1,58 @@
+"""
+This file tests the category bitsets and candidate masks of the CandidateFilter.
+"""
+import numpy as np
+import pandas as pd
+
+from CandidateFilter import (get_affected_rows, get_candidate_mask, get_category_bit, get_category_bitsets,
+                             shares_category)
+
+PRODUCT_DF = pd.DataFrame({"category_ids": ["3,5", "5", None, "12", " 3 ,x", "1,2,3,4,5,6,7,12"]})
+
+
+def test_category_bitsets():
+    category_ids, bitsets = get_category_bitsets(PRODUCT_DF)
+
+    assert category_ids.tolist() == [1, 2, 3, 4, 5, 6, 7, 12]
+    assert bitsets.shape == (6, 1)
+    assert bitsets[:, 0].tolist() == [0b00101000, 0b00001000, 0, 0b00000001, 0b00100000, 0b11111111]
+    assert get_category_bit(category_ids, 12) == (0, 0b00000001)
+    assert get_category_bit(category_ids, 8) == (-1, 0)
+
+
+def test_category_bitsets_with_more_than_eight_categories():
+    category_ids, bitsets = get_category_bitsets(pd.DataFrame({"category_ids": ["1", "9", "1,9"]}))
+    category_ids_wide, bitsets_wide = get_category_bitsets(
+        pd.DataFrame({"category_ids": [",".join(map(str, range(1, 10))), "9"]}))
+
+    assert bitsets.shape == (3, 1)
+    assert bitsets_wide.shape == (2, 2)
+    assert bitsets_wide[1].tolist() == [0, 0b10000000]
+    assert get_category_bit(category_ids_wide, 9) == (1, 0b10000000)
+
+
+def test_frame_without_categories():
+    category_ids, bitsets = get_category_bitsets(pd.DataFrame({"sku": ["a", "b"]}))
+
+    assert len(category_ids) == 0
+    assert bitsets.shape == (2, 0)
+
+
+def test_shares_category():
+    _, bitsets = get_category_bitsets(PRODUCT_DF)
+    candidate_indices = np.array([[1, 2, 3, -1], [0, 4, 5, -1]])
+
+    assert shares_category(bitsets, np.array([0, 3]), candidate_indices).tolist() == [[True, False, False, False],
+                                                                                      [False, False, True, False]]
+
+
+def test_candidate_mask_and_affected_rows():
+    _, bitsets = get_category_bitsets(PRODUCT_DF)
+    candidate_indices = np.array([[1, 4, 5], [0, 5, -1]])
+    allowed = np.array([True, True, True, True, True, False])
+
+    assert get_candidate_mask(np.array([0, 1]), candidate_indices, allowed).tolist() == [[True, True, False],
+                                                                                         [True, False, False]]
+    assert get_candidate_mask(np.array([0, 1]), candidate_indices, allowed, bitsets).tolist() == \
+        [[True, True, False], [True, False, False]]
+    assert get_affected_rows(candidate_indices, np.array([False, False, False, False, True, False])).tolist() == [0]
@@ -0,0 +1,55 @@
+"""
+This file tests that the streaming product frame gives the same documents as the frame built in memory.
+"""
+import pandas as pd
+import pytest
+
+from CandidateFilter import CATEGORY_COLUMN
+from MagentoItemHandler import MagentoItemHandler
+from ProductPreprocessing import TEXT_COLUMNS, add_documents
+from SyntheticCatalog import SyntheticCatalog
+
+N_SKUS = 40
+
+
+@pytest.fixture(scope="module")
+def catalog():
+    return SyntheticCatalog(N_SKUS)
+
+
+def get_items(catalog: SyntheticCatalog):
+    # The children of a configurable often share their texts, so every group of four products gets the same ones
+    items = [catalog.get_product(row) for row in range(N_SKUS)]
+    for row, item in enumerate(items):
+        group_attributes = {custom_attribute["attribute_code"]: custom_attribute["value"]
+                            for custom_attribute in items[row - row % 4]["custom_attributes"]}
+        for custom_attribute in item["custom_attributes"]:
+            if custom_attribute["attribute_code"] in TEXT_COLUMNS + (CATEGORY_COLUMN,):
+                custom_attribute["value"] = group_attributes[custom_attribute["attribute_code"]]
+
+    return items
+
+
+def build_documents(catalog: SyntheticCatalog, chunk_rows: int = None) -> pd.Series:
+    item_handler = MagentoItemHandler({"base_url": "http://127.0.0.1", "cache_dir": "", "consumer_key": "test",
+                                       "consumer_key_secret": "test", "access_token": "test",
+                                       "access_token_secret": "test"})
+    item_handler.chunk_rows = chunk_rows
+    item_handler.magento_attribute_handler.attributes = catalog.get_attributes()
+    item_handler.magento_attribute_handler.category_id_names = \
+        item_handler.magento_attribute_handler.parse_category_id_and_names(catalog.get_categories())
+
+    frame_builder = item_handler.get_product_frame_builder()
+    item_handler.append_products(frame_builder, get_items(catalog))
+    product_df = frame_builder.build()
+    product_df["price_ranges"] = "low"
+
+    return add_documents(product_df)["imp"]
+
+
+def test_streamed_documents_with_repeated_texts(catalog):
+    streamed_documents = build_documents(catalog, chunk_rows=4)
+
+    assert streamed_documents.dtype == object
+    assert streamed_documents.nunique() < N_SKUS
+    assert streamed_documents.tolist() == build_documents(catalog).tolist()
@@ -0,0 +1,37 @@
+"""
+This file tests the weights of the fields featurizer.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from Featurizer import FieldVectorizer
+
+PRODUCT_DF = pd.DataFrame({"name": ["red shirt", "blue shirt", "red shoe", None],
+                           "esg_hersteller": ["a", "b", "a", "c"]})
+
+
+def get_fields(name_weight: float, hersteller_weight: float):
+    return [{"column": "name", "weight": name_weight},
+            {"column": "esg_hersteller", "type": "categorical", "weight": hersteller_weight}]
+
+
+def test_reweight_equals_vectors_of_the_new_weights():
+    field_vectorizer = FieldVectorizer(get_fields(1.0, 0.5), dtype="float64")
+    vectors = field_vectorizer.reweight(field_vectorizer.fit_transform(PRODUCT_DF), [2.0, 0.25])
+
+    expected = FieldVectorizer(get_fields(2.0, 0.25), dtype="float64").fit_transform(PRODUCT_DF)
+    assert np.allclose(vectors.toarray(), expected.toarray())
+    assert field_vectorizer.get_weights() == [2.0, 0.25]
+
+
+@pytest.mark.parametrize("weight", [0, -1.0, float("nan")])
+def test_weights_have_to_be_positive(weight):
+    with pytest.raises(ValueError, match="esg_hersteller"):
+        FieldVectorizer(get_fields(1.0, weight))
+
+    field_vectorizer = FieldVectorizer(get_fields(1.0, 0.5))
+    vectors = field_vectorizer.fit_transform(PRODUCT_DF)
+    with pytest.raises(ValueError, match="esg_hersteller"):
+        field_vectorizer.reweight(vectors, [1.0, weight])
+    assert field_vectorizer.get_weights() == [1.0, 0.5]
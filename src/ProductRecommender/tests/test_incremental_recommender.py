@@ -0,0 +1,85 @@
+"""
+This file tests the incremental merge of the changed products and the neighbour update against a full recompute.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from IncrementalRecommender import get_watermark, merge_changed_products, update_neighbours, update_vectors
+from TopKSimilarity import top_k_cosine_similarity
+
+WORDS = [f"word{i}" for i in range(40)]
+
+
+def get_documents(rng, n_documents):
+    # Every document shares the word product, so no two products have a similarity of exactly 0
+    return np.array([" ".join(["product", f"unique{rng.integers(10 ** 9)}"] + list(rng.choice(WORDS, 6)))
+                     for _ in range(n_documents)], dtype=object)
+
+
+@pytest.fixture
+def previous_state():
+    rng = np.random.default_rng(0)
+    skus = np.array([f"sku-{i}" for i in range(150)], dtype=object)
+    documents = get_documents(rng, len(skus))
+    vectorizer = TfidfVectorizer().fit(documents)
+    vectors = vectorizer.transform(documents)
+    neighbour_indices, neighbour_scores = top_k_cosine_similarity(vectors, k=8)
+    return {"skus": skus, "documents": documents, "vectorizer": vectorizer, "vectors": vectors,
+            "neighbour_indices": neighbour_indices, "neighbour_scores": neighbour_scores}
+
+
+@pytest.mark.parametrize("n_changed, n_new, n_removed", [(0, 0, 0), (5, 0, 0), (0, 5, 0), (0, 0, 5), (20, 10, 10)])
+def test_update_equals_full_recompute(previous_state, n_changed, n_new, n_removed):
+    rng = np.random.default_rng(n_changed + n_new + n_removed)
+    kept_rows = np.sort(rng.choice(150, 150 - n_removed, replace=False))
+    skus = np.concatenate([previous_state["skus"][kept_rows], [f"new-{i}" for i in range(n_new)]])
+    documents = np.concatenate([previous_state["documents"][kept_rows], get_documents(rng, n_new)])
+    changed_rows = rng.choice(len(kept_rows), n_changed, replace=False)
+    documents[changed_rows] = get_documents(rng, n_changed)
+
+    vectors, new_to_old, updated_rows = update_vectors(previous_state, skus, documents)
+    neighbour_indices, neighbour_scores, recomputed_rows = update_neighbours(previous_state, vectors, new_to_old,
+                                                                             updated_rows, k=8)
+    full_vectors = previous_state["vectorizer"].transform(documents)
+    full_indices, full_scores = top_k_cosine_similarity(full_vectors, k=8)
+
+    assert new_to_old.tolist() == kept_rows.tolist() + [-1] * n_new
+    assert sorted(updated_rows.tolist()) == sorted(changed_rows.tolist() + list(range(len(kept_rows), len(skus))))
+    assert set(updated_rows) <= set(recomputed_rows)
+    np.testing.assert_allclose(vectors.toarray(), full_vectors.toarray(), atol=1e-6)
+    assert neighbour_indices.tolist() == full_indices.tolist()
+    np.testing.assert_allclose(neighbour_scores, full_scores, atol=1e-6)
+
+
+def test_changed_number_of_neighbours_recomputes_all_rows(previous_state):
+    vectors, new_to_old, changed_rows = update_vectors(previous_state, previous_state["skus"],
+                                                       previous_state["documents"])
+    neighbour_indices, _, recomputed_rows = update_neighbours(previous_state, vectors, new_to_old, changed_rows, k=4)
+
+    assert len(changed_rows) == 0
+    assert len(recomputed_rows) == 150
+    assert neighbour_indices.tolist() == top_k_cosine_similarity(vectors, k=4)[0].tolist()
+
+
+def test_merge_changed_products():
+    previous_raw = pd.DataFrame({"id": [1, 2, 3], "sku": ["a", "b", "c"], "name": ["A", "B", "C"],
+                                 "type_id": pd.Categorical(["simple", "simple", "bundle"])})
+    changed_raw = pd.DataFrame({"id": [4, 2], "sku": ["d", "b"], "name": ["D", "B2"],
+                                "type_id": ["simple", "bundle"]})
+
+    merged_raw = merge_changed_products(previous_raw, changed_raw)
+
+    assert merged_raw["id"].tolist() == [1, 2, 3, 4]
+    assert merged_raw["name"].tolist() == ["A", "B2", "C", "D"]
+    assert isinstance(merged_raw["type_id"].dtype, pd.CategoricalDtype)
+    assert merge_changed_products(previous_raw, changed_raw.iloc[:0]) is previous_raw
+
+
+def test_watermark():
+    raw_products = pd.DataFrame({"updated_at": ["2024-01-02 10:00:00", None, "2024-01-01 08:00:00"]})
+
+    assert get_watermark(raw_products) == "2024-01-02 10:00:00"
+    assert get_watermark(raw_products, "2024-02-01 00:00:00") == "2024-02-01 00:00:00"
+    assert get_watermark(pd.DataFrame({"id": [1]})) is None
@@ -0,0 +1,89 @@
+"""
+This file tests the paginated product fetch of the MagentoItemHandler against the MagentoStubServer.
+"""
+import asyncio
+
+import pandas as pd
+import pytest
+import requests
+
+from MagentoItemHandler import MagentoItemHandler
+from MagentoStubServer import MagentoStubServer
+from SyntheticCatalog import SyntheticCatalog
+
+N_SKUS = 230
+
+
+@pytest.fixture(scope="module")
+def catalog():
+    return SyntheticCatalog(N_SKUS)
+
+
+def get_item_handler(server: MagentoStubServer, **connection_settings) -> MagentoItemHandler:
+    return MagentoItemHandler(dict({"base_url": server.base_url, "cache_dir": "", "page_size": 50, "max_workers": 3,
+                                    "backoff_factor": 0, "consumer_key": "test", "consumer_key_secret": "test",
+                                    "access_token": "test", "access_token_secret": "test"}, **connection_settings))
+
+
+@pytest.mark.parametrize("fail_requests", [0, 2])
+def test_iter_products_returns_every_product_once(catalog, fail_requests):
+    server = MagentoStubServer(catalog, fail_requests=fail_requests).start()
+    try:
+        skus = [item["sku"] for item in get_item_handler(server).iter_products()]
+    finally:
+        server.stop()
+
+    assert sorted(skus) == sorted(catalog.get_sku(row) for row in range(N_SKUS))
+    assert server.fail_requests == 0
+
+
+def test_iter_products_with_updated_since(catalog):
+    updated_since = catalog.get_updated_at(N_SKUS // 2)
+    expected = catalog.get_product_page(1, N_SKUS, updated_since)["items"]
+    server = MagentoStubServer(catalog).start()
+    try:
+        items = list(get_item_handler(server).iter_products(updated_since=updated_since))
+    finally:
+        server.stop()
+
+    assert [item["sku"] for item in items] == [item["sku"] for item in expected]
+
+
+def test_async_fetch_retries_failed_pages(catalog):
+    server = MagentoStubServer(catalog, fail_requests=2).start()
+    try:
+        item_handler = get_item_handler(server)
+
+        async def fetch():
+            async with item_handler.get_async_client() as client:
+                return await item_handler.fetch_product_frame_async(client)
+
+        product_df = asyncio.run(fetch())
+    finally:
+        server.stop()
+
+    assert sorted(product_df["sku"]) == sorted(catalog.get_sku(row) for row in range(N_SKUS))
+    assert server.fail_requests == 0
+
+
+def test_failed_pages_raise_after_the_retries(catalog):
+    server = MagentoStubServer(catalog, fail_requests=100).start()
+    try:
+        with pytest.raises(requests.exceptions.RetryError):
+            list(get_item_handler(server, max_retries=2).iter_products())
+    finally:
+        server.stop()
+
+
+def test_add_qtys_sums_the_stock_items_of_a_product():
+    item_handler = MagentoItemHandler({"base_url": "http://127.0.0.1:9", "cache_dir": "", "consumer_key": "test",
+                                       "consumer_key_secret": "test", "access_token": "test",
+                                       "access_token_secret": "test"})
+    product_df = pd.DataFrame({"id": [1, 2, 3], "sku": ["a", "b", "c"]}, index=[5, 6, 7])
+    qty_df = pd.DataFrame({"id": [2, 1, 2], "qty": [3.0, 0.0, 4.0]})
+
+    product_df_with_qtys = item_handler.add_qtys(product_df, qty_df)
+
+    assert product_df_with_qtys["qty"].tolist() == [0.0, 7.0, 99999999999]
+    assert product_df_with_qtys.index.tolist() == [0, 1, 2]
+    assert product_df.columns.tolist() == ["id", "sku"]
@@ -0,0 +1,63 @@
+"""
+This file tests the storage formats of the recommendations table with the SqliteHandler.
+"""
+import numpy as np
+import pytest
+
+from RecommendationCodec import decode_to_string, encode_recommendations
+from SqliteHandler import SqliteHandler
+
+BLOBS = {"A-1": encode_recommendations(np.array([2, 3]), np.array([0.9, 0.5])),
+         "A-2": encode_recommendations(np.array([1]), np.array([0.9]))}
+SKUS = {"A-1": ["A-2", "A-3"], "A-2": ["A-1"]}
+
+
+def read_table(my_sql_handler: SqliteHandler):
+    return my_sql_handler.execute("SELECT sku, neighbours, recommondations FROM recommender ORDER BY sku", fetch=True)
+
+
+@pytest.mark.parametrize("diff_mode", ["hash", "full"])
+def test_both_format_migrates_a_text_table(tmp_path, diff_mode):
+    text_handler = SqliteHandler(tmp_path / "recommender.db")
+    text_handler.create_table_if_not_exists("recommender")
+    text_handler.publish("recommender", SKUS)
+    text_handler.connection.close()
+
+    both_handler = SqliteHandler(tmp_path / "recommender.db", diff_mode=diff_mode, storage_format="both")
+    both_handler.create_table_if_not_exists("recommender")
+    stats = both_handler.publish("recommender", SKUS, product_recommender_blobs=BLOBS)
+
+    assert stats["rows_upserted"] == 2
+    assert read_table(both_handler) == [("A-1", BLOBS["A-1"], "A-2$$A-3"), ("A-2", BLOBS["A-2"], "A-1")]
+    assert both_handler.publish("recommender", SKUS, product_recommender_blobs=BLOBS)["rows_upserted"] == 0
+
+
+@pytest.mark.parametrize("diff_mode", ["hash", "full"])
+def test_both_format_diffs_the_text_column(tmp_path, diff_mode):
+    my_sql_handler = SqliteHandler(tmp_path / "recommender.db", diff_mode=diff_mode, storage_format="both")
+    my_sql_handler.create_table_if_not_exists("recommender")
+    my_sql_handler.publish("recommender", SKUS, product_recommender_blobs=BLOBS)
+
+    # A-3 got renamed, the product ids and so the blobs stay the same
+    renamed_skus = dict(SKUS, **{"A-1": ["A-2", "A-3-new"]})
+    stats = my_sql_handler.publish("recommender", renamed_skus, product_recommender_blobs=BLOBS)
+
+    assert stats["rows_upserted"] == 1
+    assert read_table(my_sql_handler)[0] == ("A-1", BLOBS["A-1"], "A-2$$A-3-new")
+    assert decode_to_string(read_table(my_sql_handler)[0][1], {2: "A-2", 3: "A-3-new"}) == "A-2$$A-3-new"
+
+
+@pytest.mark.parametrize("settings", [{"batch_size": 0}, {"batch_size": -1}, {"fetch_size": 0}, {"batch_size": None}])
+def test_invalid_batch_sizes_are_rejected(tmp_path, settings):
+    with pytest.raises(ValueError, match="positive integer"):
+        SqliteHandler(tmp_path / "recommender.db", **settings)
+
+
+@pytest.mark.parametrize("mode", ["upsert", "swap"])
+def test_publish_in_batches_of_one_row(tmp_path, mode):
+    my_sql_handler = SqliteHandler(tmp_path / "recommender.db", batch_size=1, fetch_size=1)
+    my_sql_handler.create_table_if_not_exists("recommender")
+    my_sql_handler.publish("recommender", SKUS, mode=mode)
+
+    assert my_sql_handler.execute("SELECT sku, recommondations FROM recommender ORDER BY sku", fetch=True) == \
+        [("A-1", "A-2$$A-3"), ("A-2", "A-1")]
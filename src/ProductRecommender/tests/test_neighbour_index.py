@@ -0,0 +1,83 @@
+"""
+This file tests the write and read round trip of the neighbour index file.
+"""
+import struct
+
+import numpy as np
+import pytest
+
+from NeighbourIndex import HEADER_FORMAT, VERSION, NeighbourIndexReader, write_neighbour_index
+
+SKUS = ["b-2", "a-1", "äö-3", "c"]
+NEIGHBOURS = np.array([[1, 2, -1], [0, 3, 2], [3, 0, 1], [2, -1, -1]])
+SCORES = np.array([[0.9, 0.5, 0.0], [0.9, 0.4, 0.1], [0.8, 0.5, 0.1], [0.8, 0.0, 0.0]])
+
+
+@pytest.mark.parametrize("score_dtype", ["float16", "float32"])
+def test_round_trip(tmp_path, score_dtype):
+    in_stock = np.array([True, False, True, True])
+    category_ids = np.arange(1, 10)
+    category_bitsets = np.array([[0b10000000, 0], [0, 0b10000000], [0b11000000, 0], [0, 0]], dtype=np.uint8)
+    write_neighbour_index(tmp_path / "neighbours.idx", SKUS, NEIGHBOURS, SCORES, score_dtype, in_stock,
+                          category_ids, category_bitsets)
+
+    reader = NeighbourIndexReader(tmp_path / "neighbours.idx")
+    arrays = reader.get_arrays()
+
+    assert (len(reader), reader.k, reader.version) == (4, 3, VERSION)
+    assert [reader.row(sku) for sku in SKUS] == [0, 1, 2, 3]
+    assert reader.row("x") is None and reader.row("a") is None
+    assert [reader.sku(row) for row in range(4)] == SKUS
+    assert [reader.in_stock(row) for row in range(4)] == in_stock.tolist()
+    assert arrays["scores"].dtype == np.dtype(score_dtype)
+    np.testing.assert_array_equal(arrays["neighbours"], NEIGHBOURS)
+    np.testing.assert_array_equal(arrays["scores"], SCORES.astype(score_dtype))
+    np.testing.assert_array_equal(arrays["category_ids"], category_ids)
+    np.testing.assert_array_equal(arrays["categories"], category_bitsets)
+    assert [sku for sku, _ in reader.neighbours("b-2")] == ["a-1", "äö-3"]
+    assert reader.neighbours("äö-3", n=1) == [("c", pytest.approx(0.8, abs=1e-3))]
+    assert reader.neighbours("x") == []
+
+
+def test_defaults_without_stock_and_categories(tmp_path):
+    write_neighbour_index(tmp_path / "neighbours.idx", SKUS, NEIGHBOURS, SCORES)
+    arrays = NeighbourIndexReader(tmp_path / "neighbours.idx").get_arrays()
+
+    assert arrays["flags"].tolist() == [1, 1, 1, 1]
+    assert arrays["category_ids"].shape == (0,) and arrays["categories"].shape == (4, 0)
+
+
+def test_empty_index(tmp_path):
+    write_neighbour_index(tmp_path / "neighbours.idx", [], np.empty((0, 0), dtype=np.int32), np.empty((0, 0)))
+    reader = NeighbourIndexReader(tmp_path / "neighbours.idx")
+
+    assert len(reader) == 0
+    assert reader.row("a") is None
+
+
+def test_rewrite_is_visible_to_new_readers(tmp_path):
+    write_neighbour_index(tmp_path / "neighbours.idx", SKUS, NEIGHBOURS, SCORES)
+    write_neighbour_index(tmp_path / "neighbours.idx", SKUS[:2], NEIGHBOURS[:2, :1], SCORES[:2, :1])
+
+    assert len(NeighbourIndexReader(tmp_path / "neighbours.idx")) == 2
+    assert [path.name for path in tmp_path.iterdir()] == ["neighbours.idx"]
+
+
+@pytest.mark.parametrize("field, value", [(1, VERSION - 1), (1, VERSION + 1), (6, 8)])
+def test_unsupported_header_is_rejected(tmp_path, field, value):
+    write_neighbour_index(tmp_path / "neighbours.idx", SKUS, NEIGHBOURS, SCORES)
+    with open(tmp_path / "neighbours.idx", "r+b") as index_file:
+        header = list(struct.unpack_from(HEADER_FORMAT, index_file.read(struct.calcsize(HEADER_FORMAT))))
+        header[field] = value
+        index_file.seek(0)
+        index_file.write(struct.pack(HEADER_FORMAT, *header))
+
+    with pytest.raises(ValueError, match="Unsupported neighbour index"):
+        NeighbourIndexReader(tmp_path / "neighbours.idx").open()
+
+
+def test_other_files_are_rejected(tmp_path):
+    (tmp_path / "neighbours.idx").write_bytes(b"\0" * 64)
+
+    with pytest.raises(ValueError, match="is no neighbour index"):
+        NeighbourIndexReader(tmp_path / "neighbours.idx").open()
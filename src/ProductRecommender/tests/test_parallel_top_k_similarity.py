@@ -0,0 +1,43 @@
+"""
+This file tests that the multi-process neighbour search equals the serial search.
+"""
+import numpy as np
+import pytest
+from scipy import sparse
+
+from ParallelTopKSimilarity import (load_csr_arrays, parallel_top_k_cosine_similarity, parallel_top_k_rows,
+                                    save_csr_arrays)
+from TopKSimilarity import top_k_cosine_similarity, top_k_rows
+
+VECS = sparse.random(300, 50, density=0.1, format="csr", random_state=0)
+
+
+@pytest.mark.parametrize("n_workers, block_size", [(1, 64), (2, 64), (3, 7)])
+def test_equals_serial(n_workers, block_size):
+    indices, scores = parallel_top_k_cosine_similarity(VECS, k=10, block_size=block_size, n_workers=n_workers)
+    serial_indices, serial_scores = top_k_cosine_similarity(VECS, k=10, block_size=block_size)
+
+    assert indices.tolist() == serial_indices.tolist()
+    np.testing.assert_array_equal(scores, serial_scores)
+
+
+def test_rows_equal_serial(tmp_path):
+    row_ids = np.array([299, 0, 17, 150, 151])
+    indices, scores = parallel_top_k_rows(VECS, row_ids, k=5, block_size=2, n_workers=2, exclude_self=False,
+                                          tmp_dir=str(tmp_path))
+    serial_indices, serial_scores = top_k_rows(VECS, row_ids, k=5, exclude_self=False)
+
+    assert indices.tolist() == serial_indices.tolist()
+    np.testing.assert_array_equal(scores, serial_scores)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_csr_arrays_round_trip(tmp_path):
+    save_csr_arrays(tmp_path, "matrix", VECS)
+    matrix = load_csr_arrays(tmp_path, "matrix")
+
+    # The arrays are read-only views of the memory-mapped files, not copies
+    assert not any(array.flags.owndata or array.flags.writeable for array in (matrix.data, matrix.indices,
+                                                                               matrix.indptr))
+    assert matrix.shape == VECS.shape
+    assert (matrix != VECS).nnz == 0
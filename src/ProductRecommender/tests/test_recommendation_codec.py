@@ -0,0 +1,52 @@
+"""
+This file tests the binary format of the recommendations.
+"""
+import numpy as np
+import pytest
+
+from RecommendationCodec import (HEADER, decode_recommendations, decode_to_string, encode_batch,
+                                 encode_recommendations)
+
+
+def test_round_trip():
+    blob = encode_recommendations(np.array([7, 3, 2 ** 31 - 1]), np.array([0.75, 0.5, 0.125]))
+    product_ids, scores = decode_recommendations(blob)
+
+    assert len(blob) == HEADER.size + 3 * (4 + 2)
+    assert product_ids.tolist() == [7, 3, 2 ** 31 - 1]
+    assert scores.tolist() == [0.75, 0.5, 0.125]
+
+
+def test_round_trip_without_recommendations():
+    product_ids, scores = decode_recommendations(encode_recommendations(np.array([]), np.array([])))
+
+    assert len(product_ids) == len(scores) == 0
+
+
+def test_encode_batch_skips_the_padding():
+    recommended_rows = np.array([[2, 1], [0, -1], [-1, -1]])
+    recommended_scores = np.array([[0.5, 0.25], [0.75, -np.inf], [-np.inf, -np.inf]])
+    blobs = encode_batch(recommended_rows, recommended_scores, np.array([10, 11, 12]))
+
+    assert [decode_recommendations(blob)[0].tolist() for blob in blobs] == [[12, 11], [10], []]
+    assert blobs[0] == encode_recommendations(np.array([12, 11]), np.array([0.5, 0.25]))
+    assert decode_to_string(blobs[0], {11: "A-11", 12: "A-12"}) == "A-12$$A-11"
+    assert decode_to_string(blobs[0], {11: "A-11"}) == "A-11"
+
+
+def test_encode_batch_rejects_ids_beyond_int32():
+    with pytest.raises(ValueError, match="int32"):
+        encode_batch(np.array([[0]]), np.array([[1.0]]), np.array([2 ** 31]))
+
+
+@pytest.mark.parametrize("blob", [b"", b"\x01", encode_recommendations(np.array([1, 2]), np.array([1, 1]))[:-1],
+                                  encode_recommendations(np.array([1]), np.array([1])) + b"\x00"])
+def test_blobs_with_a_wrong_length(blob):
+    with pytest.raises(ValueError, match="bytes"):
+        decode_recommendations(blob)
+
+
+def test_unknown_version():
+    blob = bytes([2]) + encode_recommendations(np.array([1]), np.array([1]))[1:]
+    with pytest.raises(ValueError, match="version 2"):
+        decode_recommendations(blob)
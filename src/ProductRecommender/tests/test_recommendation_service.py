@@ -0,0 +1,142 @@
+"""
+This file tests the cache, the request validation and the endpoints of the RecommendationService.
+"""
+import json
+import threading
+import urllib.error
+import urllib.request
+
+import numpy as np
+import pytest
+
+from NeighbourIndex import write_neighbour_index
+from RecommendationService import RecommendationService, create_server
+
+SKUS = ["a", "b", "c", "d"]
+NEIGHBOURS = np.array([[0, 1, 2], [1, 0, 3], [2, 3, 0], [3, 2, -1]])
+SCORES = np.array([[1.0, 0.9, 0.5], [1.0, 0.9, 0.2], [1.0, 0.8, 0.5], [1.0, 0.8, 0.0]])
+CATEGORY_IDS = np.array([7, 8])
+CATEGORY_BITSETS = np.array([[0b10000000], [0b01000000], [0b11000000], [0b10000000]], dtype=np.uint8)
+
+
+def write_index(path, neighbours=NEIGHBOURS, in_stock=None):
+    write_neighbour_index(path, SKUS, neighbours, SCORES, in_stock=in_stock, category_ids=CATEGORY_IDS,
+                          category_bitsets=CATEGORY_BITSETS)
+
+
+@pytest.fixture
+def service(tmp_path):
+    write_index(tmp_path / "neighbours.idx")
+    return RecommendationService(tmp_path / "neighbours.idx", reload_interval=0.0)
+
+
+@pytest.fixture
+def base_url(service):
+    server = create_server(service, "127.0.0.1", 0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def request(url, body=None):
+    data = None if body is None else json.dumps(body).encode("utf8")
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, data=data)) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as error:
+        return error.code, json.loads(error.read())
+
+
+def test_recommend(service):
+    assert service.recommend("a") == ["b", "c"]
+    assert service.recommend("a", n=1) == ["b"]
+    assert service.recommend("a", category="same") == ["c"]
+    assert service.recommend("a", category="8") == ["b", "c"]
+    assert service.recommend("a", category="9") == []
+    assert service.recommend("x") is None
+
+
+def test_recommend_batch(service):
+    assert service.recommend_batch(["a", "d", "x"], n=1) == {"a": ["b"], "d": ["c"], "x": None}
+
+
+def test_out_of_stock_neighbours_are_skipped(tmp_path):
+    write_index(tmp_path / "neighbours.idx", in_stock=np.array([True, False, True, True]))
+
+    assert RecommendationService(tmp_path / "neighbours.idx").recommend("a") == ["c"]
+
+
+def test_n_is_validated_and_clamped(service):
+    with pytest.raises(ValueError):
+        service.recommend("a", n=0)
+    with pytest.raises(ValueError):
+        service.recommend_batch(["a"], n=-1)
+
+    assert service.recommend("a", n=1000) == ["b", "c"]
+    assert service.recommend("a", n=3) == ["b", "c"]
+    assert service.cache.get_stats()["size"] == 1
+
+
+def test_unknown_skus_are_cached(service, monkeypatch):
+    computed_skus = []
+    compute_recommendations = service.compute_recommendations
+
+    def count_and_compute(reader, sku, *args):
+        computed_skus.append(sku)
+        return compute_recommendations(reader, sku, *args)
+
+    monkeypatch.setattr(service, "compute_recommendations", count_and_compute)
+
+    assert service.recommend("x") is None
+    assert service.recommend("x") is None
+    assert computed_skus == ["x"]
+    assert service.cache.get_stats()["size"] == 1
+
+
+def test_reload_replaces_cached_recommendations(tmp_path, service):
+    assert service.recommend("a") == ["b", "c"]
+
+    write_index(tmp_path / "neighbours.idx", neighbours=NEIGHBOURS[:, [0, 2, 1]])
+    service.reload_if_changed()
+
+    assert service.recommend("a") == ["c", "b"]
+
+
+def test_request_during_reload_does_not_cache_the_old_index(tmp_path, service, monkeypatch):
+    compute_recommendations = service.compute_recommendations
+
+    def compute_and_reload(*args):
+        recommended_skus = compute_recommendations(*args)
+        write_index(tmp_path / "neighbours.idx", neighbours=NEIGHBOURS[:, [0, 2, 1]])
+        service.reload()
+        return recommended_skus
+
+    monkeypatch.setattr(service, "compute_recommendations", compute_and_reload)
+    assert service.recommend("a") == ["b", "c"]
+    monkeypatch.undo()
+
+    assert service.recommend("a") == ["c", "b"]
+
+
+def test_endpoints(service, base_url):
+    assert request(f"{base_url}/recommend/a?n=1") == (200, {"sku": "a", "recommendations": ["b"]})
+    assert request(f"{base_url}/recommend/a?category=same") == (200, {"sku": "a", "recommendations": ["c"]})
+    assert request(f"{base_url}/recommend/x")[0] == 404
+    assert request(f"{base_url}/unknown")[0] == 404
+    assert request(f"{base_url}/recommend/batch", {"skus": ["a", "x"], "n": 1}) == \
+        (200, {"recommendations": {"a": ["b"], "x": None}})
+
+    status, stats = request(f"{base_url}/stats")
+    assert status == 200
+    assert stats["requests"] == 4
+    assert stats["index"]["rows"] == 4
+
+
+@pytest.mark.parametrize("path, body", [("/recommend/a?n=0", None), ("/recommend/a?n=-2", None),
+                                        ("/recommend/a?n=x", None), ("/recommend/a?category=x", None),
+                                        ("/recommend/batch", {"n": 1}), ("/recommend/batch", {"skus": ["a"], "n": 0})])
+def test_invalid_requests(service, base_url, path, body):
+    assert request(f"{base_url}{path}", body)[0] == 400
+    assert request(f"{base_url}/stats")[1]["requests"] == 1
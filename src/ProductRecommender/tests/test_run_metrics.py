@@ -0,0 +1,31 @@
+"""
+This file tests the peak RSS of stages that run inside other stages.
+"""
+import threading
+
+from RunMetrics import RunMetrics
+
+
+def test_only_the_enclosing_stage_has_a_peak_rss():
+    metrics = RunMetrics()
+    started = threading.Barrier(2)
+
+    def run_scope(store_code: str):
+        with metrics.measure_stage(f"publish[{store_code}]"):
+            started.wait()
+
+    with metrics.measure_stage("scopes"):
+        threads = [threading.Thread(target=run_scope, args=(store_code,)) for store_code in ("de", "fr")]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    with metrics.measure_stage("write"):
+        pass
+
+    stages = metrics.get_report()["stages"]
+    assert stages["publish[de]"]["peak_rss_mb"] is None
+    assert stages["publish[fr]"]["peak_rss_mb"] is None
+    assert stages["scopes"]["peak_rss_mb"] > 0
+    assert stages["write"]["peak_rss_mb"] > 0
+    assert "recommender_stage_peak_rss_bytes{stage=\"publish[de]\"}" not in metrics.get_prometheus_text()
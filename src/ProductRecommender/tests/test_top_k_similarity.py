@@ -0,0 +1,93 @@
+"""
+This file tests the blocked top-k cosine similarities against the dense cosine matrix.
+"""
+import numpy as np
+import pytest
+from scipy import sparse
+from sklearn.metrics.pairwise import cosine_similarity
+
+from TopKSimilarity import get_block_size, max_similarity_to_rows, select_top_k, top_k_cosine_similarity, top_k_rows
+
+VECS = sparse.random(60, 30, density=0.15, format="csr", random_state=0)
+
+
+def dense_top_k(vecs, k, exclude_self=True):
+    scores = cosine_similarity(vecs)
+    if exclude_self:
+        np.fill_diagonal(scores, -np.inf)
+    columns = np.tile(np.arange(scores.shape[1]), (scores.shape[0], 1))
+    order = np.lexsort((columns, -scores), axis=1)[:, :k]
+    return order, np.take_along_axis(scores, order, axis=1)
+
+
+@pytest.mark.parametrize("block_size, max_block_mb", [(1, None), (7, None), (256, None), (256, 0.001)])
+def test_equals_dense_cosine_matrix(block_size, max_block_mb):
+    indices, scores = top_k_cosine_similarity(VECS, k=10, block_size=block_size, max_block_mb=max_block_mb)
+    expected_indices, expected_scores = dense_top_k(VECS, k=10)
+
+    assert indices.dtype == np.int32 and scores.dtype == np.float32
+    assert indices.tolist() == expected_indices.tolist()
+    np.testing.assert_allclose(scores, expected_scores, atol=1e-6)
+
+
+def test_self_is_excluded():
+    indices, _ = top_k_cosine_similarity(VECS, k=100)
+
+    assert indices.shape == (60, 59)
+    assert not (indices == np.arange(60)[:, None]).any()
+    assert all(set(row) == set(range(60)) - {row_id} for row_id, row in enumerate(indices.tolist()))
+
+
+def test_self_is_included():
+    vecs = sparse.csr_matrix(np.eye(4) + 0.1)
+    indices, scores = top_k_cosine_similarity(vecs, k=1, exclude_self=False)
+
+    assert indices[:, 0].tolist() == [0, 1, 2, 3]
+    np.testing.assert_allclose(scores[:, 0], 1.0, atol=1e-6)
+
+
+def test_equal_scores_are_ordered_by_row():
+    vecs = sparse.csr_matrix([[1, 0], [1, 0], [1, 0], [0, 1], [1, 0]])
+    indices, scores = top_k_cosine_similarity(vecs, k=4, block_size=2)
+
+    assert indices.tolist() == [[1, 2, 4, 3], [0, 2, 4, 3], [0, 1, 4, 3], [0, 1, 2, 4], [0, 1, 2, 3]]
+    assert scores[:, :3].tolist() == [[1, 1, 1]] * 3 + [[0, 0, 0]] + [[1, 1, 1]]
+
+
+def test_select_top_k():
+    indices, scores = select_top_k(np.array([[0.5, 0.9, 0.5, 0.1], [0.0, 0.0, 0.0, 0.0]]), 3)
+
+    assert indices.tolist() == [[1, 0, 2], [0, 1, 2]]
+    np.testing.assert_allclose(scores, [[0.9, 0.5, 0.5], [0.0, 0.0, 0.0]])
+    assert select_top_k(np.zeros((2, 3)), 0)[0].shape == (2, 0)
+
+
+def test_top_k_rows_of_a_subset():
+    row_ids = np.array([5, 0, 42])
+    indices, scores = top_k_rows(VECS, row_ids, k=10, block_size=2)
+    all_indices, all_scores = top_k_cosine_similarity(VECS, k=10)
+
+    assert indices.tolist() == all_indices[row_ids].tolist()
+    np.testing.assert_array_equal(scores, all_scores[row_ids])
+
+
+def test_max_similarity_to_rows():
+    row_ids = np.array([3, 17])
+    scores = cosine_similarity(VECS)[:, row_ids]
+    scores[row_ids, [0, 1]] = -np.inf
+
+    np.testing.assert_allclose(max_similarity_to_rows(VECS, row_ids, block_size=1), scores.max(axis=1), atol=1e-6)
+
+
+def test_vectors_of_the_caller_are_not_normalized():
+    vecs = VECS.astype(np.float32)
+    data = vecs.data.copy()
+    top_k_cosine_similarity(vecs, k=3)
+
+    np.testing.assert_array_equal(vecs.data, data)
+
+
+def test_block_size_in_memory_budget():
+    assert get_block_size(1000, 256) == 256
+    assert get_block_size(1000, 256, max_block_mb=1) == 65
+    assert get_block_size(10 ** 9, 256, max_block_mb=1) == 1
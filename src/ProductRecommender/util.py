@@ -6,7 +6,8 @@ import os
 import yaml
 from pathlib import Path
 
-from typing import Dict
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List
 
 logger = logging.getLogger("utilLogger")
 
@@ -50,3 +51,22 @@ def get_root() -> Path:
     """
     root_path = Path(__file__).parent.resolve()
     return root_path
+
+
+def iter_chunks(items: Iterable, chunk_size: int) -> Iterator[List]:
+    """
+    This function yields lists with at most chunk_size elements of the items.
+    :param items:
+    :type items: Iterable
+    :param chunk_size:
+    :type chunk_size: int
+    :return:
+    :rtype: Iterator[List]
+    """
+    if chunk_size < 1:
+        raise ValueError(f"The chunk size has to be at least 1, got {chunk_size}.")
+    iterator = iter(items)
+    chunk = list(islice(iterator, chunk_size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, chunk_size))